@@ -62,6 +62,10 @@ class Display {
   // Loads partial image data onto the display and updates after each page.
   void Load(const uint8_t* image_data, uint32_t size, uint32_t offset);
 
+  // Decompresses partial PackBits run-length encoded image data, loads it onto
+  // the display, and updates after each page. Runs may span multiple calls.
+  void LoadRle(const uint8_t* compressed_data, uint32_t size);
+
   // Frees display buffers and sends the display to sleep.
   void Finalize();
 
@@ -84,6 +88,10 @@ class Display {
   // Converts one pixel from input encoding to display color encoding.
   uint16_t ConvertPixel(uint8_t input, uint8_t mask, uint8_t shift);
 
+  // Draws the pixels of one byte of image data at the byte offset and updates
+  // the display after each page.
+  void LoadByte(uint8_t input, uint32_t offset);
+
   // Initializes, loads, and finalizes a static image.
   void ShowStatic(const uint8_t* black_data, const uint8_t* red_data,
                   uint16_t width, uint16_t height, uint16_t background);
@@ -93,6 +101,16 @@ class Display {
 
   // The baud rate for the serial connection. Used for GxEPD2 logging.
   uint32_t serial_speed_;
+
+  // The number of literal bytes left in the current run-length encoded run.
+  uint32_t rle_literal_count_;
+
+  // The number of times to repeat the next byte in the current run-length
+  // encoded run.
+  uint32_t rle_repeat_count_;
+
+  // The offset of the next decompressed byte of image data.
+  uint32_t rle_offset_;
 };
 
 #endif  // DISPLAY_H
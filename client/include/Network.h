@@ -29,6 +29,15 @@ class Network {
   bool HttpGet(HTTPClient* http, const String& base_url,
                const std::vector<String>& parameters);
 
+  // Opens a HTTP GET connection with the specified URL and parameters. If the
+  // ETag is not empty and still matches, the server responds with 304 Not
+  // Modified and no data, which is reported by setting not_modified. The ETag
+  // of a new response can be read with http->header("ETag"), and any delay
+  // until the next image with http->header("X-Next-Delay-Ms").
+  bool HttpGet(HTTPClient* http, const String& base_url,
+               const std::vector<String>& parameters, const String& etag,
+               bool* not_modified);
+
   // Deletes any saved Wifi SSID and password.
   void ResetWifi();
 
@@ -18,29 +18,68 @@ const String kNextEndpoint = kBaseUrl + "/next";
 // The URL for the e-paper display image endpoint.
 const String kEpdEndpoint = kBaseUrl + "/epd";
 
+// The encoding of the e-paper display image data, compressed to save airtime.
+const String kEpdEncoding = "rle";
+
+// The HTTP response header with the time in milliseconds until the next image.
+const char* kNextDelayHeader = "X-Next-Delay-Ms";
+
 // The size in bytes of the streaming HTTP response and image buffers.
 const uint32_t kStreamBufferSize = 1024;
 
 // The time in milliseconds to wait before restarting after an error.
 uint64_t kRestartDelayMs = 60 * 60 * 1000;  // 1 hour
 
+// The maximum length of an image ETag that can be kept across deep sleep.
+const size_t kMaxEtagLength = 64;
+
+// The ETag of the image currently shown on the display. Kept in RTC memory,
+// which stays powered during deep sleep.
+RTC_DATA_ATTR char shown_etag[kMaxEtagLength + 1] = "";
+
 // Helper library instances.
 Display display(kSerialSpeed);
 Network network(kSerialSpeed);
 Power power;
 
+// Remembers the ETag of the image shown on the display, unless it's too long.
+void saveEtag(const String& etag) {
+  if (etag.length() > kMaxEtagLength) {
+    Serial.printf("ETag too long: %s\n", etag.c_str());
+    shown_etag[0] = '\0';
+    return;
+  }
+
+  strcpy(shown_etag, etag.c_str());
+}
+
 // Streams the image from the server and sends it to the display in chunks.
-bool downloadImage() {
+// The display is left untouched if the image matches the ETag. Any delay until
+// the next image sent along with it is stored in next_delay_ms.
+bool downloadImage(const String& etag, String* next_delay_ms) {
   Serial.println("Downloading image");
   HTTPClient http;
 
   // Request the current image from the server.
+  bool not_modified;
   if (!network.HttpGet(&http, kEpdEndpoint,
                        {"width", String(display.Width()),
                         "height", String(display.Height()),
-                        "variant", display.Variant()})) {
+                        "variant", display.Variant(),
+                        "encoding", kEpdEncoding},
+                       etag, &not_modified)) {
     return false;
   }
+  *next_delay_ms = http.header(kNextDelayHeader);
+
+  // Skip the download and the display update if the image is unchanged.
+  if (not_modified) {
+    Serial.println("Image unchanged");
+    http.end();
+    saveEtag(etag);
+    return true;
+  }
+  String new_etag = http.header("ETag");
 
   // Start reading from the stream.
   uint8_t buffer[kStreamBufferSize];
@@ -58,8 +97,8 @@ bool downloadImage() {
     // Fill the buffer.
     uint32_t count = stream->readBytes(buffer, sizeof(buffer));
 
-    // Send the buffer to the display.
-    display.Load(buffer, count, total_count);
+    // Decompress the buffer and send it to the display.
+    display.LoadRle(buffer, count);
 
     total_count += count;
     Serial.printf("Read %lu bytes (%lu total)\n", count, total_count);
@@ -67,22 +106,27 @@ bool downloadImage() {
 
   Serial.println("Download complete");
   http.end();
+  saveEtag(new_etag);
   return true;
 }
 
-// Sleeps for a time received from the server.
-void scheduleSleep() {
+// Sleeps for a time received from the server. Unless the delay came with the
+// image, it's requested separately.
+void scheduleSleep(String delay_ms_str) {
   Serial.println("Scheduling sleep");
-  HTTPClient http;
 
-  // Request the next wake time from the server.
-  if (!network.HttpGet(&http, kNextEndpoint)) {
-    return;
-  }
+  if (delay_ms_str.length() == 0) {
+    HTTPClient http;
 
-  // Read the sleep time from the server.
-  String delay_ms_str = http.getString();
-  http.end();
+    // Request the next wake time from the server.
+    if (!network.HttpGet(&http, kNextEndpoint)) {
+      return;
+    }
+
+    // Read the sleep time from the server.
+    delay_ms_str = http.getString();
+    http.end();
+  }
   Serial.printf("Sleep server response: %s\n", delay_ms_str.c_str());
   uint64_t delay_ms = strtoull(delay_ms_str.c_str(), nullptr, 10);
   power.DeepSleep(delay_ms);
@@ -91,6 +135,11 @@ void scheduleSleep() {
 void setup() {
   Serial.begin(kSerialSpeed);
 
+  // Forget the shown image's ETag until it's confirmed again, so that any
+  // error image shown in the meantime gets replaced.
+  String etag = shown_etag;
+  shown_etag[0] = '\0';
+
   // Check if the Wifi reset pin has been connected to GND.
   pinMode(kWifiResetPin, INPUT_PULLUP);
   delay(1);  // Wait for pull-up to become active.
@@ -107,13 +156,14 @@ void setup() {
 
   // Show the latest image.
   display.Initialize();
-  if (!downloadImage()) {
+  String next_delay_ms;
+  if (!downloadImage(etag, &next_delay_ms)) {
     return;
   }
   display.Finalize();
 
   // Go to sleep until the next refresh.
-  scheduleSleep();
+  scheduleSleep(next_delay_ms);
 }
 
 void loop() {
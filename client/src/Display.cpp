@@ -38,44 +38,78 @@ void Display::Initialize() {
 
   // Start paged drawing.
   gx_epd_->firstPage();
+
+  // Reset the run-length decoder.
+  rle_literal_count_ = 0;
+  rle_repeat_count_ = 0;
+  rle_offset_ = 0;
 }
 
 void Display::Load(const uint8_t* image_data, uint32_t size, uint32_t offset) {
   Serial.printf("Loading image data: %lu bytes\n", size);
 
-  // The number of pixels per input byte depends on the display variant.
-  const uint8_t pixels_per_byte = (Variant() == kVariant7Color ? 2 : 4);
-
   // Look at the image data one byte at a time.
   for (int i = 0; i < size; ++i) {
-    // Convert the input byte to display pixels.
-    uint8_t input = image_data[i];
-    uint16_t pixels[pixels_per_byte];
-    if (Variant() == kVariant7Color) {
-      // Read 2 4-bit input pixels per byte.
-      pixels[0] = ConvertPixel(input, 0xF0, 4);
-      pixels[1] = ConvertPixel(input, 0x0F, 0);
-    } else {  // Variant() == kVariant3Color
-      // Read 4 2-bit input pixels per byte.
-      pixels[0] = ConvertPixel(input, 0xC0, 6);
-      pixels[1] = ConvertPixel(input, 0x30, 4);
-      pixels[2] = ConvertPixel(input, 0x0C, 2);
-      pixels[3] = ConvertPixel(input, 0x03, 0);
-    }
+    LoadByte(image_data[i], offset + i);
+  }
+}
+
+void Display::LoadRle(const uint8_t* compressed_data, uint32_t size) {
+  Serial.printf("Loading compressed image data: %lu bytes\n", size);
 
-    // Write the output pixels.
-    for (int in = 0; in < pixels_per_byte; ++in) {
-      uint16_t pixel = pixels[in];
-      uint32_t out = pixels_per_byte * (offset + i) + in;
-      int16_t x = out % gx_epd_->width();
-      int16_t y = out / gx_epd_->width();
-      gx_epd_->drawPixel(x, y, pixel);
-
-      // Trigger a display update after the last pixel of each page.
-      if ((y + 1) % gx_epd_->pageHeight() == 0 && x == gx_epd_->width() - 1) {
-        Serial.println("Updating display");
-        gx_epd_->nextPage();
+  for (int i = 0; i < size; ++i) {
+    uint8_t input = compressed_data[i];
+
+    if (rle_literal_count_ > 0) {
+      // Copy a literal byte.
+      LoadByte(input, rle_offset_++);
+      --rle_literal_count_;
+    } else if (rle_repeat_count_ > 0) {
+      // Repeat the byte.
+      for (; rle_repeat_count_ > 0; --rle_repeat_count_) {
+        LoadByte(input, rle_offset_++);
       }
+    } else if (input < 128) {
+      // Start a run of 1 to 128 literal bytes.
+      rle_literal_count_ = input + 1;
+    } else if (input > 128) {
+      // Start a run repeating the next byte 2 to 128 times.
+      rle_repeat_count_ = 257 - input;
+    }
+    // A header of 128 is skipped.
+  }
+}
+
+void Display::LoadByte(uint8_t input, uint32_t offset) {
+  // The number of pixels per input byte depends on the display variant.
+  const uint8_t pixels_per_byte = (Variant() == kVariant7Color ? 2 : 4);
+
+  // Convert the input byte to display pixels.
+  uint16_t pixels[pixels_per_byte];
+  if (Variant() == kVariant7Color) {
+    // Read 2 4-bit input pixels per byte.
+    pixels[0] = ConvertPixel(input, 0xF0, 4);
+    pixels[1] = ConvertPixel(input, 0x0F, 0);
+  } else {  // Variant() == kVariant3Color
+    // Read 4 2-bit input pixels per byte.
+    pixels[0] = ConvertPixel(input, 0xC0, 6);
+    pixels[1] = ConvertPixel(input, 0x30, 4);
+    pixels[2] = ConvertPixel(input, 0x0C, 2);
+    pixels[3] = ConvertPixel(input, 0x03, 0);
+  }
+
+  // Write the output pixels.
+  for (int in = 0; in < pixels_per_byte; ++in) {
+    uint16_t pixel = pixels[in];
+    uint32_t out = pixels_per_byte * offset + in;
+    int16_t x = out % gx_epd_->width();
+    int16_t y = out / gx_epd_->width();
+    gx_epd_->drawPixel(x, y, pixel);
+
+    // Trigger a display update after the last pixel of each page.
+    if ((y + 1) % gx_epd_->pageHeight() == 0 && x == gx_epd_->width() - 1) {
+      Serial.println("Updating display");
+      gx_epd_->nextPage();
     }
   }
 }
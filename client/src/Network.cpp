@@ -64,6 +64,12 @@ const uint32_t kConnectTimeoutStepMs = 500;
 // The time in milliseconds before timing out when reading HTTP data.
 const uint16_t kReadTimeoutMs = 30 * 1000;
 
+// The HTTP request header asking to skip a response with a matching ETag.
+const char* kIfNoneMatchHeader = "If-None-Match";
+
+// The HTTP response headers to keep for the caller.
+const char* kResponseHeaders[] = {"ETag", "X-Next-Delay-Ms"};
+
 bool Network::ConnectWifi() {
   if (WiFi.isConnected()) {
     Serial.println("Already connected");
@@ -113,6 +119,15 @@ bool Network::HttpGet(HTTPClient* http, const String& url) {
 
 bool Network::HttpGet(HTTPClient* http, const String& base_url,
                       const std::vector<String>& parameters) {
+  bool not_modified;
+  return HttpGet(http, base_url, parameters, "", &not_modified);
+}
+
+bool Network::HttpGet(HTTPClient* http, const String& base_url,
+                      const std::vector<String>& parameters,
+                      const String& etag, bool* not_modified) {
+  *not_modified = false;
+
   if (parameters.size() % 2 != 0) {
     Serial.printf("Incomplete pairs of keys and values for URL: %s\n",
                   base_url.c_str());
@@ -140,6 +155,13 @@ bool Network::HttpGet(HTTPClient* http, const String& base_url,
   // Authenticate the request.
   AddAuthHeader(http);
 
+  // Let the server skip the response if it hasn't changed.
+  if (etag.length() > 0) {
+    http->addHeader(kIfNoneMatchHeader, etag);
+  }
+  http->collectHeaders(kResponseHeaders,
+                       sizeof(kResponseHeaders) / sizeof(kResponseHeaders[0]));
+
   int status = http->GET();
   if (status <= 0) {
     Serial.printf("Request failed: %s\n", http->errorToString(status).c_str());
@@ -148,6 +170,10 @@ bool Network::HttpGet(HTTPClient* http, const String& base_url,
   }
 
   Serial.printf("Status code: %d\n", status);
+  if (status == HTTP_CODE_NOT_MODIFIED && etag.length() > 0) {
+    *not_modified = true;
+    return true;
+  }
   if (status != HTTP_CODE_OK) {
     http->end();
     return false;
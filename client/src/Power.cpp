@@ -1,9 +1,9 @@
 #include "Power.h"
 
-// The power domains to turn off for deep sleep.
+// The power domains to turn off for deep sleep. RTC slow memory stays on to
+// keep the shown image's ETag.
 const esp_sleep_pd_domain_t kPowerDomains[] = {
     ESP_PD_DOMAIN_RTC_PERIPH,
-    ESP_PD_DOMAIN_RTC_SLOW_MEM,
     ESP_PD_DOMAIN_RTC_FAST_MEM,
     ESP_PD_DOMAIN_XTAL};
 
@@ -1,11 +1,22 @@
 from glob import glob
 from logging import info
+from numpy import array
+from numpy import uint8
+from numpy import unique
 from os.path import join as path_join
 from PIL import Image
-from random import choice
 from random import randint
+from random import randrange
 
+from compositing import color_keys
+from compositing import key_colors
+from compositing import new_canvas
 from content import ImageContent
+from epd import epd_encoding
+from epd import epd_image
+from epd import epd_indices
+from epd import epd_packed_rows
+from epd import DISPLAY_VARIANTS
 
 # The directory containing static artwork images.
 IMAGES_DIR = 'assets/artwork'
@@ -13,6 +24,81 @@ IMAGES_DIR = 'assets/artwork'
 # The file extension of all artwork image files.
 IMAGE_EXTENSION = 'gif'
 
+# The color around artwork smaller than the display.
+BACKGROUND_COLOR = (0, 0, 0)
+
+
+class ArtworkCatalog(object):
+    """The artwork images, decoded once into arrays of indices into each
+    display variant's palette, so that random crops are array slices. The
+    rows are also packed into display data, so that crops aligned to whole
+    bytes skip packing.
+    """
+
+    def __init__(self):
+        self._filenames = sorted(glob(path_join(IMAGES_DIR, '*.%s' %
+                                                IMAGE_EXTENSION)))
+        self._indices = {variant: [] for variant in DISPLAY_VARIANTS}
+        self._packed_rows = {variant: [] for variant in DISPLAY_VARIANTS}
+        self._background = {variant: epd_indices([BACKGROUND_COLOR],
+                                                 variant)[0]
+                            for variant in DISPLAY_VARIANTS}
+
+        for filename in self._filenames:
+            # The source artwork is already quantized, so map each of its
+            # colors to the closest palette color without dithering.
+            pixels = array(Image.open(filename).convert('RGB'))
+            keys, inverse = unique(color_keys(pixels), return_inverse=True)
+            colors = key_colors(keys)
+            for variant in DISPLAY_VARIANTS:
+                remap = array(epd_indices(colors, variant), dtype=uint8)
+                indices = remap[inverse.reshape(-1)].reshape(
+                    pixels.shape[:2])
+                self._indices[variant].append(indices)
+                try:
+                    packed_rows = epd_packed_rows(indices, variant)
+                except ValueError:
+                    packed_rows = None
+                self._packed_rows[variant].append(packed_rows)
+
+        info('Loaded %d artwork images' % len(self._filenames))
+
+    def image(self, width, height, variant):
+        """Crops a random image to a random display-sized area."""
+
+        pixels_per_byte = 8 // epd_encoding(variant).shape[1]
+        index = randrange(len(self._filenames))
+        info('Using artwork file: %s' % self._filenames[index])
+        indices = self._indices[variant][index]
+        image_height, image_width = indices.shape
+
+        # Align the crop to whole bytes of the packed rows.
+        x = randint(0, max(0, image_width - width) // pixels_per_byte)
+        x *= pixels_per_byte
+        y = randint(0, max(0, image_height - height))
+        crop = indices[y:y + height, x:x + width]
+
+        # Fill the rest of the display around smaller images.
+        if crop.shape != (height, width):
+            canvas = new_canvas(width, height, self._background[variant])
+            canvas[:crop.shape[0], :crop.shape[1]] = crop
+            return epd_image(canvas, variant)
+
+        # Slice the display data out of the packed rows, if the crop fills
+        # whole bytes.
+        data = None
+        packed_rows = self._packed_rows[variant][index]
+        if packed_rows is not None and width % pixels_per_byte == 0:
+            data = packed_rows[y:y + height,
+                               x // pixels_per_byte:
+                               (x + width) // pixels_per_byte].tobytes()
+
+        return epd_image(crop, variant, data)
+
+
+# The decoded artwork images shared by all instances.
+catalog = ArtworkCatalog()
+
 
 class Artwork(ImageContent):
     """A collection of randomly selected image artwork."""
@@ -20,19 +106,4 @@ class Artwork(ImageContent):
     def image(self, user, width, height, variant):
         """Generates an artwork image."""
 
-        # Load a random image.
-        paths = glob(path_join(IMAGES_DIR, '*.%s' % IMAGE_EXTENSION))
-        filename = choice(paths)
-        info('Using artwork file: %s' % filename)
-        image = Image.open(filename)
-        image = image.convert('RGB')
-
-        # Crop the image to a random display-sized area.
-        x = randint(0, max(0, image.width - width))
-        y = randint(0, max(0, image.height - height))
-        image = image.crop((x, y, x + width, y + height))
-
-        # The source artwork is already quantized (no dithering).
-        image = image.convert('P', dither=None, palette=Image.ADAPTIVE)
-
-        return image
+        return catalog.image(width, height, variant)
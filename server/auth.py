@@ -7,8 +7,10 @@ from oauth2client.client import HttpAccessTokenRefreshError
 from oauth2client.client import OAuth2WebServerFlow
 from re import compile as re_compile
 
+from firestore import config
 from firestore import Firestore
 from firestore import GoogleCalendarStorage
+from render_context import RenderContext
 from response import display_metadata
 from response import forbidden_response
 from response import settings_response
@@ -61,8 +63,6 @@ def validate_key(func):
 def user_auth(image_response=None, bad_response=forbidden_response):
     """A decorator for Flask route functions to enforce user authentication."""
 
-    firestore = Firestore()
-
     def decorator(func):
 
         @wraps(func)
@@ -82,7 +82,7 @@ def user_auth(image_response=None, bad_response=forbidden_response):
                 return bad_response()
 
             # Look up the user from the key.
-            user = firestore.user(key)
+            user = Firestore().user(key)
             if not user:
                 if image_response:
                     # For image requests, start the new user flow.
@@ -93,10 +93,15 @@ def user_auth(image_response=None, bad_response=forbidden_response):
                     # Otherwise, return a forbidden response.
                     return bad_response()
 
-            # Inject the key and user into the function arguments.
+            # Inject the key and the user, wrapped in a context memoizing
+            # lookups for this request, into the function arguments.
+            context = RenderContext(user)
             kwargs['key'] = key
-            kwargs['user'] = user
-            return func(*args, **kwargs)
+            kwargs['user'] = context
+            response = func(*args, **kwargs)
+            context.log_lookups()
+
+            return response
 
         return wrapper
 
@@ -106,7 +111,7 @@ def user_auth(image_response=None, bad_response=forbidden_response):
 def _google_calendar_flow(key):
     """Creates the OAuth flow."""
 
-    secrets = Firestore().google_calendar_secrets()
+    secrets = config.google_calendar_secrets()
     return OAuth2WebServerFlow(client_id=secrets['client_id'],
                                client_secret=secrets['client_secret'],
                                scope=GOOGLE_CALENDAR_SCOPE,
@@ -1,17 +1,215 @@
-from os.path import join as path_join
-from PIL import Image
+from cachetools import cached
+from cachetools import LRUCache
+from json import load
+from numpy import array
+from numpy import uint8
+from numpy import zeros
 from random import random
 
+from city_assets import CityAssets
+from compositing import blit
+from compositing import Sprite
+from compositing import stencil
 from content import ContentError
 from content import ImageContent
 from epd import adjust_xy
+from epd import epd_image
+from epd import epd_indices
 from firestore import DataError
 from local_time import LocalTime
 from sun import Sun
 from weather import Weather
 
-# The directory containing city image assets.
-ASSETS_DIR = 'assets/city'
+# The file defining the layers of the city scene.
+LAYERS_FILE = 'assets/city/layers.json'
+
+# The names of the conditions layers can depend on, in the order of their bits
+# in the compiled layers.
+PREDICATES = ['daylight', 'clear', 'partly_cloudy', 'cloudy', 'rainy', 'snowy',
+              'foggy', 'modulo_3_0', 'modulo_3_1', 'modulo_3_2']
+
+# The keys allowed in a layer group.
+GROUP_KEYS = {'condition', 'not_condition', 'and_condition', 'or_condition',
+              'layers'}
+
+# The keys allowed in a layer with content.
+CONTENT_KEYS = {'condition', 'not_condition', 'and_condition', 'or_condition',
+                'else_condition', 'probability', 'file', 'xy'}
+
+# The time to live in seconds for cached frames, matching the weather cache.
+FRAME_TTL_S = 60 * 60  # 1 hour
+
+# The maximum number of predicate states with cached layouts, which is more
+# than the combinations of daylight, weather, and day that can occur.
+MAX_CACHED_LAYOUTS = 64
+
+# The maximum total size in bytes of cached base plates and sprites.
+MAX_SCENE_BYTES = 32 * 1024 * 1024  # 32 MB
+
+# Whether a layer is drawn in a predicate state: never, always, or depending
+# on chance.
+NEVER_DRAWN = 0
+ALWAYS_DRAWN = 1
+MAYBE_DRAWN = 2
+
+# The decoded city image assets shared by all instances.
+assets = CityAssets()
+
+
+def _predicate_mask(names):
+    """Combines the bits of the named predicates."""
+
+    mask = 0
+    for name in names:
+        try:
+            mask |= 1 << PREDICATES.index(name)
+        except ValueError:
+            raise ValueError('Unknown layer condition: %s' % name)
+
+    return mask
+
+
+def _scene_bytes(scene):
+    """Adds up the size in bytes of a base plate and its sprites."""
+
+    plate, sprites = scene
+    size = plate.nbytes
+    for _, _, sprite, _, _ in sprites:
+        size += sprite.indices.nbytes + sprite.mask.nbytes
+
+    return size
+
+
+def _overlaps(sprite, sprites):
+    """Checks if the opaque pixels of a sprite intersect those of any of the
+    other sprites. Each sprite is a tuple of its box and its boolean mask.
+    """
+
+    (left, top, right, bottom), mask = sprite
+    for (other_left, other_top, other_right, other_bottom), other_mask in (
+            sprites):
+        # Compare the masks where the boxes intersect.
+        intersection_left = max(left, other_left)
+        intersection_top = max(top, other_top)
+        intersection_right = min(right, other_right)
+        intersection_bottom = min(bottom, other_bottom)
+        if (intersection_left >= intersection_right or
+                intersection_top >= intersection_bottom):
+            continue
+        if (mask[intersection_top - top:intersection_bottom - top,
+                 intersection_left - left:intersection_right - left] &
+                other_mask[intersection_top - other_top:
+                           intersection_bottom - other_top,
+                           intersection_left - other_left:
+                           intersection_right - other_left]).any():
+            return True
+
+    return False
+
+
+def _composite(layers, width, height):
+    """Combines the sprites of layers at display coordinates into one sprite,
+    cropped to the display. Returns its position and the sprite, or None if
+    it's not visible.
+    """
+
+    sprites = [(assets.sprite(file), x, y) for file, x, y in layers]
+    left = max(min(x for _, x, _ in sprites), 0)
+    top = max(min(y for _, _, y in sprites), 0)
+    right = min(max(x + sprite.width for sprite, x, _ in sprites), width)
+    bottom = min(max(y + sprite.height for sprite, _, y in sprites), height)
+    if left >= right or top >= bottom:
+        return None
+
+    composite = Sprite(assets.new_canvas(right - left, bottom - top),
+                       zeros((bottom - top, right - left), dtype=bool))
+    for sprite, x, y in sprites:
+        blit(composite.indices, sprite, (x - left, y - top))
+        stencil(composite.mask, sprite, (x - left, y - top), True)
+
+    return (left, top), composite
+
+
+def _compile_layers(layers, required=0, forbidden=0, any_masks=(),
+                    program=None):
+    """Flattens the layer definitions into a list of instructions, one for
+    each layer with content, in drawing order. Each layer is a dictionary with
+    a combination of the following keys.
+
+    Optionally one or more of...
+         'condition': A predicate that needs to be true for this layer to be
+                      drawn.
+     'not_condition': A predicate that needs to be false for this layer to be
+                      drawn.
+     'and_condition': A list of predicates that all have to be true for this
+                      layer to be drawn.
+      'or_condition': A list of predicates where at least one has to be true
+                      for this layer to be drawn.
+
+    Either a layer group...
+            'layers': A list of layer dictionaries to be drawn recursively.
+
+    Or layer content...
+              'file': The path of the image file for this layer relative to
+                      the city assets directory.
+                'xy': A list defining the top left corner of this layer.
+
+    And optionally...
+    'else_condition': A list of file paths (identifying layers in the same
+                      group) that have to not have been drawn for this layer
+                      to be drawn.
+       'probability': The probability in percent for this layer to be drawn.
+
+    Predicates are referenced by their names in PREDICATES. Each instruction
+    is a tuple of the file, the coordinates, the bit masks of predicates that
+    have to be true, false, and at least partially true, the indices of the
+    instructions that have to not have been drawn, and the probability.
+    """
+
+    if program is None:
+        program = []
+
+    # Remember the instructions drawing each file in this group.
+    group_files = {}
+
+    for layer in layers:
+        # Collect all predicates the layer depends on, including its group's.
+        layer_required = required | _predicate_mask(
+            [layer['condition']] if 'condition' in layer else [])
+        layer_required |= _predicate_mask(layer.get('and_condition', []))
+        layer_forbidden = forbidden | _predicate_mask(
+            [layer['not_condition']] if 'not_condition' in layer else [])
+        layer_any_masks = any_masks
+        if 'or_condition' in layer:
+            layer_any_masks += (_predicate_mask(layer['or_condition']),)
+
+        if 'layers' in layer:
+            unsupported_keys = set(layer) - GROUP_KEYS
+            if unsupported_keys:
+                raise ValueError('Unsupported layer group keys: %s' %
+                                 unsupported_keys)
+            _compile_layers(layer['layers'], layer_required, layer_forbidden,
+                            layer_any_masks, program)
+            continue
+
+        unsupported_keys = set(layer) - CONTENT_KEYS
+        if unsupported_keys:
+            raise ValueError('Unsupported layer keys: %s' % unsupported_keys)
+
+        unless_drawn = []
+        for file in layer.get('else_condition', []):
+            try:
+                unless_drawn.extend(group_files[file])
+            except KeyError:
+                raise ValueError('Unknown else condition file: %s' % file)
+
+        x, y = layer['xy']
+        group_files.setdefault(layer['file'], []).append(len(program))
+        program.append((layer['file'], x, y, layer_required, layer_forbidden,
+                        layer_any_masks, tuple(unless_drawn),
+                        layer.get('probability')))
+
+    return program
 
 
 class City(ImageContent):
@@ -22,6 +220,25 @@ class City(ImageContent):
         self._sun = Sun(geocoder)
         self._weather = Weather(geocoder)
 
+        # Look up the predicate functions in the order of their bits.
+        predicates = {
+            'daylight': self._sun.is_daylight,
+            'clear': self._weather.is_clear,
+            'partly_cloudy': self._weather.is_partly_cloudy,
+            'cloudy': self._weather.is_cloudy,
+            'rainy': self._weather.is_rainy,
+            'snowy': self._weather.is_snowy,
+            'foggy': self._weather.is_foggy,
+            'modulo_3_0': self._modulo_3_0,
+            'modulo_3_1': self._modulo_3_1,
+            'modulo_3_2': self._modulo_3_2
+        }
+        self._predicates = [predicates[name] for name in PREDICATES]
+
+        # Compile the layer definitions once.
+        with open(LAYERS_FILE) as layers_file:
+            self._program = _compile_layers(load(layers_file))
+
     def _day_of_year(self, user):
         """Returns the current day of the year in the users's time zone."""
 
@@ -42,1000 +259,157 @@ class City(ImageContent):
 
         return self._day_of_year(user) % 3 == 2
 
-    def _layers(self):
-        """The list of layers making up the city scene. Each layer is a
-        dictionary with a combination of the following keys.
-
-        Exactly one of...
-             'condition': A function that needs to evaluate to True for this
-                          layer to be drawn.
-         'not_condition': A function that needs to evaluate to False for this
-                          layer to be drawn.
-         'and_condition': A list of functions that all have to evaluate to True
-                          for this layer to be drawn.
-          'or_condition': A list of functions where at least one has to
-                          evaluate to True for this layer to be drawn.
-        'else_condition': A list of file paths (identifying layers) that have
-                          to not have been drawn for this layer to be drawn.
-
-        And optionally...
-           'probability': The probability in percent for this layer to be
-                          drawn.
-
-        Either a layer group...
-                'layers': A list of layer dictionaries to be drawn recursively.
-
-        Or layer content...
-                  'file': The path of the image file for this layer relative to
-                          ASSETS_DIR.
-
-        With a fixed position...
-                    'xy': A tuple defining the top left corner of this layer.
-
-        Or a dynamic position...
-          'xy_transform': A function that evaluates to a tuple defining the top
-                          left corner of this layer.
-               'xy_data': The argument passed to the function specified in
-                          'xy_transform'.
+    def _state(self, user):
+        """Evaluates each predicate once and combines their bits."""
+
+        state = 0
+        for bit, predicate in enumerate(self._predicates):
+            if predicate(user):
+                state |= 1 << bit
+
+        return state
+
+    @cached(cache=LRUCache(maxsize=MAX_CACHED_LAYOUTS))
+    def _layout(self, state):
+        """Splits the layers drawn in a predicate state into the ones that can
+        be composited into a base plate and the ones that have to be drawn on
+        top of it for each image.
+
+        The base plate has all layers that are always drawn and don't cover
+        any layers drawn on top of it. The rest, in drawing order, are the
+        layers depending on chance and groups of the remaining layers, which
+        are composited into one sprite each. Layers which don't intersect may
+        be drawn out of order. Each is a tuple of the layer index (None for
+        groups), the list of layers, the indices of the layers that have to
+        not have been drawn, and the probability.
         """
 
-        return [{
-            'condition': self._sun.is_daylight,
-            'layers': [
-                {
-                    'file': 'day/environment/water-day.gif',
-                    'xy': (-640, -384),
-                    'or_condition': [self._weather.is_clear,
-                                     self._weather.is_partly_cloudy,
-                                     self._weather.is_cloudy,
-                                     self._weather.is_foggy]
-                },
-                {
-                    'file': 'day/environment/water-flat-day.gif',
-                    'xy': (-640, -384),
-                    'or_condition': [self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'day/environment/isle-day.gif',
-                    'xy': (-4, 24)
-                },
-                {
-                    'file': 'day/blocks/bldg-facstdo-day.gif',
-                    'xy': (262, 9)
-                },
-                {
-                    'file': 'day/misc/lightpole-day.gif',
-                    'xy': (130, 5)
-                },
-                {
-                    'file': 'day/blocks/bldg-verylittlegravitas-day.gif',
-                    'xy': (188, 18)
-                },
-                {
-                    'file': 'day/blocks/block-D-day.gif',
-                    'xy': (74, 59)
-                },
-                {
-                    'file': 'day/vehicles/van2-247-yp-day.gif',
-                    'xy': (156, 116),
-                    'probability': 50
-                },
-                {
-                    'file': 'day/misc/streetlight-xp-day.gif',
-                    'xy': (314, 11)
-                },
-                {
-                    'file': 'day/blocks/block-F-day.gif',
-                    'xy': (418, 6)
-                },
-                {
-                    'file': 'day/blocks/bldg-home-day.gif',
-                    'xy': (422, 36)
-                },
-                {
-                    'file': 'day/vehicles/boat3-yp-day.gif',
-                    'xy': (590, 87),
-                    'probability': 50
-                },
-                {
-                    'file': ('day/characters/blockbob/'
-                             'blockbob-driving-xp-day.gif'),
-                    'xy': (418, 109),
-                    'probability': 50,
-                    'not_condition': self._weather.is_rainy
-                },
-                {
-                    'file': ('day/characters/blockbob/'
-                             'blockbob-driving-xp-day-rain.gif'),
-                    'xy': (418, 93),
-                    'probability': 50,
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/environment/fog1-day.gif',
-                    'xy': (-640, -384),
-                    'condition': self._weather.is_foggy
-                },
-                {
-                    'file': 'day/blocks/bldg-robosuper-day.gif',
-                    'xy': (540, 116)
-                },
-                {
-                    'file': 'day/blocks/block-A/block-A-day.gif',
-                    'xy': (200, 6),
-                    'not_condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/blocks/block-A/block-A-day-rain.gif',
-                    'xy': (200, 6),
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/characters/blockbob/blockbob-sitting-day.gif',
-                    'xy': (276, 78),
-                    'else_condition': [
-                        'day/characters/blockbob/blockbob-driving-xp-day.gif',
-                        ('day/characters/blockbob/'
-                         'blockbob-driving-xp-day-rain.gif')
-                    ],
-                },
-                {
-                    'file': ('day/misc/computersays/'
-                             'billboard-computer-no-day.gif'),
-                    'xy': (386, 51),
-                    'probability': 50
-                },
-                {
-                    'file': ('day/misc/computersays/'
-                             'billboard-computer-yes-day.gif'),
-                    'xy': (386, 51),
-                    'else_condition': [
-                        'day/misc/computersays/billboard-computer-no-day.gif'
-                    ]
-                },
-                {
-                    'file': 'day/misc/3letterLED/3letterLED-UFO-day.gif',
-                    'xy': (354, 125),
-                    'condition': self._modulo_3_0
-                },
-                {
-                    'file': 'day/misc/3letterLED/3letterLED-LOL-day.gif',
-                    'xy': (354, 125),
-                    'condition': self._modulo_3_1
-                },
-                {
-                    'file': 'day/misc/3letterLED/3letterLED-404-day.gif',
-                    'xy': (354, 125),
-                    'condition': self._modulo_3_2
-                },
-                {
-                    'file': 'day/misc/streetlight-yp-day.gif',
-                    'xy': (168, 125)
-                },
-                {
-                    'file': 'day/characters/robogroup/robogroup-day.gif',
-                    'xy': (554, 168),
-                    'probability': 50,
-                    'not_condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/characters/robogroup/robogroup-day-rain.gif',
-                    'xy': (547, 157),
-                    'probability': 50,
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/misc/streetlight-xm-day.gif',
-                    'xy': (596, 164)
-                },
-                {
-                    'file': 'day/misc/streetlight-yp-day.gif',
-                    'xy': (516, 119)
-                },
-                {
-                    'file': ('day/characters/deliverybiker/'
-                             'deliverybiker-xm-day.gif'),
-                    'xy': (500, 142),
-                    'probability': 50,
-                    'not_condition': self._weather.is_rainy
-                },
-                {
-                    'file': ('day/characters/deliverybiker/'
-                             'deliverybiker-xm-day-rain.gif'),
-                    'xy': (492, 135),
-                    'probability': 50,
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/environment/fog2-day.gif',
-                    'xy': (-640, -384),
-                    'condition': self._weather.is_foggy
-                },
-                {
-                    'file': 'day/blocks/block-E/block-E-day.gif',
-                    'xy': (12, 51),
-                    'not_condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/blocks/block-E/block-E-day-rain.gif',
-                    'xy': (12, 51),
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/vehicles/boat1/boat1-yp-day.gif',
-                    'xy': (6, 238),
-                    'probability': 50,
-                    'not_condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/vehicles/boat1/boat1-yp-day-rain.gif',
-                    'xy': (6, 216),
-                    'probability': 50,
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/misc/bench-day.gif',
-                    'xy': (48, 245)
-                },
-                {
-                    'file': 'day/vehicles/boat2-ym-day.gif',
-                    'xy': (12, 261),
-                    'probability': 50
-                },
-                {
-                    'file': 'day/characters/ladybiker/ladybiker-day.gif',
-                    'xy': (102, 251),
-                    'probability': 50,
-                    'not_condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/characters/ladybiker/ladybiker-day-rain.gif',
-                    'xy': (102, 234),
-                    'probability': 50,
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/misc/streetlight-ym-day.gif',
-                    'xy': (38, 224)
-                },
-                {
-                    'file': 'day/vehicles/van1-yp-day.gif',
-                    'xy': (412, 164),
-                    'probability': 50
-                },
-                {
-                    'file': 'day/vehicles/van2-milk-yp-day.gif',
-                    'xy': (440, 158),
-                    'probability': 50
-                },
-                {
-                    'file': 'day/vehicles/van2-yp-day.gif',
-                    'xy': (388, 184),
-                    'probability': 50
-                },
-                {
-                    'file': 'day/vehicles/car2-xp-day.gif',
-                    'xy': (236, 213),
-                    'probability': 50
-                },
-                {
-                    'file': 'day/vehicles/car1-yp-day.gif',
-                    'xy': (152, 266),
-                    'probability': 50
-                },
-                {
-                    'file': 'day/blocks/block-B-day.gif',
-                    'xy': (334, 191)
-                },
-                {
-                    'file': 'day/misc/cleat-x-day.gif',
-                    'xy': (518, 285)
-                },
-                {
-                    'file': ('day/characters/robogroup/'
-                             'robogroup-barge-empty-xm-day.gif'),
-                    'xy': (574, 222),
-                    'probability': 50,
-                    'not_condition': self._weather.is_rainy
-                },
-                {
-                    'file': ('day/characters/robogroup/'
-                             'robogroup-barge-empty-xm-day-rain.gif'),
-                    'xy': (574, 218),
-                    'probability': 50,
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/blocks/bldg-jetty-day.gif',
-                    'xy': (516, 230)
-                },
-                {
-                    'file': 'day/misc/streetlight-yp-day.gif',
-                    'xy': (528, 255)
-                },
-                {
-                    'file': 'day/environment/fog3-day.gif',
-                    'xy': (-640, -384),
-                    'condition': self._weather.is_foggy
-                },
-                {
-                    'file': 'day/blocks/park-day.gif',
-                    'xy': (379, 252)
-                },
-                {
-                    'file': 'day/characters/dogcouple-day.gif',
-                    'xy': (509, 312),
-                    'probability': 50
-                },
-                {
-                    'file': 'day/characters/girl/girlwbird-day.gif',
-                    'xy': (400, 315),
-                    'probability': 50,
-                    'not_condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/characters/girl/girlwbird-day-rain.gif',
-                    'xy': (404, 303),
-                    'probability': 50,
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/misc/streetlight-ym-day.gif',
-                    'xy': (294, 218)
-                },
-                {
-                    'file': 'day/blocks/block-C-day.gif',
-                    'xy': (216, 197)
-                },
-                {
-                    'file': 'day/misc/cleat-y-day.gif',
-                    'xy': (400, 346)
-                },
-                {
-                    'file': 'day/characters/vrguys/vrguy-A-day.gif',
-                    'xy': (217, 298),
-                    'probability': 50,
-                    'not_condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/characters/vrguys/vrguy-A-day-rain.gif',
-                    'xy': (203, 276),
-                    'probability': 50,
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/characters/vrguys/vrguy-B-day.gif',
-                    'xy': (240, 305),
-                    'probability': 50,
-                    'not_condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/characters/vrguys/vrguy-B-day-rain.gif',
-                    'xy': (234, 293),
-                    'probability': 50,
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/blocks/bldg-honeybucket-day.gif',
-                    'xy': (146, 291)
-                },
-                {
-                    'file': 'day/misc/memorial-minicyclops-day.gif',
-                    'xy': (40, 291)
-                },
-                {
-                    'file': 'day/misc/cleat-y-day.gif',
-                    'xy': (10, 309)
-                },
-                {
-                    'file': 'day/misc/cleat-y-day.gif',
-                    'xy': (26, 317)
-                },
-                {
-                    'file': 'day/misc/memorial-cyclops-day.gif',
-                    'xy': (62, 289)
-                },
-                {
-                    'file': 'day/characters/penguin1-day.gif',
-                    'xy': (289, 370),
-                    'probability': 50
-                },
-                {
-                    'file': 'day/characters/penguin2-day.gif',
-                    'xy': (261, 352)
-                },
-                {
-                    'file': 'day/vehicles/yacht2-xm-day.gif',
-                    'xy': (544, 302),
-                    'probability': 50
-                },
-                {
-                    'file': 'day/vehicles/yacht1-xm-day.gif',
-                    'xy': (506, 334),
-                    'probability': 50
-                },
-                {
-                    'file': 'day/vehicles/houseboat/houseboat-day.gif',
-                    'xy': (163, 326),
-                    'probability': 50
-                },
-                {
-                    'file': 'day/misc/streetlight-xp-day.gif',
-                    'xy': (216, 322)
-                },
-                {
-                    'file': 'day/environment/fog4-day.gif',
-                    'xy': (-640, -384),
-                    'condition': self._weather.is_foggy
-                },
-                {
-                    'file': 'day/environment/sun-day.gif',
-                    'xy': (19, 17),
-                    'not_condition': self._weather.is_foggy
-                },
-                {
-                    'file': 'day/environment/sun-fog-day.gif',
-                    'xy': (19, 17),
-                    'condition': self._weather.is_foggy
-                },
-                {
-                    'file': 'day/environment/rain1-day.gif',
-                    'xy': (-640, -384),
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'day/environment/snow1-day.gif',
-                    'xy': (-640, -384),
-                    'condition': self._weather.is_snowy
-                },
-                {
-                    'file': 'day/environment/cloud1-day.gif',
-                    'xy': (523, 5),
-                    'or_condition': [self._weather.is_partly_cloudy,
-                                     self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'day/environment/cloud2-day.gif',
-                    'xy': (-43, 41),
-                    'or_condition': [self._weather.is_partly_cloudy,
-                                     self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'day/environment/cloud2-day.gif',
-                    'xy': (519, 177),
-                    'or_condition': [self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'day/environment/cloud3-day.gif',
-                    'xy': (49, 96),
-                    'or_condition': [self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'day/environment/cloud4-day.gif',
-                    'xy': (195, 156),
-                    'or_condition': [self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'day/environment/cloud5-day.gif',
-                    'xy': (339, 70),
-                    'or_condition': [self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'day/environment/cloud6-day.gif',
-                    'xy': (93, 264),
-                    'or_condition': [self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'day/environment/cloud7-day.gif',
-                    'xy': (472, 247),
-                    'or_condition': [self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'day/environment/cloud8-day.gif',
-                    'xy': (-18, 314),
-                    'or_condition': [self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                }
-            ]
-        }, {
-            'not_condition': self._sun.is_daylight,
-            'layers': [
-                {
-                    'file': 'night/environment/water-night.gif',
-                    'xy': (-640, -384),
-                    'or_condition': [self._weather.is_clear,
-                                     self._weather.is_partly_cloudy,
-                                     self._weather.is_cloudy,
-                                     self._weather.is_foggy]
-                },
-                {
-                    'file': 'night/environment/water-flat-night.gif',
-                    'xy': (-640, -384),
-                    'or_condition': [self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'night/environment/isle-night.gif',
-                    'xy': (-4, 24)
-                },
-                {
-                    'file': 'night/blocks/bldg-facstdo-night.gif',
-                    'xy': (262, 9)
-                },
-                {
-                    'file': 'night/misc/lightpole-night.gif',
-                    'xy': (130, 5)
-                },
-                {
-                    'file': 'night/blocks/bldg-verylittlegravitas-night.gif',
-                    'xy': (188, 18)
-                },
-                {
-                    'file': 'night/blocks/block-D-night.gif',
-                    'xy': (74, 59)
-                },
-                {
-                    'file': 'night/vehicles/van2-247-yp-night.gif',
-                    'xy': (142, 116),
-                    'probability': 50
-                },
-                {
-                    'file': 'night/misc/streetlight-xp-night.gif',
-                    'xy': (314, 11)
-                },
-                {
-                    'file': 'night/blocks/block-F-night.gif',
-                    'xy': (418, 6)
-                },
-                {
-                    'file': 'night/blocks/bldg-home-night.gif',
-                    'xy': (422, 36)
-                },
-                {
-                    'file': 'night/vehicles/boat3-yp-night.gif',
-                    'xy': (590, 87),
-                    'probability': 80
-                },
-                {
-                    'file': ('night/characters/blockbob/'
-                             'blockbob-driving-xp-night.gif'),
-                    'xy': (418, 109),
-                    'probability': 50,
-                    'not_condition': self._weather.is_rainy
-                },
-                {
-                    'file': ('night/characters/blockbob/'
-                             'blockbob-driving-xp-night-rain.gif'),
-                    'xy': (418, 93),
-                    'probability': 50,
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'night/environment/fog1-night.gif',
-                    'xy': (-640, -384),
-                    'condition': self._weather.is_foggy
-                },
-                {
-                    'file': 'night/blocks/bldg-robosuper-night.gif',
-                    'xy': (540, 116)
-                },
-                {
-                    'file': 'night/characters/dogcouple-night.gif',
-                    'xy': (578, 175)
-                },
-                {
-                    'file': 'night/vehicles/car3-yp-night.gif',
-                    'xy': (532, 186),
-                    'probability': 50
-                },
-                {
-                    'file': 'night/blocks/block-A/block-A-night.gif',
-                    'xy': (200, 6),
-                    'not_condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'night/blocks/block-A/block-A-night-rain.gif',
-                    'xy': (200, 6),
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': ('night/characters/blockbob/'
-                             'blockbob-sitting-night.gif'),
-                    'xy': (276, 78),
-                    'else_condition': [
-                        ('night/characters/blockbob/'
-                         'blockbob-driving-xp-night.gif'),
-                        ('night/characters/blockbob/'
-                         'blockbob-driving-xp-night-rain.gif')
-                    ]
-                },
-                {
-                    'file': ('night/misc/computersays/'
-                             'billboard-computer-no-night.gif'),
-                    'xy': (386, 51),
-                    'probability': 50
-                },
-                {
-                    'file': ('night/misc/computersays/'
-                             'billboard-computer-yes-night.gif'),
-                    'xy': (386, 51),
-                    'else_condition': [
-                        ('night/misc/computersays/'
-                         'billboard-computer-no-night.gif')
-                    ]
-                },
-                {
-                    'file': 'night/misc/3letterLED/3letterLED-UFO-night.gif',
-                    'xy': (354, 125),
-                    'condition': self._modulo_3_0
-                },
-                {
-                    'file': 'night/misc/3letterLED/3letterLED-LOL-night.gif',
-                    'xy': (354, 125),
-                    'condition': self._modulo_3_1
-                },
-                {
-                    'file': 'night/misc/3letterLED/3letterLED-404-night.gif',
-                    'xy': (354, 125),
-                    'condition': self._modulo_3_2
-                },
-                {
-                    'file': 'night/misc/streetlight-yp-night.gif',
-                    'xy': (168, 125)
-                },
-                {
-                    'file': 'night/misc/streetlight-xm-night.gif',
-                    'xy': (596, 164)
-                },
-                {
-                    'file': 'night/misc/streetlight-yp-night.gif',
-                    'xy': (516, 119)
-                },
-                {
-                    'file': 'night/environment/fog2-night.gif',
-                    'xy': (-640, -384),
-                    'condition': self._weather.is_foggy
-                },
-                {
-                    'file': 'night/blocks/block-E-night.gif',
-                    'xy': (12, 51)
-                },
-                {
-                    'file': 'night/vehicles/boat1-yp-night.gif',
-                    'xy': (6, 238),
-                    'probability': 80,
-                    'not_condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'night/vehicles/boat1-yp-night-rain.gif',
-                    'xy': (6, 216),
-                    'probability': 80,
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'night/misc/bench-night.gif',
-                    'xy': (48, 245)
-                },
-                {
-                    'file': 'night/vehicles/boat2-ym-night.gif',
-                    'xy': (12, 261),
-                    'probability': 80
-                },
-                {
-                    'file': 'night/misc/streetlight-ym-night.gif',
-                    'xy': (38, 224)
-                },
-                {
-                    'file': 'night/vehicles/van1-yp-night.gif',
-                    'xy': (400, 164),
-                    'probability': 50
-                },
-                {
-                    'file': 'night/vehicles/van2-milk-yp-night.gif',
-                    'xy': (440, 158),
-                    'probability': 50
-                },
-                {
-                    'file': 'night/vehicles/van2-yp-night.gif',
-                    'xy': (374, 184),
-                    'probability': 50
-                },
-                {
-                    'file': 'night/vehicles/car2-xp-night.gif',
-                    'xy': (236, 213),
-                    'probability': 50
-                },
-                {
-                    'file': 'night/vehicles/car1-yp-night.gif',
-                    'xy': (138, 266),
-                    'probability': 50
-                },
-                {
-                    'file': 'night/blocks/block-B-night.gif',
-                    'xy': (334, 191)
-                },
-                {
-                    'file': 'night/misc/cleat-x-night.gif',
-                    'xy': (518, 285)
-                },
-                {
-                    'file': ('night/characters/robogroup/'
-                             'robogroup-barge-xm-night.gif'),
-                    'xy': (574, 222),
-                    'probability': 50
-                },
-                {
-                    'file': 'night/blocks/bldg-jetty-night.gif',
-                    'xy': (516, 230)
-                },
-                {
-                    'file': 'night/misc/streetlight-yp-night.gif',
-                    'xy': (528, 255)
-                },
-                {
-                    'file': 'night/environment/fog3-night.gif',
-                    'xy': (-640, -384),
-                    'condition': self._weather.is_foggy
-                },
-                {
-                    'file': 'night/blocks/park-night.gif',
-                    'xy': (379, 252)
-                },
-                {
-                    'file': 'night/misc/streetlight-ym-night.gif',
-                    'xy': (294, 218)
-                },
-                {
-                    'file': 'night/blocks/block-C-night.gif',
-                    'xy': (216, 197)
-                },
-                {
-                    'file': 'night/misc/cleat-y-night.gif',
-                    'xy': (400, 346)
-                },
-                {
-                    'file': 'night/blocks/bldg-honeybucket-night.gif',
-                    'xy': (146, 291)
-                },
-                {
-                    'file': 'night/misc/memorial-minicyclops-night.gif',
-                    'xy': (40, 291)
-                },
-                {
-                    'file': 'night/misc/cleat-y-night.gif',
-                    'xy': (10, 309)
-                },
-                {
-                    'file': 'night/misc/cleat-y-night.gif',
-                    'xy': (26, 317)
-                },
-                {
-                    'file': 'night/misc/memorial-cyclops-night.gif',
-                    'xy': (62, 289)
-                },
-                {
-                    'file': 'night/characters/penguin1-night.gif',
-                    'xy': (289, 370),
-                    'probability': 50
-                },
-                {
-                    'file': 'night/characters/penguin2-night.gif',
-                    'xy': (261, 352)
-                },
-                {
-                    'file': 'night/vehicles/yacht2-xm-night.gif',
-                    'xy': (544, 302),
-                    'probability': 80
-                },
-                {
-                    'file': 'night/vehicles/yacht1-xm-night.gif',
-                    'xy': (506, 334),
-                    'probability': 80
-                },
-                {
-                    'file': 'night/vehicles/houseboat/houseboat-night.gif',
-                    'xy': (163, 326),
-                    'probability': 80
-                },
-                {
-                    'file': 'night/misc/streetlight-xp-night.gif',
-                    'xy': (216, 322)
-                },
-                {
-                    'file': 'night/environment/fog4-night.gif',
-                    'xy': (-640, -384),
-                    'condition': self._weather.is_foggy
-                },
-                {
-                    'file': 'night/environment/moon-night.gif',
-                    'xy': (19, 17),
-                    'not_condition': self._weather.is_foggy
-                },
-                {
-                    'file': 'night/environment/moon-fog-night.gif',
-                    'xy': (19, 17),
-                    'condition': self._weather.is_foggy
-                },
-                {
-                    'file': 'night/environment/rain1-night.gif',
-                    'xy': (-640, -384),
-                    'condition': self._weather.is_rainy
-                },
-                {
-                    'file': 'night/environment/snow1-night.gif',
-                    'xy': (-640, -384),
-                    'condition': self._weather.is_snowy
-                },
-                {
-                    'file': 'night/environment/cloud1-night.gif',
-                    'xy': (523, 5),
-                    'or_condition': [self._weather.is_partly_cloudy,
-                                     self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'night/environment/cloud2-night.gif',
-                    'xy': (-43, 41),
-                    'or_condition': [self._weather.is_partly_cloudy,
-                                     self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'night/environment/cloud2-night.gif',
-                    'xy': (519, 177),
-                    'or_condition': [self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'night/environment/cloud3-night.gif',
-                    'xy': (49, 96),
-                    'or_condition': [self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'night/environment/cloud4-night.gif',
-                    'xy': (195, 156),
-                    'or_condition': [self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'night/environment/cloud5-night.gif',
-                    'xy': (339, 70),
-                    'or_condition': [self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'night/environment/cloud6-night.gif',
-                    'xy': (93, 264),
-                    'or_condition': [self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'night/environment/cloud7-night.gif',
-                    'xy': (472, 247),
-                    'or_condition': [self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                },
-                {
-                    'file': 'night/environment/cloud8-night.gif',
-                    'xy': (-18, 314),
-                    'or_condition': [self._weather.is_cloudy,
-                                     self._weather.is_rainy,
-                                     self._weather.is_snowy]
-                }
-            ]
-        }]
-
-    def _draw_layers(self, image, layers, user, width, height):
-        """Draws a list of layers onto an image."""
-
-        # Keep track of drawn layers.
-        drawn_files = []
-
-        # Draw the layers in order.
-        for layer in layers:
-            try:
-                # Simple condition has to be true.
-                if not layer['condition'](user):
-                    continue
-            except KeyError:
-                pass
-
-            try:
-                # Negated condition has to be false.
-                if layer['not_condition'](user):
-                    continue
-            except KeyError:
-                pass
-
-            try:
-                # All and-conditions have to be true.
-                if not all([c(user) for c in layer['and_condition']]):
-                    continue
-            except KeyError:
-                pass
-
-            try:
-                # One or-condition has to be true.
-                if not any([c(user) for c in layer['or_condition']]):
-                    continue
-            except KeyError:
-                pass
-
-            try:
-                # Else layers have to not have been drawn.
-                if not set(layer['else_condition']).isdisjoint(drawn_files):
-                    continue
-            except KeyError:
-                pass
-
-            try:
-                # Evaluate a random probability.
-                if layer['probability'] <= 100 * random():
-                    continue
-            except KeyError:
-                pass
-
-            # Recursively draw groups of layers.
-            try:
-                self._draw_layers(image, layer['layers'], user, width, height)
-                continue  # Don't try to draw layer groups.
-            except KeyError:
-                pass
+        statuses = []
+        plate = []
+        overlay = []
+        overlay_sprites = []
+        pending_layers = []
+        pending_sprites = []
+        for index, (file, x, y, required, forbidden, any_masks, unless_drawn,
+                    probability) in enumerate(self._program):
+            # Resolve the predicates and any else conditions referring to
+            # layers which are either always or never drawn.
+            if (state & required != required or state & forbidden or
+                    not all(state & mask for mask in any_masks) or
+                    any(statuses[i] == ALWAYS_DRAWN for i in unless_drawn)):
+                statuses.append(NEVER_DRAWN)
+                continue
+            if probability is None and all(
+                    statuses[i] == NEVER_DRAWN for i in unless_drawn):
+                status = ALWAYS_DRAWN
+            else:
+                status = MAYBE_DRAWN
+            statuses.append(status)
+
+            layer_sprite = assets.sprite(file)
+            sprite = ((x, y, x + layer_sprite.width, y + layer_sprite.height),
+                      layer_sprite.mask)
+
+            if status == ALWAYS_DRAWN:
+                # Draw the layer as part of the base plate, unless it covers a
+                # layer drawn on top of the base plate. Then group it with the
+                # other layers in the same situation.
+                if _overlaps(sprite, overlay_sprites):
+                    pending_layers.append((file, x, y))
+                    pending_sprites.append(sprite)
+                    overlay_sprites.append(sprite)
+                else:
+                    plate.append((file, x, y))
+                continue
+
+            # Draw the pending group first if this layer covers it.
+            if _overlaps(sprite, pending_sprites):
+                overlay.append((None, pending_layers, (), None))
+                pending_layers = []
+                pending_sprites = []
+            overlay.append((index, [(file, x, y)], unless_drawn, probability))
+            overlay_sprites.append(sprite)
+
+        if pending_layers:
+            overlay.append((None, pending_layers, (), None))
+
+        return plate, overlay
+
+    @cached(cache=LRUCache(maxsize=MAX_SCENE_BYTES, getsizeof=_scene_bytes))
+    def _scene(self, state, width, height, variant):
+        """Composites the base plate and the grouped sprites for a predicate
+        state, display size, and display variant.
+        """
 
-            # Get the coordinates, optionally transforming them first.
-            try:
-                x, y = layer['xy_transform'](layer['xy_data'])
-            except KeyError:
-                x, y = layer['xy']
+        plate, overlay = self._layout(state)
+
+        # Adjust the coordinates to be centered on the display.
+        dx, dy = adjust_xy(0, 0, width, height)
+
+        canvas = assets.new_canvas(width, height)
+        for file, x, y in plate:
+            blit(canvas, assets.sprite(file), (x + dx, y + dy))
+
+        sprites = []
+        for index, layers, unless_drawn, probability in overlay:
+            layers = [(file, x + dx, y + dy) for file, x, y in layers]
+            if index is None:
+                composite = _composite(layers, width, height)
+                if composite:
+                    sprites.append((index,) + composite +
+                                   (unless_drawn, probability))
+            else:
+                (file, x, y), = layers
+                sprites.append((index, (x, y), assets.sprite(file),
+                                unless_drawn, probability))
+
+        # Map the assets' palette to the display's palette once, so that the
+        # images don't need to be quantized.
+        remap = array(epd_indices(assets.palette(), variant), dtype=uint8)
+        canvas = remap[canvas]
+        sprites = [(index, xy, Sprite(remap[sprite.indices], sprite.mask),
+                    unless_drawn, probability)
+                   for index, xy, sprite, unless_drawn, probability in sprites]
+
+        return canvas, sprites
+
+    def fingerprint(self, user, width, height, variant):
+        """Summarizes the date, weather, and daylight that select the layers.
+        Random layers stay the same while the frame is cached.
+        """
 
-            # Adjust the coordinates to be centered on the display.
-            x, y = adjust_xy(x, y, width, height)
+        try:
+            return (self._local_time.now(user).date(),
+                    self._weather.icon(user),
+                    self._sun.is_daylight(user))
+        except DataError as e:
+            raise ContentError(e)
 
-            # Draw the layer.
-            path = path_join(ASSETS_DIR, layer['file'])
-            bitmap = Image.open(path).convert('RGBA')
-            image.paste(bitmap, (x, y), bitmap)
+    def frame_ttl(self, fingerprint):
+        """Returns the time to live in seconds for cached city frames."""
 
-            # Remember the drawn file for the else condition.
-            drawn_files.append(layer['file'])
+        return FRAME_TTL_S
 
     def image(self, user, width, height, variant):
         """Generates the current city image."""
 
-        image = Image.new(mode='RGB', size=(width, height))
         try:
-            self._draw_layers(image, self._layers(), user, width, height)
+            state = self._state(user)
         except DataError as e:
             raise ContentError(e)
 
-        # The city image is already quantized (no dithering).
-        image = image.convert('P', dither=None, palette=Image.ADAPTIVE)
-
-        return image
+        # Start with a copy of the cached base plate and draw the sprites on
+        # top, keeping track of the drawn layers for else conditions.
+        plate, sprites = self._scene(state, width, height, variant)
+        canvas = plate.copy()
+        drawn = set()
+        for index, xy, sprite, unless_drawn, probability in sprites:
+            if any(i in drawn for i in unless_drawn):
+                continue
+            if probability is not None and probability <= 100 * random():
+                continue
+
+            blit(canvas, sprite, xy)
+            drawn.add(index)
+
+        return epd_image(canvas, variant)
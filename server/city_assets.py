@@ -0,0 +1,192 @@
+# To rebuild the bundle of decoded city assets after changing any of them, run:
+# $ python city_assets.py
+
+from glob import glob
+from hashlib import blake2b
+from logging import info
+from logging import warning
+from numpy import append
+from numpy import array
+from numpy import concatenate
+from numpy import cumsum
+from numpy import int64
+from numpy import load
+from numpy import packbits
+from numpy import savez_compressed
+from numpy import searchsorted
+from numpy import uint8
+from numpy import unique
+from numpy import unpackbits
+from os.path import join as path_join
+from os.path import relpath
+from PIL import Image
+
+from compositing import color_keys
+from compositing import key_colors
+from compositing import new_canvas
+from compositing import Sprite
+
+# The directory containing city image assets.
+ASSETS_DIR = 'assets/city'
+
+# The file extension of all city image assets.
+ASSET_EXTENSION = 'gif'
+
+# The prebuilt bundle of decoded city assets.
+BUNDLE_FILE = 'assets/city.npz'
+
+# The background color of city images.
+BACKGROUND_COLOR = (0, 0, 0)
+
+
+def _asset_paths():
+    """Lists the paths of all city image assets in a stable order."""
+
+    pattern = path_join(ASSETS_DIR, '**', '*.%s' % ASSET_EXTENSION)
+    return sorted(glob(pattern, recursive=True))
+
+
+def _digest(paths):
+    """Hashes the names and contents of the asset files."""
+
+    digest = blake2b()
+    for path in paths:
+        digest.update(relpath(path, ASSETS_DIR).encode())
+        with open(path, 'rb') as asset_file:
+            digest.update(asset_file.read())
+
+    return digest.hexdigest()
+
+
+def _decode(paths):
+    """Decodes the asset files into the arrays stored in the bundle."""
+
+    bitmaps = [array(Image.open(path).convert('RGBA')) for path in paths]
+    keys = [color_keys(bitmap) for bitmap in bitmaps]
+
+    # Collect the opaque colors of all assets into one shared palette.
+    opaque_keys = [unique(k[b[..., 3] > 0]) for k, b in zip(keys, bitmaps)]
+    opaque_keys.append(color_keys(array([BACKGROUND_COLOR], dtype=uint8)))
+    palette_keys = unique(concatenate(opaque_keys))
+    palette = key_colors(palette_keys)
+
+    # Map each pixel to its palette index and pack the binary alpha into
+    # bits, padding each row to a full byte.
+    indices = []
+    masks = []
+    for bitmap, bitmap_keys in zip(bitmaps, keys):
+        opaque = bitmap[..., 3] > 0
+        bitmap_indices = searchsorted(palette_keys, bitmap_keys)
+        bitmap_indices[~opaque] = 0
+        indices.append(bitmap_indices.astype(uint8).reshape(-1))
+        masks.append(packbits(opaque, axis=1).reshape(-1))
+
+    return {
+        'digest': array(_digest(paths)),
+        'files': array([relpath(path, ASSETS_DIR) for path in paths]),
+        'sizes': array([bitmap.shape[1::-1] for bitmap in bitmaps]),
+        'palette': palette,
+        'index_offsets': append(0, cumsum([len(i) for i in indices],
+                                          dtype=int64)),
+        'indices': concatenate(indices),
+        'mask_offsets': append(0, cumsum([len(m) for m in masks],
+                                         dtype=int64)),
+        'masks': concatenate(masks)}
+
+
+def _load_bundle(bundle_file, paths):
+    """Loads the decoded assets from the bundle unless it's missing or doesn't
+    match the asset files.
+    """
+
+    try:
+        with load(bundle_file) as bundle:
+            arrays = dict(bundle)
+    except FileNotFoundError:
+        warning('Missing city asset bundle: %s' % bundle_file)
+        return None
+
+    if arrays['digest'] != _digest(paths):
+        warning('Outdated city asset bundle: %s' % bundle_file)
+        return None
+
+    return arrays
+
+
+class CityAssets(object):
+    """The city image assets, decoded once into indices into a shared palette
+    and 1-bit alpha masks. They are loaded from a prebuilt bundle unless it's
+    missing or outdated. Each kind of data is stored in one contiguous array.
+    The bundle is compressed, so it's decompressed into each worker's own
+    memory on first use rather than shared between workers.
+    """
+
+    def __init__(self, bundle_file=BUNDLE_FILE):
+        # Decode the asset files if there is no usable bundle.
+        paths = _asset_paths()
+        arrays = None
+        if bundle_file:
+            arrays = _load_bundle(bundle_file, paths)
+        if arrays is None:
+            arrays = _decode(paths)
+
+        self._arrays = arrays
+        self._files = {file: index for index, file in
+                       enumerate(self._arrays['files'])}
+        self._sizes = self._arrays['sizes'].tolist()
+        self._index_offsets = self._arrays['index_offsets'].tolist()
+        self._mask_offsets = self._arrays['mask_offsets'].tolist()
+        self._indices = self._arrays['indices']
+        self._masks = self._arrays['masks']
+
+        # Use the palette index of the background for new canvases.
+        palette = self._arrays['palette']
+        self._palette = [tuple(color) for color in palette.tolist()]
+        self._background = int(searchsorted(
+            color_keys(palette),
+            color_keys(array(BACKGROUND_COLOR, dtype=uint8))))
+
+        info('Loaded %d city assets' % len(self._files))
+
+    def files(self):
+        """Lists the asset files relative to the assets directory."""
+
+        return list(self._files)
+
+    def new_canvas(self, width, height):
+        """Creates a blank canvas of indices into the assets' palette."""
+
+        return new_canvas(width, height, self._background)
+
+    def palette(self):
+        """Returns the RGB colors of the assets' palette."""
+
+        return self._palette
+
+    def sprite(self, file):
+        """Returns the sprite of an asset. Its indices wrap the decoded array
+        without copying, while the mask is unpacked.
+        """
+
+        index = self._files[file]
+        width, height = self._sizes[index]
+        indices = self._indices[self._index_offsets[index]:
+                                self._index_offsets[index + 1]]
+        mask = self._masks[self._mask_offsets[index]:
+                           self._mask_offsets[index + 1]]
+
+        # Drop the padding at the end of each mask row.
+        mask = unpackbits(mask.reshape(height, -1), axis=1,
+                          count=width).view(bool)
+
+        return Sprite(indices.reshape(height, width), mask)
+
+    def save(self, bundle_file=BUNDLE_FILE):
+        """Writes the decoded assets to a bundle file."""
+
+        savez_compressed(bundle_file, **self._arrays)
+
+
+if __name__ == '__main__':
+    assets = CityAssets(bundle_file=None)
+    assets.save()
@@ -1,5 +1,5 @@
 # To generate client code for static images, run:
-# $ pip install absl-py
+# $ pip install absl-py scipy
 # $ python client_image.py --input=assets/client/error.gif
 
 from absl import app
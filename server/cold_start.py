@@ -0,0 +1,87 @@
+# To measure the time from a cold start to the first served image, start the
+# Firestore emulator and run:
+# $ gcloud emulators firestore start --host-port=localhost:8080
+# $ FIRESTORE_EMULATOR_HOST=localhost:8080 GOOGLE_CLOUD_PROJECT=accent-local \
+#   python cold_start.py
+
+from os import environ
+from subprocess import run
+from sys import argv
+from sys import executable
+from time import perf_counter
+
+# The key of the user created in the emulator.
+USER_KEY = 'C0LDSTART000'
+
+# The home address of the user, resolved locally to stay offline.
+HOME = 'San Francisco, CA'
+
+# The astral location info of the home address.
+HOME_LOCATION = ('San Francisco', 'USA', 37.7749, -122.4194,
+                 'America/Los_Angeles', 16)
+
+
+def _seed(db):
+    """Writes the configuration and a user showing artwork to the
+    emulator.
+    """
+
+    db.collection('api_keys').document('google_maps').set(
+        {'api_key': 'local'})
+    db.collection('api_keys').document('open_weather').set(
+        {'api_key': 'local'})
+    db.collection('oauth_clients').document('google_calendar').set(
+        {'client_id': 'local', 'client_secret': 'local'})
+    db.collection('users').document(USER_KEY).set({
+        'home': HOME,
+        'schedule': [{'name': 'Artwork', 'start': '0 0 * * *',
+                      'image': 'artwork'}]})
+
+
+def _measure():
+    """Times importing the app and serving the first image in a fresh
+    process.
+    """
+
+    start = perf_counter()
+    import main
+    import_time = perf_counter() - start
+
+    from astral import Location
+    from cachetools.keys import hashkey
+
+    # Resolve the home address without the Geocoding API.
+    main.Geocoder.__getitem__.cache[hashkey(main.geocoder, HOME)] = Location(
+        HOME_LOCATION)
+
+    client = main.app.test_client()
+    start = perf_counter()
+    response = client.get('/epd?key=%s' % USER_KEY)
+    request_time = perf_counter() - start
+    if response.status_code != 200:
+        raise ValueError('Failed request: %d' % response.status_code)
+
+    print('Import: %.3f ms' % (import_time * 1000))
+    print('First /epd: %.3f ms' % (request_time * 1000))
+    print('Total: %.3f ms' % ((import_time + request_time) * 1000))
+
+
+def _benchmark():
+    """Seeds the emulator and measures a cold start in a separate process, so
+    that seeding doesn't warm up any imports.
+    """
+
+    if 'FIRESTORE_EMULATOR_HOST' not in environ:
+        raise ValueError('Missing FIRESTORE_EMULATOR_HOST')
+
+    from firestore import Firestore
+    _seed(Firestore()._db)
+
+    run([executable, __file__, 'measure'], check=True)
+
+
+if __name__ == '__main__':
+    if argv[1:] == ['measure']:
+        _measure()
+    else:
+        _benchmark()
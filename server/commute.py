@@ -22,6 +22,10 @@ DIRECTIONS_BORDER_WIDTH = 3
 # The padding of the box around the directions text.
 DIRECTIONS_BOX_PADDING = 8
 
+# The time to live in seconds for cached frames, which bounds how outdated
+# the traffic can be.
+FRAME_TTL_S = 5 * 60  # 5 minutes
+
 
 class Commute(ImageContent):
     """The commute route on a map."""
@@ -29,6 +33,22 @@ class Commute(ImageContent):
     def __init__(self, geocoder):
         self._google_maps = GoogleMaps(geocoder)
 
+    def fingerprint(self, user, width, height, variant):
+        """Summarizes the route request, leaving traffic to the time to
+        live.
+        """
+
+        try:
+            return (user.get('home'), user.get('work'),
+                    user.get('travel_mode'))
+        except KeyError as e:
+            raise ContentError(e)
+
+    def frame_ttl(self, fingerprint):
+        """Returns the time to live in seconds for cached commute frames."""
+
+        return FRAME_TTL_S
+
     def image(self, user, width, height, variant):
         """Generates the current commute image."""
 
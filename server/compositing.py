@@ -0,0 +1,176 @@
+# To compare the performance of drawing sprites with PIL and NumPy, run:
+# $ python compositing.py
+
+from numpy import array
+from numpy import bitwise_xor
+from numpy import copyto
+from numpy import full
+from numpy import multiply
+from numpy import stack
+from numpy import uint8
+from numpy import uint32
+from PIL import Image
+
+# The display size used for the benchmark.
+BENCHMARK_SIZE = (800, 480)
+
+# The number of repetitions in the benchmark.
+BENCHMARK_REPETITIONS = 1000
+
+
+class Sprite(object):
+    """An image with binary transparency, held as a NumPy array of palette
+    indices and a boolean mask of the opaque pixels. The indices may be None
+    for sprites only used with stencil().
+    """
+
+    def __init__(self, indices, mask):
+        self.indices = indices
+        self.mask = mask
+
+    @property
+    def width(self):
+        """The width of the sprite in pixels."""
+
+        return self.mask.shape[1]
+
+    @property
+    def height(self):
+        """The height of the sprite in pixels."""
+
+        return self.mask.shape[0]
+
+
+def load_sprite(file, palette):
+    """Loads an image file with binary transparency as a sprite, mapping its
+    opaque colors to their indices in the palette, a list of RGB tuples.
+    """
+
+    bitmap = array(Image.open(file).convert('RGBA'))
+    mask = bitmap[..., 3] > 0
+
+    indices = full(mask.shape, 0, dtype=uint8)
+    for color in {tuple(color) for color in bitmap[mask][:, :3].tolist()}:
+        try:
+            index = palette.index(color)
+        except ValueError:
+            raise ValueError('Unsupported sprite color: %s' % (color,))
+        indices[mask & (bitmap[..., :3] == color).all(axis=-1)] = index
+
+    return Sprite(indices, mask)
+
+
+def color_keys(colors):
+    """Combines the RGB channels of each color into one sortable integer."""
+
+    colors = colors.astype(uint32)
+    return (colors[..., 0] << 16) | (colors[..., 1] << 8) | colors[..., 2]
+
+
+def key_colors(keys):
+    """Splits the integers from color_keys() back into RGB channels."""
+
+    return stack([keys >> 16, keys >> 8, keys], axis=-1).astype(uint8)
+
+
+def new_canvas(width, height, index):
+    """Creates a canvas of palette indices filled with one index."""
+
+    return full((height, width), index, dtype=uint8)
+
+
+def _clip(canvas, xy, width, height):
+    """Clips a rectangle to the canvas. Returns the slices of the visible part
+    in the canvas and in the rectangle, or None if it's not visible.
+    """
+
+    x, y = xy
+    canvas_height, canvas_width = canvas.shape
+    left = max(x, 0)
+    top = max(y, 0)
+    right = min(x + width, canvas_width)
+    bottom = min(y + height, canvas_height)
+    if left >= right or top >= bottom:
+        return None
+
+    return ((slice(top, bottom), slice(left, right)),
+            (slice(top - y, bottom - y), slice(left - x, right - x)))
+
+
+def blit(canvas, sprite, xy):
+    """Draws the opaque pixels of a sprite onto a canvas. The coordinates of
+    the sprite's top left corner may be outside of the canvas.
+    """
+
+    clipped = _clip(canvas, xy, sprite.width, sprite.height)
+    if not clipped:
+        return
+
+    # Replace the opaque pixels without branching on the mask, which is fast
+    # regardless of its pattern: XOR the canvas with its difference to the
+    # sprite, multiplied by the mask as zeros and ones.
+    canvas_slices, sprite_slices = clipped
+    region = canvas[canvas_slices]
+    difference = bitwise_xor(region, sprite.indices[sprite_slices])
+    multiply(difference, sprite.mask[sprite_slices].view(uint8),
+             out=difference)
+    bitwise_xor(region, difference, out=region)
+
+
+def stencil(canvas, sprite, xy, index):
+    """Fills the opaque pixels of a sprite on a canvas with one index."""
+
+    clipped = _clip(canvas, xy, sprite.width, sprite.height)
+    if not clipped:
+        return
+
+    canvas_slices, sprite_slices = clipped
+    copyto(canvas[canvas_slices], index, where=sprite.mask[sprite_slices])
+
+
+def _benchmark():
+    """Times drawing the city's sprites with PIL and NumPy."""
+
+    from random import randrange
+    from time import perf_counter
+
+    from city_assets import CityAssets
+
+    assets = CityAssets()
+    width, height = BENCHMARK_SIZE
+    # Place all sprites randomly, some partially outside of the canvas.
+    placements = []
+    for file in assets.files():
+        sprite = assets.sprite(file)
+        xy = (randrange(-sprite.width // 2, width - sprite.width // 2),
+              randrange(-sprite.height // 2, height - sprite.height // 2))
+        bitmap = Image.fromarray(sprite.indices, mode='P')
+        mask = Image.fromarray(sprite.mask)
+        placements.append((sprite, bitmap, mask, xy))
+
+    canvas = assets.new_canvas(width, height)
+    start = perf_counter()
+    for _ in range(BENCHMARK_REPETITIONS):
+        image = Image.fromarray(canvas, mode='P')
+        for _, bitmap, mask, xy in placements:
+            image.paste(bitmap, xy, mask)
+    pil_time = perf_counter() - start
+
+    start = perf_counter()
+    for _ in range(BENCHMARK_REPETITIONS):
+        numpy_canvas = canvas.copy()
+        for sprite, _, _, xy in placements:
+            blit(numpy_canvas, sprite, xy)
+    numpy_time = perf_counter() - start
+
+    # Make sure both draw the same pixels.
+    if array(image).tobytes() != numpy_canvas.tobytes():
+        raise ValueError('Mismatched compositing results')
+
+    print('Drew %d sprites at %dx%d' % (len(placements), width, height))
+    print('PIL: %.3f ms' % (pil_time * 1000 / BENCHMARK_REPETITIONS))
+    print('NumPy: %.3f ms' % (numpy_time * 1000 / BENCHMARK_REPETITIONS))
+
+
+if __name__ == '__main__':
+    _benchmark()
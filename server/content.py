@@ -1,11 +1,98 @@
+from importlib import import_module
+from logging import info
+from threading import Lock
+
+from epd import DEFAULT_DITHER
+
+# The default time to live in seconds for cached frames.
+FRAME_TTL_S = 60 * 60  # 1 hour
+
+# The module and class of the image content for each kind, and whether its
+# constructor takes the geocoder.
+CONTENT_CLASSES = {
+    'artwork': ('artwork', 'Artwork', False),
+    'calendar': ('google_calendar', 'GoogleCalendar', True),
+    'city': ('city', 'City', True),
+    'commute': ('commute', 'Commute', True),
+    'everyone': ('everyone', 'Everyone', True),
+    'wittgenstein': ('wittgenstein', 'Wittgenstein', False),
+}
+
+
 class ImageContent(object):
     """An abstract base class for image content."""
 
     def image(self, user, width, height, variant):
-        """Generates the current image for the specified user."""
+        """Generates the current image for the specified user's
+        RenderContext. Images that aren't quantized yet may request a
+        dithering mode in info['dither']. Images drawn with indices into the
+        display's palette can be wrapped with epd.epd_image() to skip
+        quantization.
+        """
 
         raise NotImplementedError('Missing image content')
 
+    def fingerprint(self, user, width, height, variant):
+        """Summarizes the inputs determining the current image in a hashable
+        value. Frames are only cached for content with a fingerprint.
+        """
+
+        return None
+
+    def frame_ttl(self, fingerprint):
+        """Returns the time to live in seconds for frames with the
+        fingerprint.
+        """
+
+        return FRAME_TTL_S
+
+    def dither_mode(self, fingerprint):
+        """Returns the dithering mode preferred for images with the
+        fingerprint, unless the request overrides it. It has to match the
+        mode the images request in info['dither'].
+        """
+
+        return DEFAULT_DITHER
+
+
+class ContentRegistry(object):
+    """The image content instances by kind. Each content module is imported
+    and its instance created on first use, so that starting the server and
+    requests for other content don't load its assets and libraries.
+    """
+
+    def __init__(self, geocoder):
+        self._geocoder = geocoder
+        self._contents = {}
+
+        # Lock each kind separately, so that loading one doesn't block
+        # requests for the others.
+        self._locks = {kind: Lock() for kind in CONTENT_CLASSES}
+
+    def get(self, kind):
+        """Returns the shared image content instance for the kind, or None if
+        the kind is unknown.
+        """
+
+        if kind not in CONTENT_CLASSES:
+            return None
+
+        content = self._contents.get(kind)
+        if content:
+            return content
+
+        with self._locks[kind]:
+            if kind not in self._contents:
+                module, name, uses_geocoder = CONTENT_CLASSES[kind]
+                content_class = getattr(import_module(module), name)
+                if uses_geocoder:
+                    self._contents[kind] = content_class(self._geocoder)
+                else:
+                    self._contents[kind] = content_class()
+                info('Loaded image content: %s' % kind)
+
+            return self._contents[kind]
+
 
 class ContentError(Exception):
     """An error indicating issues generating content."""
@@ -1,168 +1,537 @@
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
-#include <numpy/arrayobject.h>
 
 // Clamps a value to the range [0, 255].
 #define CLAMP(x) ((x) < 0 ? 0 : (x) > 255 ? 255 : (x))
 
+// The maximum distance in pixels that any kernel diffuses error horizontally.
+#define MAX_KERNEL_DX 2
+
+// The maximum distance in pixels that any kernel diffuses error vertically.
+#define MAX_KERNEL_DY 2
+
+// The maximum number of bytes in one PackBits run.
+#define MAX_PACK_BITS_RUN 128
+
+// The minimum number of identical bytes encoded as a PackBits repeat.
+#define MIN_PACK_BITS_REPEAT 3
+
+// Identifiers for the supported error diffusion kernels.
+enum { FLOYD_STEINBERG = 0, ATKINSON = 1, STUCKI = 2, NUM_KERNELS = 3 };
+
+// A share of the error diffused to the pixel at (`dx`, `dy`) relative to the
+// current pixel, in units of the kernel's divisor.
+typedef struct {
+  int8_t dx;
+  int8_t dy;
+  int16_t weight;
+} kernel_weight;
+
+// An error diffusion kernel made up of `num_weights` weights, which are divided
+// by `divisor`.
+typedef struct {
+  const kernel_weight *weights;
+  uint32_t num_weights;
+  int32_t divisor;
+} kernel;
+
+// Diffuses 16/16 of the error to 4 neighbors.
+static const kernel_weight kFloydSteinbergWeights[] = {
+    {1, 0, 7}, {-1, 1, 3}, {0, 1, 5}, {1, 1, 1}};
+
+// Diffuses 6/8 of the error to 6 neighbors, which is cheaper and keeps more
+// contrast.
+static const kernel_weight kAtkinsonWeights[] = {
+    {1, 0, 1}, {2, 0, 1}, {-1, 1, 1}, {0, 1, 1}, {1, 1, 1}, {0, 2, 1}};
+
+// Diffuses 42/42 of the error to 12 neighbors, which is smoother.
+static const kernel_weight kStuckiWeights[] = {
+    {1, 0, 8},  {2, 0, 4},  {-2, 1, 2}, {-1, 1, 4}, {0, 1, 8}, {1, 1, 4},
+    {2, 1, 2},  {-2, 2, 1}, {-1, 2, 2}, {0, 2, 4},  {1, 2, 2}, {2, 2, 1}};
+
+// The supported kernels, indexed by their identifiers.
+static const kernel kKernels[NUM_KERNELS] = {
+    {kFloydSteinbergWeights, 4, 16},
+    {kAtkinsonWeights, 6, 8},
+    {kStuckiWeights, 12, 42}};
+
 // Finds the closest matching color in the palette. `red`, `green`, and `blue`
 // define the input color. `palette` is an array of size `num_colors` containing
-// available RGB values. `closest_red`, `closest_green`, and `closest_blue`
-// define the output color.
-void find_closest(const uint8_t red, const uint8_t green, const uint8_t blue,
-                  const uint8_t *palette, const uint32_t num_colors,
-                  uint8_t *closest_red, uint8_t *closest_green,
-                  uint8_t *closest_blue) {
+// available RGB values. Returns the index of the closest palette color.
+uint32_t find_closest(const uint8_t red, const uint8_t green,
+                      const uint8_t blue, const uint8_t *palette,
+                      const uint32_t num_colors) {
   uint32_t min_distance = UINT32_MAX;
+  uint32_t closest = 0;
 
   // Compare to all colors in the palette and return the one with the shortest
   // Euclidean distance.
   for (uint32_t i = 0; i < num_colors; ++i) {
-    uint8_t palette_red = palette[i * 3];
-    uint8_t palette_green = palette[i * 3 + 1];
-    uint8_t palette_blue = palette[i * 3 + 2];
-
-    int32_t delta_red = (int32_t)red - palette_red;
-    int32_t delta_green = (int32_t)green - palette_green;
-    int32_t delta_blue = (int32_t)blue - palette_blue;
+    int32_t delta_red = (int32_t)red - palette[i * 3];
+    int32_t delta_green = (int32_t)green - palette[i * 3 + 1];
+    int32_t delta_blue = (int32_t)blue - palette[i * 3 + 2];
     uint32_t distance = delta_red * delta_red + delta_green * delta_green +
                         delta_blue * delta_blue;
 
     if (distance < min_distance) {
-      *closest_red = palette_red;
-      *closest_green = palette_green;
-      *closest_blue = palette_blue;
+      closest = i;
       min_distance = distance;
     }
   }
+
+  return closest;
 }
 
-// Runs the Floyd-Steinberg dithering algorithm on the image. `pixels` is an
-// array of size `width` * `height` * 3 containing RGB values in row-major
-// order. `palette` is an array of size `num_colors` containing available RGB
-// values. The pixels are modified in place.
-void floyd_steinberg(uint8_t *pixels, const uint32_t width,
-                     const uint32_t height, const uint8_t *palette,
-                     const uint32_t num_colors) {
+// Runs an error diffusion dithering algorithm on the image. `pixels` is an
+// array of size `width` * `height` * `channels` containing RGB values in
+// row-major order, followed by `channels` - 3 ignored values per pixel.
+// `palette` is an array of size `num_colors` containing available RGB values.
+// `kernel` defines how the error is diffused and `serpentine` alternates the
+// scanning direction between rows. `indices` is an array of size `width` *
+// `height` receiving the palette index of each pixel. `errors` is a scratch
+// array of size (`MAX_KERNEL_DY` + 1) * (`width` + 2 * `MAX_KERNEL_DX`) * 3.
+//
+// The pixels are only read. The accumulated error is kept separately with
+// full precision in one row buffer per kernel row, which are rotated after each
+// row.
+static inline void diffuse_errors(const uint8_t *pixels, const uint32_t width,
+                                  const uint32_t height,
+                                  const uint32_t channels,
+                                  const uint8_t *palette,
+                                  const uint32_t num_colors,
+                                  const kernel *kernel, const int serpentine,
+                                  uint8_t *indices, int16_t *errors) {
+  const uint32_t row_size = (width + 2 * MAX_KERNEL_DX) * 3;
+  int16_t *rows[MAX_KERNEL_DY + 1];
+  for (uint32_t dy = 0; dy <= MAX_KERNEL_DY; ++dy) {
+    rows[dy] = errors + dy * row_size;
+  }
+  memset(errors, 0, (MAX_KERNEL_DY + 1) * row_size * sizeof(int16_t));
+
   for (uint32_t y = 0; y < height; ++y) {
-    for (uint32_t x = 0; x < width; ++x) {
-      uint32_t i = (y * width + x) * 3;
+    // Scan odd rows from right to left in serpentine mode.
+    const int reverse = serpentine && (y % 2 == 1);
+    const int32_t direction = reverse ? -1 : 1;
+
+    for (uint32_t step = 0; step < width; ++step) {
+      const uint32_t x = reverse ? width - 1 - step : step;
+      const uint32_t i = (y * width + x) * channels;
+      const int32_t e = (x + MAX_KERNEL_DX) * 3;
+
+      // Add the accumulated error to the pixel.
+      const int32_t old_red = CLAMP(pixels[i] + rows[0][e]);
+      const int32_t old_green = CLAMP(pixels[i + 1] + rows[0][e + 1]);
+      const int32_t old_blue = CLAMP(pixels[i + 2] + rows[0][e + 2]);
 
       // Find the closest matching color in the palette.
-      const uint8_t old_red = pixels[i];
-      const uint8_t old_green = pixels[i + 1];
-      const uint8_t old_blue = pixels[i + 2];
-      uint8_t new_red, new_green, new_blue;
-      find_closest(old_red, old_green, old_blue, palette, num_colors, &new_red,
-                   &new_green, &new_blue);
-
-      // Replace the current pixel with the closest matching color.
-      pixels[i] = new_red;
-      pixels[i + 1] = new_green;
-      pixels[i + 2] = new_blue;
+      const uint32_t closest =
+          find_closest(old_red, old_green, old_blue, palette, num_colors);
+      indices[y * width + x] = closest;
 
       // Calculate the residual error.
-      const int32_t red_error = (int32_t)old_red - new_red;
-      const int32_t green_error = (int32_t)old_green - new_green;
-      const int32_t blue_error = (int32_t)old_blue - new_blue;
-      int32_t red_residual, green_residual, blue_residual;
-
-      // Propagate 7/16 of the residual error to (x + 1, y).
-      if (x < width - 1) {
-        i = (y * width + (x + 1)) * 3;
-        red_residual = pixels[i] + red_error * 7 / 16;
-        pixels[i] = CLAMP(red_residual);
-        green_residual = pixels[i + 1] + green_error * 7 / 16;
-        pixels[i + 1] = CLAMP(green_residual);
-        blue_residual = pixels[i + 2] + blue_error * 7 / 16;
-        pixels[i + 2] = CLAMP(blue_residual);
-      }
+      const int32_t red_error = old_red - palette[closest * 3];
+      const int32_t green_error = old_green - palette[closest * 3 + 1];
+      const int32_t blue_error = old_blue - palette[closest * 3 + 2];
 
-      // Propagate 3/16 of the residual error to (x - 1, y + 1).
-      if (x > 0 && y < height - 1) {
-        i = ((y + 1) * width + (x - 1)) * 3;
-        red_residual = pixels[i] + red_error * 3 / 16;
-        pixels[i] = CLAMP(red_residual);
-        green_residual = pixels[i + 1] + green_error * 3 / 16;
-        pixels[i + 1] = CLAMP(green_residual);
-        blue_residual = pixels[i + 2] + blue_error * 3 / 16;
-        pixels[i + 2] = CLAMP(blue_residual);
+      // Propagate the weighted residual error to the neighbors. The padding
+      // around each row absorbs the error falling off the left and right.
+      for (uint32_t k = 0; k < kernel->num_weights; ++k) {
+        const kernel_weight *weight = &kernel->weights[k];
+        int16_t *neighbor = rows[weight->dy] + e + direction * weight->dx * 3;
+        neighbor[0] += red_error * weight->weight / kernel->divisor;
+        neighbor[1] += green_error * weight->weight / kernel->divisor;
+        neighbor[2] += blue_error * weight->weight / kernel->divisor;
       }
+    }
+
+    // Move on to the next row and reuse the current row's buffer for the
+    // error diffused furthest down.
+    int16_t *done = rows[0];
+    for (uint32_t dy = 0; dy < MAX_KERNEL_DY; ++dy) {
+      rows[dy] = rows[dy + 1];
+    }
+    rows[MAX_KERNEL_DY] = done;
+    memset(done, 0, row_size * sizeof(int16_t));
+  }
+}
+
+// Packs palette indices into a byte stream. `indices` is an array of size
+// `num_pixels` containing palette indices. `codes` maps each palette index to
+// the code with `bits_per_pixel` bits sent to the display. The codes are packed
+// in order starting from the most significant bits of `packed`, which is an
+// array of size `num_pixels` * `bits_per_pixel` / 8, rounded up.
+void pack_codes(const uint8_t *indices, const uint32_t num_pixels,
+                const uint8_t *codes, const uint32_t bits_per_pixel,
+                uint8_t *packed) {
+  const uint32_t pixels_per_byte = 8 / bits_per_pixel;
+  const uint32_t num_bytes =
+      (num_pixels + pixels_per_byte - 1) / pixels_per_byte;
+
+  for (uint32_t i = 0; i < num_bytes; ++i) {
+    uint8_t byte = 0;
+    for (uint32_t j = 0; j < pixels_per_byte; ++j) {
+      const uint32_t pixel = i * pixels_per_byte + j;
+      byte <<= bits_per_pixel;
 
-      // Propagate 5/16 of the residual error to (x, y + 1).
-      if (y < height - 1) {
-        i = ((y + 1) * width + x) * 3;
-        red_residual = pixels[i] + red_error * 5 / 16;
-        pixels[i] = CLAMP(red_residual);
-        green_residual = pixels[i + 1] + green_error * 5 / 16;
-        pixels[i + 1] = CLAMP(green_residual);
-        blue_residual = pixels[i + 2] + blue_error * 5 / 16;
-        pixels[i + 2] = CLAMP(blue_residual);
+      // Pad the last byte with zeros.
+      if (pixel < num_pixels) {
+        byte |= codes[indices[pixel]];
       }
+    }
+    packed[i] = byte;
+  }
+}
+
+// Compresses `size` bytes of `data` with PackBits run-length encoding. Each run
+// starts with a header byte `n`. For `n` in [0, 127], the next `n` + 1 bytes
+// are copied literally. For `n` in [129, 255], the next byte is repeated
+// 257 - `n` times. `compressed` has to have room for `size` + `size` / 128 + 1
+// bytes. Returns the size of the compressed data.
+Py_ssize_t encode_pack_bits(const uint8_t *data, const Py_ssize_t size,
+                            uint8_t *compressed) {
+  Py_ssize_t i = 0;
+  Py_ssize_t length = 0;
+
+  while (i < size) {
+    // Encode runs of at least 3 identical bytes as repeats.
+    Py_ssize_t run = 1;
+    while (i + run < size && run < MAX_PACK_BITS_RUN &&
+           data[i + run] == data[i]) {
+      ++run;
+    }
+    if (run >= MIN_PACK_BITS_REPEAT) {
+      compressed[length++] = (uint8_t)(257 - run);
+      compressed[length++] = data[i];
+      i += run;
+      continue;
+    }
+
+    // Copy everything else literally until the next repeat starts.
+    const Py_ssize_t start = i;
+    while (i < size && i - start < MAX_PACK_BITS_RUN &&
+           !(i + 2 < size && data[i] == data[i + 1] &&
+             data[i] == data[i + 2])) {
+      ++i;
+    }
+    compressed[length++] = (uint8_t)(i - start - 1);
+    memcpy(compressed + length, data + start, i - start);
+    length += i - start;
+  }
+
+  return length;
+}
+
+// Validates the pixels, palette, and kernel arguments shared by all functions.
+// `pixels` has to contain `width` * `height` pixels with 3 (RGB) or 4 (e.g.
+// RGBX or RGBA) values each. `palette` has to contain up to 256 RGB values.
+// Returns 0 and sets an exception on failure.
+static int validate_image(const Py_buffer *pixels, const uint32_t width,
+                          const uint32_t height, const Py_buffer *palette,
+                          const uint32_t kernel_id, uint32_t *channels,
+                          uint32_t *num_colors) {
+  // Verify that the pixels match the dimensions.
+  const Py_ssize_t num_pixels = (Py_ssize_t)width * height;
+  if (num_pixels == 0 || (pixels->len != num_pixels * 3 &&
+                          pixels->len != num_pixels * 4)) {
+    PyErr_SetString(PyExc_ValueError,
+                    "Pixels should contain width * height * 3 or 4 bytes");
+    return 0;
+  }
+  *channels = pixels->len / num_pixels;
+
+  // Verify that the palette contains whole RGB colors.
+  if (palette->len == 0 || palette->len % 3 != 0 || palette->len > 256 * 3) {
+    PyErr_SetString(PyExc_ValueError,
+                    "Palette should contain 1 to 256 RGB colors of 3 bytes");
+    return 0;
+  }
+  *num_colors = palette->len / 3;
+
+  // Verify that the kernel exists.
+  if (kernel_id >= NUM_KERNELS) {
+    PyErr_SetString(PyExc_ValueError, "Unknown kernel");
+    return 0;
+  }
+
+  return 1;
+}
+
+// Dithers the pixels and records the palette index of each pixel in `indices`.
+// Doesn't need the GIL. Returns 0 if the error rows can't be allocated.
+static int dither_image(const Py_buffer *pixels, const uint32_t width,
+                        const uint32_t height, const uint32_t channels,
+                        const Py_buffer *palette, const uint32_t num_colors,
+                        const uint32_t kernel_id, const int serpentine,
+                        uint8_t *indices) {
+  int16_t *errors = malloc((MAX_KERNEL_DY + 1) *
+                           (width + 2 * MAX_KERNEL_DX) * 3 * sizeof(int16_t));
+  if (errors == NULL) {
+    return 0;
+  }
 
-      // Propagate 1/16 of the residual error to (x + 1, y + 1).
-      if (x < width - 1 && y < height - 1) {
-        i = ((y + 1) * width + (x + 1)) * 3;
-        red_residual = pixels[i] + red_error / 16;
-        pixels[i] = CLAMP(red_residual);
-        green_residual = pixels[i + 1] + green_error / 16;
-        pixels[i + 1] = CLAMP(green_residual);
-        blue_residual = pixels[i + 2] + blue_error / 16;
-        pixels[i + 2] = CLAMP(blue_residual);
+  // Inline a copy of the algorithm for each kernel, so that the compiler can
+  // unroll the loop over the constant weights.
+  switch (kernel_id) {
+    case ATKINSON:
+      diffuse_errors(pixels->buf, width, height, channels, palette->buf,
+                     num_colors, &kKernels[ATKINSON], serpentine, indices,
+                     errors);
+      break;
+    case STUCKI:
+      diffuse_errors(pixels->buf, width, height, channels, palette->buf,
+                     num_colors, &kKernels[STUCKI], serpentine, indices,
+                     errors);
+      break;
+    default:
+      diffuse_errors(pixels->buf, width, height, channels, palette->buf,
+                     num_colors, &kKernels[FLOYD_STEINBERG], serpentine,
+                     indices, errors);
+      break;
+  }
+  free(errors);
+
+  return 1;
+}
+
+static PyObject *dither(PyObject *self, PyObject *args, PyObject *kwargs) {
+  // Parse the function arguments.
+  static char *keywords[] = {"pixels", "width",      "height", "palette",
+                             "kernel", "serpentine", NULL};
+  Py_buffer pixels, palette;
+  uint32_t width, height, kernel_id = FLOYD_STEINBERG;
+  int serpentine = 0;
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "w*IIy*|Ip", keywords,
+                                   &pixels, &width, &height, &palette,
+                                   &kernel_id, &serpentine)) {
+    return NULL;
+  }
+  uint32_t channels, num_colors;
+  if (!validate_image(&pixels, width, height, &palette, kernel_id, &channels,
+                      &num_colors)) {
+    PyBuffer_Release(&pixels);
+    PyBuffer_Release(&palette);
+    return NULL;
+  }
+
+  // Dither without blocking other threads and write the palette colors back.
+  const uint32_t num_pixels = width * height;
+  uint8_t *indices = PyMem_RawMalloc(num_pixels);
+  int success = 0;
+  if (indices != NULL) {
+    Py_BEGIN_ALLOW_THREADS
+    success = dither_image(&pixels, width, height, channels, &palette,
+                           num_colors, kernel_id, serpentine, indices);
+    if (success) {
+      uint8_t *output = pixels.buf;
+      const uint8_t *colors = palette.buf;
+      for (uint32_t i = 0; i < num_pixels; ++i) {
+        memcpy(&output[i * channels], &colors[indices[i] * 3], 3);
       }
     }
+    Py_END_ALLOW_THREADS
+    PyMem_RawFree(indices);
+  }
+
+  PyBuffer_Release(&pixels);
+  PyBuffer_Release(&palette);
+  if (!success) {
+    return PyErr_NoMemory();
   }
+  Py_RETURN_NONE;
 }
 
-static PyObject *dither(PyObject *self, PyObject *args) {
+static PyObject *dither_indices(PyObject *self, PyObject *args,
+                                PyObject *kwargs) {
   // Parse the function arguments.
-  PyArrayObject *pixels, *palette;
-  if (!PyArg_ParseTuple(args, "O!O!", &PyArray_Type, &pixels, &PyArray_Type,
-                        &palette)) {
+  static char *keywords[] = {"pixels", "width",      "height", "palette",
+                             "kernel", "serpentine", NULL};
+  Py_buffer pixels, palette;
+  uint32_t width, height, kernel_id = FLOYD_STEINBERG;
+  int serpentine = 0;
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "y*IIy*|Ip", keywords,
+                                   &pixels, &width, &height, &palette,
+                                   &kernel_id, &serpentine)) {
+    return NULL;
+  }
+  uint32_t channels, num_colors;
+  if (!validate_image(&pixels, width, height, &palette, kernel_id, &channels,
+                      &num_colors)) {
+    PyBuffer_Release(&pixels);
+    PyBuffer_Release(&palette);
     return NULL;
   }
 
-  // Verify that the inputs are of the correct shape.
-  if (PyArray_NDIM(pixels) != 3 || PyArray_DIM(pixels, 2) != 3) {
-    PyErr_SetString(
-        PyExc_ValueError,
-        "Pixels should be a numpy array of shape (height, width, 3)");
+  // Allocate the output bytes.
+  PyObject *indices = PyBytes_FromStringAndSize(NULL, (Py_ssize_t)width *
+                                                          height);
+  if (indices == NULL) {
+    PyBuffer_Release(&pixels);
+    PyBuffer_Release(&palette);
     return NULL;
   }
-  if (PyArray_NDIM(palette) != 2 || PyArray_DIM(palette, 1) != 3) {
-    PyErr_SetString(PyExc_ValueError,
-                    "Palette should be a numpy array of shape (num_colors, 3)");
+
+  // Dither without blocking other threads, recording the palette indices.
+  int success;
+  Py_BEGIN_ALLOW_THREADS
+  success = dither_image(&pixels, width, height, channels, &palette,
+                         num_colors, kernel_id, serpentine,
+                         (uint8_t *)PyBytes_AS_STRING(indices));
+  Py_END_ALLOW_THREADS
+
+  PyBuffer_Release(&pixels);
+  PyBuffer_Release(&palette);
+  if (!success) {
+    Py_DECREF(indices);
+    return PyErr_NoMemory();
+  }
+  return indices;
+}
+
+static PyObject *dither_packed(PyObject *self, PyObject *args,
+                               PyObject *kwargs) {
+  // Parse the function arguments.
+  static char *keywords[] = {"pixels", "width",      "height",
+                             "palette", "codes",     "bits_per_pixel",
+                             "kernel", "serpentine", NULL};
+  Py_buffer pixels, palette, codes;
+  uint32_t width, height, bits_per_pixel, kernel_id = FLOYD_STEINBERG;
+  int serpentine = 0;
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "y*IIy*y*I|Ip", keywords,
+                                   &pixels, &width, &height, &palette, &codes,
+                                   &bits_per_pixel, &kernel_id, &serpentine)) {
     return NULL;
   }
+  uint32_t channels, num_colors;
+  if (!validate_image(&pixels, width, height, &palette, kernel_id, &channels,
+                      &num_colors)) {
+    goto error;
+  }
 
-  // Verify that the inputs are of the correct type.
-  if (PyArray_TYPE(pixels) != NPY_UINT8 || PyArray_TYPE(palette) != NPY_UINT8) {
+  // Verify the encoding.
+  if (codes.len != num_colors) {
+    PyErr_SetString(PyExc_ValueError,
+                    "Codes should contain one byte per palette color");
+    goto error;
+  }
+  if (bits_per_pixel != 1 && bits_per_pixel != 2 && bits_per_pixel != 4 &&
+      bits_per_pixel != 8) {
     PyErr_SetString(PyExc_ValueError,
-                    "Pixels and palette should be of type uint8");
+                    "Bits per pixel should be one of 1, 2, 4, or 8");
+    goto error;
+  }
+
+  // Allocate the output bytes and a temporary buffer for the palette indices.
+  const uint32_t num_pixels = width * height;
+  const uint32_t pixels_per_byte = 8 / bits_per_pixel;
+  PyObject *packed = PyBytes_FromStringAndSize(
+      NULL, (num_pixels + pixels_per_byte - 1) / pixels_per_byte);
+  if (packed == NULL) {
+    goto error;
+  }
+  uint8_t *indices = PyMem_RawMalloc(num_pixels);
+  if (indices == NULL) {
+    Py_DECREF(packed);
+    PyErr_NoMemory();
+    goto error;
+  }
+
+  // Dither and pack the codes into the output bytes without blocking other
+  // threads.
+  int success;
+  Py_BEGIN_ALLOW_THREADS
+  success = dither_image(&pixels, width, height, channels, &palette,
+                         num_colors, kernel_id, serpentine, indices);
+  if (success) {
+    pack_codes(indices, num_pixels, codes.buf, bits_per_pixel,
+               (uint8_t *)PyBytes_AS_STRING(packed));
+  }
+  Py_END_ALLOW_THREADS
+
+  PyMem_RawFree(indices);
+  PyBuffer_Release(&pixels);
+  PyBuffer_Release(&palette);
+  PyBuffer_Release(&codes);
+  if (!success) {
+    Py_DECREF(packed);
+    return PyErr_NoMemory();
+  }
+  return packed;
+
+error:
+  PyBuffer_Release(&pixels);
+  PyBuffer_Release(&palette);
+  PyBuffer_Release(&codes);
+  return NULL;
+}
+
+static PyObject *pack_bits(PyObject *self, PyObject *args, PyObject *kwargs) {
+  // Parse the function arguments.
+  static char *keywords[] = {"data", NULL};
+  Py_buffer data;
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "y*", keywords, &data)) {
     return NULL;
   }
 
-  // Get the dimensions from the numpy arrays.
-  uint32_t height = PyArray_DIM(pixels, 0);
-  uint32_t width = PyArray_DIM(pixels, 1);
-  uint32_t num_colors = PyArray_DIM(palette, 0);
+  // Allocate the output bytes for the worst case of only literal runs.
+  PyObject *compressed = PyBytes_FromStringAndSize(
+      NULL, data.len + data.len / MAX_PACK_BITS_RUN + 1);
+  if (compressed == NULL) {
+    PyBuffer_Release(&data);
+    return NULL;
+  }
 
-  // Run the Floyd-Steinberg algorithm.
-  floyd_steinberg(PyArray_DATA(pixels), width, height, PyArray_DATA(palette),
-                  num_colors);
+  // Compress the data without blocking other threads.
+  Py_ssize_t length;
+  Py_BEGIN_ALLOW_THREADS
+  length = encode_pack_bits(data.buf, data.len,
+                            (uint8_t *)PyBytes_AS_STRING(compressed));
+  Py_END_ALLOW_THREADS
 
-  Py_RETURN_NONE;
+  PyBuffer_Release(&data);
+  if (_PyBytes_Resize(&compressed, length) < 0) {
+    return NULL;
+  }
+  return compressed;
 }
 
 static PyMethodDef package_methods[] = {
-    {"dither", dither, METH_VARARGS,
-     "Dithers the image in place using the Floyd-Steinberg algorithm."},
+    {"dither", (PyCFunction)(void (*)(void))dither,
+     METH_VARARGS | METH_KEYWORDS,
+     "dither(pixels, width, height, palette, kernel=FLOYD_STEINBERG, "
+     "serpentine=False)\n\n"
+     "Dithers the image in place using error diffusion."},
+    {"dither_indices", (PyCFunction)(void (*)(void))dither_indices,
+     METH_VARARGS | METH_KEYWORDS,
+     "dither_indices(pixels, width, height, palette, kernel=FLOYD_STEINBERG, "
+     "serpentine=False)\n\n"
+     "Dithers the image and returns the palette index bytes."},
+    {"dither_packed", (PyCFunction)(void (*)(void))dither_packed,
+     METH_VARARGS | METH_KEYWORDS,
+     "dither_packed(pixels, width, height, palette, codes, bits_per_pixel, "
+     "kernel=FLOYD_STEINBERG, serpentine=False)\n\n"
+     "Dithers the image and returns the packed display code bytes."},
+    {"pack_bits", (PyCFunction)(void (*)(void))pack_bits,
+     METH_VARARGS | METH_KEYWORDS,
+     "pack_bits(data)\n\n"
+     "Compresses the bytes with PackBits run-length encoding."},
     {NULL, NULL, 0, NULL}};
 
 static struct PyModuleDef package_definition = {
     PyModuleDef_HEAD_INIT, "dithering", NULL, -1, package_methods};
 
 PyMODINIT_FUNC PyInit_dithering(void) {
-  Py_Initialize();
-  import_array();
-  return PyModule_Create(&package_definition);
+  PyObject *module = PyModule_Create(&package_definition);
+  if (module == NULL) {
+    return NULL;
+  }
+
+  // Expose the kernel identifiers.
+  if (PyModule_AddIntConstant(module, "FLOYD_STEINBERG", FLOYD_STEINBERG) ||
+      PyModule_AddIntConstant(module, "ATKINSON", ATKINSON) ||
+      PyModule_AddIntConstant(module, "STUCKI", STUCKI)) {
+    Py_DECREF(module);
+    return NULL;
+  }
+
+  return module;
 }
@@ -1,10 +1,8 @@
 from setuptools import Extension
 from setuptools import setup
-from numpy import get_include
 
 extension = Extension(
     name='dithering',
-    sources=['dithering.c'],
-    include_dirs=[get_include()])
+    sources=['dithering.c'])
 
 setup(ext_modules=[extension])
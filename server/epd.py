@@ -1,9 +1,36 @@
-from dithering import dither
+# To check the palette lookup tables against SciPy's vq and compare their
+# performance, run:
+# $ pip install scipy
+# $ python epd.py
+#
+# To measure the throughput of each dither kernel, run:
+# $ python epd.py kernels
+#
+# To measure how dithering scales across threads, which run in parallel
+# because the C extension releases the GIL, run:
+# $ python epd.py threads
+
+from cachetools import cached
+from dithering import dither_indices
+from dithering import dither_packed
+from dithering import pack_bits
+from dithering import ATKINSON
+from dithering import FLOYD_STEINBERG
+from dithering import STUCKI
+from numpy import append
+from numpy import arange
 from numpy import array
-from numpy import packbits
+from numpy import block
+from numpy import frombuffer
+from numpy import full
+from numpy import int16
+from numpy import int32
+from numpy import sqrt
+from numpy import tile
 from numpy import uint8
+from numpy import uint32
+from numpy import zeros
 from PIL import Image
-from scipy.cluster.vq import vq
 
 # The default width of the display in pixels.
 DEFAULT_DISPLAY_WIDTH = 640
@@ -35,32 +62,300 @@ ENCODING_7COLOR = array([[0, 0, 0, 0], [0, 0, 0, 1], [0, 0, 1, 0],
                          [0, 0, 1, 1], [0, 1, 0, 0], [0, 1, 0, 1],
                          [0, 1, 1, 0]], dtype=uint8)
 
+# The encodings of the display data sent to the client, either the raw packed
+# color codes or compressed with PackBits run-length encoding.
+EPD_ENCODINGS = ['raw', 'rle']
 
-def _dither(image, palette):
-    """Dithers the image using the Floyd-Steinberg algorithm."""
+# The default encoding of the display data.
+DEFAULT_EPD_ENCODING = 'raw'
+
+# The number of image rows converted at a time when streaming. A multiple of
+# the Bayer matrix size keeps the ordered dithering pattern aligned and a
+# multiple of 8 makes strips end on byte boundaries.
+STRIP_HEIGHT = 64
+
+# The error diffusion kernels available for dithering.
+DITHER_KERNELS = {
+    'floyd_steinberg': FLOYD_STEINBERG,
+    'atkinson': ATKINSON,
+    'stucki': STUCKI
+}
+
+# The dithering mode using a threshold matrix instead of error diffusion.
+ORDERED_DITHER = 'ordered'
+
+# The available dithering modes, either error diffusion kernels or ordered.
+DITHER_MODES = list(DITHER_KERNELS) + [ORDERED_DITHER]
+
+# The default dithering mode.
+DEFAULT_DITHER = 'floyd_steinberg'
+
+# The size of the Bayer threshold matrix used for ordered dithering.
+BAYER_SIZE = 8
+
+# The range of the ordered dithering offsets for black, white, and red.
+ORDERED_SPREAD_BWR = 255
+
+# The range of the ordered dithering offsets for 7-color.
+ORDERED_SPREAD_7COLOR = 192
+
+# The image modes that are already quantized and don't need dithering.
+QUANTIZED_MODES = ('1', 'L', 'P')
+
+# The maximum number of colors in a quantized image.
+QUANTIZED_COLORS = 256
+
+# The image info key marking palettized images whose indices already refer to
+# the palette of the named display variant.
+EPD_VARIANT_KEY = 'epd_variant'
+
+# The image info key of display data packed ahead of time for such images.
+EPD_DATA_KEY = 'epd_data'
+
+# The number of most significant bits per color channel used to index the
+# palette lookup tables.
+LUT_BITS = 6
+
+# The lookup table entry for colors without a unique closest palette color.
+LUT_AMBIGUOUS = 255
+
+# The display sizes used for the benchmark.
+BENCHMARK_SIZES = [(640, 384), (800, 480), (1304, 984)]
+
+# The number of repetitions in the benchmark.
+BENCHMARK_REPETITIONS = 20
+
+# The number of random pixels checked against vq.
+BENCHMARK_RANDOM_PIXELS = 1000000
+
+# The frame size used for the thread benchmark.
+THREAD_BENCHMARK_SIZE = (1304, 984)
+
+# The number of threads, each dithering its own frame, in the thread benchmark.
+THREAD_BENCHMARK_THREADS = 4
+
+
+def _dither_kernel(kernel):
+    """Returns the identifier of the error diffusion kernel."""
+
+    try:
+        return DITHER_KERNELS[kernel]
+    except KeyError:
+        raise ValueError('Unsupported dither kernel: %s' % kernel)
+
+
+def _dither(image, variant, kernel=DEFAULT_DITHER, serpentine=False):
+    """Dithers the image and returns the palette index of each pixel."""
 
     # Call the C extension to iterate over all image pixels efficiently.
     image = image.convert('RGB')
-    pixels = array(image)
-    dither(pixels, palette)
+    indices = dither_indices(image.tobytes(), image.width, image.height,
+                             epd_palette(variant),
+                             kernel=_dither_kernel(kernel),
+                             serpentine=serpentine)
+
+    return frombuffer(indices, dtype=uint8).reshape((image.height,
+                                                     image.width))
+
+
+def _dither_bytes(image, variant, kernel=DEFAULT_DITHER, serpentine=False):
+    """Dithers the image and returns the packed display color codes."""
+
+    # Let the C extension dither, map, and pack in a single pass.
+    image = image.convert('RGB')
+    codes = _encoding_codes(variant)
+    bits_per_pixel = epd_encoding(variant).shape[1]
+    return dither_packed(image.tobytes(), image.width, image.height,
+                         epd_palette(variant), codes, bits_per_pixel,
+                         kernel=_dither_kernel(kernel), serpentine=serpentine)
+
+
+def _bayer_matrix(size):
+    """Builds a Bayer threshold matrix with values in the range (-0.5, 0.5)."""
+
+    matrix = zeros((1, 1))
+    while len(matrix) < size:
+        matrix = block([[4 * matrix, 4 * matrix + 2],
+                        [4 * matrix + 3, 4 * matrix + 1]])
+
+    return (matrix + 0.5) / matrix.size - 0.5
+
+
+@cached(cache={})
+def _ordered_offsets(variant):
+    """Returns the Bayer matrix scaled to the color offsets for the variant."""
+
+    if variant == 'bwr':
+        spread = ORDERED_SPREAD_BWR
+    elif variant == '7color':
+        spread = ORDERED_SPREAD_7COLOR
+    else:
+        raise ValueError('Unsupported display variant: %s' % variant)
+
+    return (_bayer_matrix(BAYER_SIZE) * spread).round().astype(int16)
+
+
+def _ordered_dither(image, variant):
+    """Dithers the image with a threshold matrix into palette indices."""
+
+    # Offset each pixel by the threshold at its position in the tiled matrix.
+    # Unlike error diffusion, every pixel is independent of the others.
+    pixels = array(image.convert('RGB'), dtype=int16)
+    offsets = _ordered_offsets(variant)
+    repeats = (image.height // BAYER_SIZE + 1, image.width // BAYER_SIZE + 1)
+    offsets = tile(offsets, repeats)[:image.height, :image.width]
+    pixels += offsets[:, :, None]
+
+    # Map each offset pixel to the closest palette color.
+    return _lut_indices(pixels.clip(0, 255).astype(uint8), variant)
+
+
+@cached(cache={})
+def _palette_lut(variant):
+    """Builds a table mapping quantized RGB colors to palette indices."""
+
+    palette = epd_palette(variant).astype(int32)
+
+    # Represent each cell of the quantized RGB cube by its center.
+    cell_size = 1 << (8 - LUT_BITS)
+    centers = arange(1 << LUT_BITS) * cell_size + (cell_size - 1) / 2
+    red = centers.reshape((-1, 1, 1))
+    green = centers.reshape((1, -1, 1))
+    blue = centers.reshape((1, 1, -1))
+
+    # Find the closest and second closest palette color for each cell.
+    lut_shape = (1 << LUT_BITS,) * 3
+    closest = zeros(lut_shape, dtype=uint8)
+    closest_distance = full(lut_shape, float('inf'))
+    second_distance = full(lut_shape, float('inf'))
+    for index, (palette_red, palette_green, palette_blue) in enumerate(
+            palette):
+        distance = ((red - palette_red) ** 2 + (green - palette_green) ** 2 +
+                    (blue - palette_blue) ** 2)
+        is_closer = distance < closest_distance
+        second_distance[is_closer] = closest_distance[is_closer]
+        second_distance[~is_closer] = (
+            distance[~is_closer].clip(max=second_distance[~is_closer]))
+        closest[is_closer] = index
+        closest_distance[is_closer] = distance[is_closer]
+
+    # Any color in a cell is at most this far from the cell's center. Cells
+    # where the margin between the two closest palette colors is smaller than
+    # twice that could contain colors closer to either one.
+    cell_radius = sqrt(3) * (cell_size - 1) / 2
+    margin = sqrt(second_distance) - sqrt(closest_distance)
+    closest[margin <= 2 * cell_radius] = LUT_AMBIGUOUS
+
+    return closest.reshape(-1)
+
+
+def _closest_indices(colors, palette):
+    """Finds the closest palette color for each color by brute force."""
+
+    colors = colors.astype(int32)
+    closest = zeros(len(colors), dtype=uint8)
+    closest_distance = full(len(colors), 3 * 255 ** 2 + 1, dtype=int32)
+    for index, color in enumerate(palette.astype(int32)):
+        distance = ((colors - color) ** 2).sum(axis=1)
+        is_closer = distance < closest_distance
+        closest[is_closer] = index
+        closest_distance[is_closer] = distance[is_closer]
+
+    return closest
+
+
+def _lut_indices(pixels, variant):
+    """Maps RGB pixels to the closest palette colors using a lookup table."""
+
+    # Look up the quantized colors in the table.
+    shift = 8 - LUT_BITS
+    keys = (pixels[..., 0] >> shift).astype(uint32) << (2 * LUT_BITS)
+    keys |= (pixels[..., 1] >> shift).astype(uint32) << LUT_BITS
+    keys |= pixels[..., 2] >> shift
+    indices = _palette_lut(variant)[keys]
+
+    # Resolve the few colors near the boundary between palette colors.
+    ambiguous = indices == LUT_AMBIGUOUS
+    if ambiguous.any():
+        indices[ambiguous] = _closest_indices(pixels[ambiguous],
+                                              epd_palette(variant))
+
+    return indices
+
+
+def _image_colors(image):
+    """Returns the RGB colors referenced by the quantized image's pixels."""
+
+    if image.mode == 'P':
+        colors = array(image.getpalette(), dtype=uint8).reshape((-1, 3))
+        padding = zeros((QUANTIZED_COLORS - len(colors), 3), dtype=uint8)
+        return append(colors, padding, axis=0)
+    elif image.mode == 'L':
+        return arange(QUANTIZED_COLORS, dtype=uint8).repeat(3).reshape(
+            (-1, 3))
+    else:
+        raise ValueError('Unsupported image mode: %s' % image.mode)
+
+
+def _remap_indices(image, variant):
+    """Maps each pixel of a quantized image to the closest palette color."""
 
-    return Image.fromarray(pixels)
+    # Bilevel images are stored as packed bits, so use one byte per pixel.
+    if image.mode == '1':
+        image = image.convert('L')
 
+    # Find the closest palette color for each of the at most 256 colors and
+    # gather the pixels' indices from the raw image buffer.
+    remap = _closest_indices(_image_colors(image), epd_palette(variant))
+    pixels = frombuffer(image.tobytes(), dtype=uint8)
 
-def _color_indices(image, variant):
+    return remap[pixels].reshape((image.height, image.width))
+
+
+def _color_indices(image, variant, dither, serpentine):
     """Maps each image pixel to the index of the closest palette color."""
 
+    # Use the indices of images already in the display's palette as they are.
+    if image.mode == 'P' and image.info.get(EPD_VARIANT_KEY) == variant:
+        return array(image)
+
     # Apply dithering unless the image is already quantized.
-    palette = epd_palette(variant)
-    if image.mode not in ('1', 'L', 'P'):
-        image = _dither(image, palette)
+    if image.mode not in QUANTIZED_MODES:
+        if dither == ORDERED_DITHER:
+            return _ordered_dither(image, variant)
+        return _dither(image, variant, dither, serpentine)
 
-    # Map each pixel to the closest palette color.
-    image = image.convert('RGB')
-    image_data = array(image).reshape((image.width * image.height, 3))
-    indices, _ = vq(image_data, palette)
+    # Map each color of the image palette once and look up the pixels.
+    return _remap_indices(image, variant)
 
-    return indices
+
+@cached(cache={})
+def _encoding_codes(variant):
+    """Combines the color encoding bits into one display code per color."""
+
+    encoding = epd_encoding(variant)
+    bits_per_pixel = encoding.shape[1]
+    shifts = arange(bits_per_pixel)[::-1]
+
+    return (encoding << shifts).sum(axis=1).astype(uint8)
+
+
+def _pack(indices, variant):
+    """Packs the display color codes for the palette indices into bytes."""
+
+    codes = _encoding_codes(variant)[indices.reshape(-1)]
+
+    # Pad the codes to fill the last byte and combine them in groups.
+    bits_per_pixel = epd_encoding(variant).shape[1]
+    pixels_per_byte = 8 // bits_per_pixel
+    padding = zeros(-len(codes) % pixels_per_byte, dtype=uint8)
+    codes = append(codes, padding).reshape((-1, pixels_per_byte))
+    packed = zeros(len(codes), dtype=uint8)
+    for column in range(pixels_per_byte):
+        packed <<= bits_per_pixel
+        packed |= codes[:, column]
+
+    return packed.tobytes()
 
 
 def epd_palette(variant):
@@ -85,22 +380,131 @@ def epd_encoding(variant):
         raise ValueError('Unsupported display variant: %s' % variant)
 
 
-def to_epd_image(image, variant):
+def epd_indices(colors, variant):
+    """Finds the indices of the closest palette colors for a list of RGB
+    colors.
+    """
+
+    colors = array(colors, dtype=uint8).reshape((-1, 3))
+    return _closest_indices(colors, epd_palette(variant)).tolist()
+
+
+def epd_packed_rows(indices, variant):
+    """Packs the display color codes for an array of palette indices into an
+    array of bytes per row. The width must fill whole bytes.
+    """
+
+    height, width = indices.shape
+    if width % (8 // epd_encoding(variant).shape[1]):
+        raise ValueError('Unsupported packed width: %d' % width)
+
+    return frombuffer(_pack(indices, variant), dtype=uint8).reshape(
+        (height, -1))
+
+
+def epd_image(indices, variant, data=None):
+    """Wraps an array of palette indices in a palettized image. The image is
+    marked, so that converting it for the same display variant skips
+    quantization. Any packed display data for the indices is kept along with
+    it, so that converting it skips packing too.
+    """
+
+    image = Image.fromarray(indices, mode='P')
+    image.putpalette(epd_palette(variant).reshape(-1).tolist())
+    image.info[EPD_VARIANT_KEY] = variant
+    if data is not None:
+        image.info[EPD_DATA_KEY] = data
+
+    return image
+
+
+def _packed_data(image, variant):
+    """Returns the display data packed along with the image for the variant,
+    or None if there is none or it doesn't match the image's size.
+    """
+
+    data = image.info.get(EPD_DATA_KEY)
+    if data is None or image.info.get(EPD_VARIANT_KEY) != variant:
+        return None
+
+    bits_per_pixel = epd_encoding(variant).shape[1]
+    if len(data) != -(-image.width * image.height * bits_per_pixel // 8):
+        return None
+
+    return data
+
+
+def to_epd_image(image, variant, dither=DEFAULT_DITHER, serpentine=False):
     """Converts the image's colors to the closest palette color."""
 
-    indices = _color_indices(image, variant)
-    palette = epd_palette(variant)
-    epd_image_data = palette[indices.reshape((image.height, image.width))]
-    return Image.fromarray(epd_image_data)
+    indices = _color_indices(image, variant, dither, serpentine)
+    return epd_image(indices, variant)
 
 
-def to_epd_bytes(image, variant):
+def _encode(data, encoding):
+    """Encodes the packed display color codes for transfer."""
+
+    if encoding == 'raw':
+        return data
+    elif encoding == 'rle':
+        return pack_bits(data)
+    else:
+        raise ValueError('Unsupported display encoding: %s' % encoding)
+
+
+def to_epd_bytes(image, variant, dither=DEFAULT_DITHER, serpentine=False,
+                 encoding=DEFAULT_EPD_ENCODING):
     """Converts the image to the closest 2-bit palette color bytes."""
 
-    indices = _color_indices(image, variant)
-    encoding = epd_encoding(variant)
-    epd_image_data = encoding[indices.reshape((image.height * image.width))]
-    return packbits(epd_image_data)
+    # Use any display data packed ahead of time.
+    data = _packed_data(image, variant)
+    if data is None:
+        # Dither, map, and pack unquantized images in a single pass.
+        if image.mode not in QUANTIZED_MODES and dither != ORDERED_DITHER:
+            data = _dither_bytes(image, variant, dither, serpentine)
+        else:
+            indices = _color_indices(image, variant, dither, serpentine)
+            data = _pack(indices, variant)
+
+    return _encode(data, encoding)
+
+
+def _strips(image, variant, dither, encoding):
+    """Converts the image one strip at a time, without error diffusion."""
+
+    for y in range(0, image.height, STRIP_HEIGHT):
+        strip = image.crop((0, y, image.width,
+                            min(y + STRIP_HEIGHT, image.height)))
+        indices = _color_indices(strip, variant, dither, serpentine=False)
+        yield _encode(_pack(indices, variant), encoding)
+
+
+def to_epd_strips(image, variant, dither=DEFAULT_DITHER, serpentine=False,
+                  encoding=DEFAULT_EPD_ENCODING):
+    """Converts the image like to_epd_bytes, but returns an iterator over the
+    bytes of each horizontal strip, which are converted when requested.
+    """
+
+    # Check the arguments before the conversion is deferred.
+    if variant not in DISPLAY_VARIANTS:
+        raise ValueError('Unsupported display variant: %s' % variant)
+    if encoding not in EPD_ENCODINGS:
+        raise ValueError('Unsupported display encoding: %s' % encoding)
+
+    # Error diffusion carries over from one row to the next, so dither the
+    # whole image at once and only split the bytes. The same goes for display
+    # data packed ahead of time.
+    data = _packed_data(image, variant)
+    if data is None and (image.mode not in QUANTIZED_MODES and
+                         dither != ORDERED_DITHER):
+        data = _dither_bytes(image, variant, dither, serpentine)
+    if data is not None:
+        bits_per_pixel = epd_encoding(variant).shape[1]
+        strip_size = STRIP_HEIGHT * image.width * bits_per_pixel // 8
+        return (_encode(data[i:i + strip_size], encoding)
+                for i in range(0, len(data), strip_size))
+
+    return _strips(image, variant, dither, encoding)
 
 
 def adjust_xy(x, y, width, height):
@@ -111,3 +515,146 @@ def adjust_xy(x, y, width, height):
     y += (height - DEFAULT_DISPLAY_HEIGHT) // 2
 
     return x, y
+
+
+def _benchmark():
+    """Checks the palette lookup tables against vq for random pixels and all
+    RGB colors, and times both at the benchmark display sizes.
+    """
+
+    from numpy.random import default_rng
+    from scipy.cluster.vq import vq
+    from time import perf_counter
+
+    random = default_rng()
+    channel = arange(256, dtype=uint8)
+    for variant in DISPLAY_VARIANTS:
+        palette = epd_palette(variant)
+
+        # Compare random pixels and every RGB color, one red value at a time.
+        mismatches = 0
+        pixels = random.integers(0, 256, size=(BENCHMARK_RANDOM_PIXELS, 3),
+                                 dtype=uint8)
+        mismatches += (_lut_indices(pixels, variant) !=
+                       vq(pixels, palette)[0]).sum()
+        green_blue = array([(green, blue) for green in channel
+                            for blue in channel], dtype=uint8)
+        for red in channel:
+            pixels = block([full((len(green_blue), 1), red, dtype=uint8),
+                            green_blue])
+            mismatches += (_lut_indices(pixels, variant) !=
+                           vq(pixels, palette)[0]).sum()
+        if mismatches:
+            raise ValueError('Mismatched %s palette indices: %d' % (
+                variant, mismatches))
+        print('%s: identical to vq for %d random pixels and all colors' % (
+            variant, BENCHMARK_RANDOM_PIXELS))
+
+        for width, height in BENCHMARK_SIZES:
+            pixels = random.integers(0, 256, size=(height, width, 3),
+                                     dtype=uint8)
+
+            start = perf_counter()
+            for _ in range(BENCHMARK_REPETITIONS):
+                _lut_indices(pixels, variant)
+            lut_time = perf_counter() - start
+
+            start = perf_counter()
+            for _ in range(BENCHMARK_REPETITIONS):
+                vq(pixels.reshape((-1, 3)), palette)
+            vq_time = perf_counter() - start
+
+            print('%s at %dx%d: lookup table %.3f ms, vq %.3f ms' % (
+                variant, width, height,
+                lut_time * 1000 / BENCHMARK_REPETITIONS,
+                vq_time * 1000 / BENCHMARK_REPETITIONS))
+
+
+def _thread_benchmark():
+    """Times dithering a batch of frames on a single thread and on one thread
+    per frame.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+    from numpy.random import default_rng
+    from time import perf_counter
+
+    random = default_rng()
+    num_threads = THREAD_BENCHMARK_THREADS
+    width, height = THREAD_BENCHMARK_SIZE
+    frames = [random.integers(0, 256, size=(height, width, 3),
+                              dtype=uint8).tobytes()
+              for _ in range(num_threads)]
+
+    for variant in DISPLAY_VARIANTS:
+        palette = epd_palette(variant)
+        codes = _encoding_codes(variant)
+        bits_per_pixel = epd_encoding(variant).shape[1]
+        functions = {
+            'dither_indices': lambda frame: dither_indices(
+                frame, width, height, palette),
+            'dither_packed': lambda frame: dither_packed(
+                frame, width, height, palette, codes, bits_per_pixel)}
+
+        for name, function in functions.items():
+            start = perf_counter()
+            for _ in range(BENCHMARK_REPETITIONS):
+                for frame in frames:
+                    function(frame)
+            serial_time = perf_counter() - start
+
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                start = perf_counter()
+                for _ in range(BENCHMARK_REPETITIONS):
+                    list(executor.map(function, frames))
+                parallel_time = perf_counter() - start
+
+            print('%s %s, %d frames at %dx%d: 1 thread %.3f ms, '
+                  '%d threads %.3f ms, speedup %.2fx' % (
+                      variant, name, num_threads, width, height,
+                      serial_time * 1000 / BENCHMARK_REPETITIONS,
+                      num_threads,
+                      parallel_time * 1000 / BENCHMARK_REPETITIONS,
+                      serial_time / parallel_time))
+
+
+def _kernel_benchmark():
+    """Times each error diffusion kernel, with and without serpentine
+    scanning, for each display variant and benchmark size.
+    """
+
+    from numpy.random import default_rng
+    from time import perf_counter
+
+    random = default_rng()
+    for width, height in BENCHMARK_SIZES:
+        frame = random.integers(0, 256, size=(height, width, 3),
+                                dtype=uint8).tobytes()
+        for variant in DISPLAY_VARIANTS:
+            palette = epd_palette(variant)
+            for kernel in DITHER_KERNELS:
+                for serpentine in [False, True]:
+                    start = perf_counter()
+                    for _ in range(BENCHMARK_REPETITIONS):
+                        dither_indices(frame, width, height, palette,
+                                       kernel=_dither_kernel(kernel),
+                                       serpentine=serpentine)
+                    elapsed = perf_counter() - start
+
+                    megapixels = (width * height * BENCHMARK_REPETITIONS /
+                                  1000000)
+                    print('%s %dx%d %s%s: %.1f Mpx/s' % (
+                        variant, width, height, kernel,
+                        ' serpentine' if serpentine else '',
+                        megapixels / elapsed))
+
+
+if __name__ == '__main__':
+    from sys import argv
+
+    if argv[1:] == ['kernels']:
+        _kernel_benchmark()
+    elif argv[1:] == ['threads']:
+        _thread_benchmark()
+    else:
+        _benchmark()
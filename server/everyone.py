@@ -47,6 +47,16 @@ class Everyone(ImageContent):
 
         return markers
 
+    def fingerprint(self, user, width, height, variant):
+        """Uses the cached user locations shown on the map."""
+
+        return self._markers()
+
+    def frame_ttl(self, fingerprint):
+        """Keeps frames as long as the cached user locations."""
+
+        return CACHE_TTL_S
+
     def image(self, user, width, height, variant):
         """Generates a map with user locations."""
 
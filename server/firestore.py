@@ -1,9 +1,6 @@
-from firebase_admin import _apps as firebase_apps
-from firebase_admin import initialize_app
-from firebase_admin.credentials import ApplicationDefault
-from firebase_admin.firestore import client as firestore_client
+from cachetools import cached
+from cachetools import TTLCache
 from googleapiclient.http import build_http
-from google.cloud.firestore import DELETE_FIELD
 from logging import error
 from logging import info
 from logging import warning
@@ -13,11 +10,27 @@ from oauth2client.client import Storage
 from os import environ
 from threading import Lock
 
+# The database documents with API keys and OAuth client secrets, as pairs of
+# collection and document IDs.
+CONFIG_DOCUMENTS = [('api_keys', 'google_maps'),
+                    ('api_keys', 'open_weather'),
+                    ('oauth_clients', 'google_calendar')]
+
+# The time to live in seconds for the configuration, after which rotated API
+# keys and secrets are picked up.
+CONFIG_TTL_S = 5 * 60  # 5 minutes
+
 
 class Firestore(object):
     """A wrapper around the Cloud Firestore database."""
 
     def __init__(self):
+        # Import Firebase on first use, which is slow to load.
+        from firebase_admin import _apps as firebase_apps
+        from firebase_admin import initialize_app
+        from firebase_admin.credentials import ApplicationDefault
+        from firebase_admin.firestore import client as firestore_client
+
         # Only initialize Firebase once.
         if not len(firebase_apps):
             initialize_app(ApplicationDefault(), {
@@ -25,34 +38,17 @@ class Firestore(object):
             })
         self._db = firestore_client()
 
-    def _api_key(self, service):
-        """Retrieves the API key for the specified service."""
-
-        api_key = self._db.collection('api_keys').document(service).get()
-        if not api_key.exists:
-            raise DataError('Missing API key for: %s' % service)
-
-        return api_key.get('api_key')
-
-    def google_maps_api_key(self):
-        """Retrieves the Google Maps API key."""
-
-        return self._api_key('google_maps')
-
-    def open_weather_api_key(self):
-        """Retrieves the OpenWeather API key."""
+    def config_documents(self):
+        """Retrieves the API keys and OAuth client secrets in one batched
+        read, keyed by collection and document IDs.
+        """
 
-        return self._api_key('open_weather')
+        references = [self._db.collection(collection).document(document)
+                      for collection, document in CONFIG_DOCUMENTS]
+        snapshots = self._db.get_all(references)
 
-    def google_calendar_secrets(self):
-        """Loads the Google Calendar API secrets from the database."""
-
-        clients = self._db.collection('oauth_clients')
-        secrets = clients.document('google_calendar').get()
-        if not secrets.exists:
-            raise DataError('Missing Google Calendar secrets')
-
-        return secrets.to_dict()
+        return {(snapshot.reference.parent.id, snapshot.id): snapshot.to_dict()
+                for snapshot in snapshots if snapshot.exists}
 
     def google_calendar_credentials(self, key):
         """Loads and refreshes Google Calendar API credentials."""
@@ -97,6 +93,7 @@ class Firestore(object):
     def delete_google_calendar_credentials(self, key):
         """Deletes the users's Google Calendar credentials."""
 
+        from google.cloud.firestore import DELETE_FIELD
         self.update_user(key, {'google_calendar_credentials': DELETE_FIELD})
 
     def user(self, key):
@@ -136,6 +133,60 @@ class Firestore(object):
         user.update(fields)
 
 
+class Config(object):
+    """A snapshot of the API keys and OAuth client secrets, loaded from the
+    database on first use instead of at startup and refreshed periodically.
+    """
+
+    @cached(cache=TTLCache(maxsize=1, ttl=CONFIG_TTL_S), lock=Lock())
+    def _documents(self):
+        """Loads all configuration documents."""
+
+        documents = Firestore().config_documents()
+        info('Loaded config: %d documents' % len(documents))
+
+        return documents
+
+    def _document(self, collection, document):
+        """Returns the data of a configuration document, or None if it's
+        missing.
+        """
+
+        return self._documents().get((collection, document))
+
+    def _api_key(self, service):
+        """Retrieves the API key for the specified service."""
+
+        api_key = self._document('api_keys', service)
+        if not api_key:
+            raise DataError('Missing API key for: %s' % service)
+
+        return api_key['api_key']
+
+    def google_maps_api_key(self):
+        """Retrieves the Google Maps API key."""
+
+        return self._api_key('google_maps')
+
+    def open_weather_api_key(self):
+        """Retrieves the OpenWeather API key."""
+
+        return self._api_key('open_weather')
+
+    def google_calendar_secrets(self):
+        """Retrieves the Google Calendar API secrets."""
+
+        secrets = self._document('oauth_clients', 'google_calendar')
+        if not secrets:
+            raise DataError('Missing Google Calendar secrets')
+
+        return secrets
+
+
+# The configuration shared by all instances.
+config = Config()
+
+
 class GoogleCalendarStorage(Storage):
     """Credentials storage for the Google Calendar API using Firestore."""
 
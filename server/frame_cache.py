@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+# The maximum total size in bytes of all cached frames.
+MAX_CACHE_BYTES = 32 * 1024 * 1024  # 32 MB
+
+# The maximum number of cached frames.
+MAX_CACHE_FRAMES = 1000
+
+
+class FrameCache(object):
+    """A least recently used cache of encoded frames, bounded by their total
+    size and number, with a time to live per frame.
+    """
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, max_frames=MAX_CACHE_FRAMES):
+        self._max_bytes = max_bytes
+        self._max_frames = max_frames
+        self._frames = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+
+    def _remove(self, key):
+        """Removes a frame and updates the total size."""
+
+        _, data = self._frames.pop(key)
+        self._bytes -= len(data)
+
+    def get(self, key):
+        """Returns the cached frame data or None if it's missing or expired."""
+
+        with self._lock:
+            try:
+                expiration, data = self._frames[key]
+            except KeyError:
+                return None
+
+            if expiration <= monotonic():
+                self._remove(key)
+                return None
+
+            self._frames.move_to_end(key)
+            return data
+
+    def put(self, key, data, ttl):
+        """Caches the frame data for the time to live in seconds."""
+
+        # Skip frames that would never fit.
+        if len(data) > self._max_bytes:
+            return
+
+        with self._lock:
+            if key in self._frames:
+                self._remove(key)
+            self._frames[key] = (monotonic() + ttl, data)
+            self._bytes += len(data)
+
+            # Evict the least recently used frames until within bounds.
+            while (self._bytes > self._max_bytes or
+                   len(self._frames) > self._max_frames):
+                self._remove(next(iter(self._frames)))
@@ -2,7 +2,7 @@ from astral import GoogleGeocoder
 from cachetools import cached
 from cachetools import TTLCache
 
-from firestore import Firestore
+from firestore import config
 
 # The maximum number of locations kept in the cache.
 MAX_CACHE_SIZE = 100
@@ -15,11 +15,12 @@ class Geocoder(GoogleGeocoder):
     """A version of astral.GoogleGeocoder with a TTLCache."""
 
     def __init__(self):
-        google_maps_api_key = Firestore().google_maps_api_key()
-        GoogleGeocoder.__init__(self, api_key=google_maps_api_key, cache=False)
+        GoogleGeocoder.__init__(self, api_key=None, cache=False)
 
     @cached(cache=TTLCache(maxsize=MAX_CACHE_SIZE, ttl=CACHE_TTL_S))
     def __getitem__(self, key):
+        # Look up the API key on first use instead of at startup.
+        self.api_key = config.google_maps_api_key()
         return GoogleGeocoder.__getitem__(self, key)
 
 
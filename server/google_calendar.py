@@ -5,20 +5,22 @@ from collections import Counter
 from datetime import datetime
 from datetime import timedelta
 from dateutil.parser import parse
-from googleapiclient import discovery
 from googleapiclient.http import build_http
 from logging import warning
 from logging import error
 from oauth2client.client import HttpAccessTokenRefreshError
-from PIL import Image
-from PIL.ImageDraw import Draw
 
+from compositing import load_sprite
+from compositing import new_canvas
+from compositing import stencil
 from firestore import DataError
 from firestore import GoogleCalendarStorage
-from graphics import draw_text
+from graphics import stencil_text
 from graphics import SUBVARIO_CONDENSED_MEDIUM
 from content import ContentError
 from content import ImageContent
+from epd import epd_image
+from epd import epd_indices
 from local_time import LocalTime
 
 # The name of the Google Calendar API.
@@ -60,9 +62,20 @@ DOT_OFFSET = 16
 # The color used to highlight the current day and events.
 HIGHLIGHT_COLOR = (255, 0, 0)
 
+# The colors of the calendar image, which are all close to display colors.
+PALETTE = [BACKGROUND_COLOR, NUMBER_COLOR, HIGHLIGHT_COLOR]
+
 # The maximum number of events to show.
 MAX_EVENTS = 3
 
+# The time to live in seconds for cached frames, which bounds the delay
+# until new events show up.
+FRAME_TTL_S = 15 * 60  # 15 minutes
+
+# The squircle and dot sprites.
+squircle = load_sprite(SQUIRCLE_FILE, PALETTE)
+dot = load_sprite(DOT_FILE, PALETTE)
+
 
 class GoogleCalendar(ImageContent):
     """A monthly calendar backed by the Google Calendar API."""
@@ -89,6 +102,9 @@ class GoogleCalendar(ImageContent):
             error('No valid Google Calendar credentials.')
             return Counter()
         authed_http = credentials.authorize(http=build_http())
+
+        # Import the API discovery on first use, which is slow to load.
+        from googleapiclient import discovery
         service = discovery.build(API_NAME, API_VERSION, http=authed_http,
                                   cache_discovery=False)
 
@@ -140,6 +156,19 @@ class GoogleCalendar(ImageContent):
 
         return event_counts
 
+    def fingerprint(self, user, width, height, variant):
+        """Uses the current date, leaving event changes to the time to live."""
+
+        try:
+            return self._local_time.now(user).date()
+        except DataError as e:
+            raise ContentError(e)
+
+    def frame_ttl(self, fingerprint):
+        """Returns the time to live in seconds for cached calendar frames."""
+
+        return FRAME_TTL_S
+
     def image(self, user, width, height, variant):
         """Generates an image with a calendar view."""
 
@@ -152,10 +181,9 @@ class GoogleCalendar(ImageContent):
         # Get the number of events per day from the API.
         event_counts = self._event_counts(time, user)
 
-        # Create a blank image.
-        image = Image.new(mode='RGB', size=(width, height),
-                          color=BACKGROUND_COLOR)
-        draw = Draw(image)
+        # Create a blank canvas of indices into the display's palette.
+        indices = dict(zip(PALETTE, epd_indices(PALETTE, variant)))
+        canvas = new_canvas(width, height, indices[BACKGROUND_COLOR])
 
         # Get this month's calendar.
         calendar = Calendar(firstweekday=SUNDAY)
@@ -166,6 +194,7 @@ class GoogleCalendar(ImageContent):
         y_stride = height // (len(weeks) + 1)
 
         # Draw each week in a row.
+        numbers = []
         for week_index in range(len(weeks)):
             week = weeks[week_index]
 
@@ -183,35 +212,35 @@ class GoogleCalendar(ImageContent):
 
                 # Mark the current day with a squircle.
                 if day == time.day:
-                    squircle = Image.open(SQUIRCLE_FILE).convert(mode='RGBA')
                     squircle_xy = (x - squircle.width // 2,
                                    y - squircle.height // 2)
-                    draw.bitmap(squircle_xy, squircle, HIGHLIGHT_COLOR)
+                    stencil(canvas, squircle, squircle_xy,
+                            indices[HIGHLIGHT_COLOR])
                     number_color = TODAY_COLOR
                     event_color = TODAY_COLOR
                 else:
                     number_color = NUMBER_COLOR
                     event_color = HIGHLIGHT_COLOR
 
-                # Draw the day of the month number.
-                number = str(day)
-                draw_text(number, SUBVARIO_CONDENSED_MEDIUM, number_color,
-                          xy=(x, y - NUMBER_Y_OFFSET), image=image)
+                # Remember the day of the month number for later.
+                numbers.append((str(day), indices[number_color],
+                                (x, y - NUMBER_Y_OFFSET)))
 
                 # Draw a dot for each event.
                 num_events = min(MAX_EVENTS, event_counts[day])
-                dot = Image.open(DOT_FILE).convert(mode='RGBA')
                 if num_events > 0:
                     events_width = (num_events * dot.width +
                                     (num_events - 1) * DOT_MARGIN)
                     for event_index in range(num_events):
                         event_offset = (event_index * (dot.width +
                                         DOT_MARGIN) - events_width // 2)
-                        dot_xy = [x + event_offset,
-                                  y + DOT_OFFSET - dot.width // 2]
-                        draw.bitmap(dot_xy, dot, event_color)
+                        dot_xy = (x + event_offset,
+                                  y + DOT_OFFSET - dot.width // 2)
+                        stencil(canvas, dot, dot_xy, indices[event_color])
 
-        # The calendar image is already quantized (no dithering).
-        image = image.convert('P', dither=None, palette=Image.ADAPTIVE)
+        # Draw the numbers on top of the squircle.
+        for number, number_color, number_xy in numbers:
+            stencil_text(number, SUBVARIO_CONDENSED_MEDIUM, number_color,
+                         xy=number_xy, canvas=canvas)
 
-        return image
+        return epd_image(canvas, variant)
@@ -1,6 +1,5 @@
 from cachetools import cached
 from cachetools import TTLCache
-from google.cloud import vision
 from io import BytesIO
 from logging import warning
 from PIL import Image
@@ -10,8 +9,8 @@ from requests.exceptions import RequestException
 from urllib.parse import quote
 
 from graphics import SCREENSTAR_SMALL_REGULAR
+from firestore import config
 from firestore import DataError
-from firestore import Firestore
 from graphics import draw_text
 from local_time import LocalTime
 
@@ -46,20 +45,28 @@ MAX_CACHE_SIZE = 100
 CACHE_TTL_S = 24 * 60 * 60  # 1 day
 
 
+@cached(cache={})
+def _vision_client():
+    """Creates the Cloud Vision client on first use, shared by all
+    instances. The library is slow to load, so it's imported here.
+    """
+
+    from google.cloud import vision
+    return vision.ImageAnnotatorClient()
+
+
 class GoogleMaps(object):
     """A wrapper around the Google Static Map and Directions APIs."""
 
     def __init__(self, geocoder):
-        self._google_maps_api_key = Firestore().google_maps_api_key()
         self._local_time = LocalTime(geocoder)
-        self._vision_client = vision.ImageAnnotatorClient()
 
     def _static_map_url(self, width, height, polyline=None, markers=None,
                         marker_icon=None, hide_map=False):
         """Constructs the URL for the Static Map API request."""
 
         url = STATIC_MAP_URL
-        url += '?key=%s' % self._google_maps_api_key
+        url += '?key=%s' % config.google_maps_api_key()
         url += '&size=%dx%d' % (width, height)
         url += '&scale=1'
         url += '&maptype=roadmap'
@@ -119,9 +126,10 @@ class GoogleMaps(object):
                                         hide_map=True)
 
         # Make a request to the Vision API.
+        from google.cloud import vision
         with BytesIO(image_data) as buffer:
             request_image = vision.Image(content=buffer.getvalue())
-            response = self._vision_client.document_text_detection(
+            response = _vision_client().document_text_detection(
                 image=request_image)
 
         # Parse all recognized text for the copyright.
@@ -182,7 +190,7 @@ class GoogleMaps(object):
             raise DataError('Missing travel mode')
 
         url = DIRECTIONS_URL
-        url += '?key=%s' % self._google_maps_api_key
+        url += '?key=%s' % config.google_maps_api_key()
         url += '&origin=%s' % quote(home)
         url += '&destination=%s' % quote(work)
         url += '&mode=%s' % travel_mode
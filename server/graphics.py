@@ -1,5 +1,16 @@
+from cachetools import cached
+from cachetools import LRUCache
+from numpy import array
+from numpy import zeros
+from PIL import Image
 from PIL import ImageFont
 from PIL.ImageDraw import Draw
+from string import ascii_letters
+from string import digits
+from string import punctuation
+
+from compositing import Sprite
+from compositing import stencil
 
 # The FF SubVario Condensed Medium pixel font.
 SUBVARIO_CONDENSED_MEDIUM = {
@@ -24,28 +35,168 @@ SCREENSTAR_SMALL_REGULAR = {
     }
 }
 
+# The characters whose widths and glyphs are prepared up front for each font.
+COMMON_CHARACTERS = ' ' + ascii_letters + digits + punctuation
 
-def draw_text(text, font_spec, text_color, xy=None, anchor=None,
-              box_color=None, box_padding=0, border_color=None, border_width=0,
-              image=None, draw=None):
-    """Draws centered text on an image, optionally in a box."""
+# The font rendering mode without anti-aliasing, used for palette images.
+BITMAP_FONT_MODE = '1'
 
-    if not draw:
-        draw = Draw(image)
-    text_size = font_spec['size']
-    font = ImageFont.truetype(font_spec['file'], size=text_size)
+# The maximum number of strings set from glyph atlases to keep in memory.
+MAX_CACHED_TEXTS = 1024
+
+
+@cached(cache={})
+def _font(file, size):
+    """Loads a font file once for each size."""
+
+    return ImageFont.truetype(file, size=size)
+
+
+def _widths_key(font_spec, mode=BITMAP_FONT_MODE):
+    """Identifies the font and width overrides of a font spec and the font
+    rendering mode.
+    """
+
+    return (font_spec['file'], font_spec['size'], mode,
+            tuple(sorted(font_spec['width_overrides'].items())))
+
+
+@cached(cache={}, key=_widths_key)
+def _character_widths(font_spec, mode):
+    """Builds a table of character widths for a font spec and font rendering
+    mode, with the width overrides applied. Other characters are added when
+    they are first measured.
+    """
+
+    font = _font(font_spec['file'], font_spec['size'])
+    character_widths = {character: font.getlength(character, mode)
+                        for character in COMMON_CHARACTERS}
+    character_widths.update(font_spec['width_overrides'])
 
-    # Measure the width of each character.
-    character_widths = []
+    return character_widths
+
+
+def _text_widths(text, font_spec, mode):
+    """Looks up the width of each character, measuring any new ones."""
+
+    widths = _character_widths(font_spec, mode)
+    text_widths = []
     for character in text:
-        # Override the measured width, if specified.
-        width_overrides = font_spec['width_overrides']
-        if character in width_overrides.keys():
-            character_width = width_overrides[character]
-        else:
-            character_width = draw.textlength(character, font)
-        character_widths.append(character_width)
-    text_width = sum(character_widths)
+        try:
+            character_width = widths[character]
+        except KeyError:
+            font = _font(font_spec['file'], font_spec['size'])
+            character_width = font.getlength(character, mode)
+            widths[character] = character_width
+        text_widths.append(character_width)
+
+    return text_widths
+
+
+class TextBitmap(object):
+    """A string set from a glyph atlas as a 1-bit mask, both as a sprite and
+    as an image, with the offset of its top left corner from the position the
+    text is drawn at.
+    """
+
+    def __init__(self, mask, left, top):
+        self.sprite = Sprite(None, mask)
+        self.image = Image.fromarray(mask) if mask.size else None
+        self.left = left
+        self.top = top
+
+
+class GlyphAtlas(object):
+    """The glyphs of a pixel font spec, rasterized once into 1-bit masks. Text
+    set from them is pixel-identical to drawing it one character at a time
+    without anti-aliasing at whole pixel positions.
+    """
+
+    def __init__(self, font_spec):
+        self._font_spec = font_spec
+        self._font = _font(font_spec['file'], font_spec['size'])
+        self._glyphs = {character: self._rasterize(character)
+                        for character in COMMON_CHARACTERS}
+
+    def _rasterize(self, character):
+        """Draws a character into a 1-bit mask. Returns the mask and the
+        offset of its top left corner from the drawing position.
+        """
+
+        left, top, right, bottom = self._font.getbbox(character,
+                                                      BITMAP_FONT_MODE)
+        bitmap = Image.new('1', (max(right - left, 0), max(bottom - top, 0)))
+        if bitmap.width and bitmap.height:
+            Draw(bitmap).text((-left, -top), character, 1, self._font)
+
+        return array(bitmap, dtype=bool), left, top
+
+    def glyph(self, character):
+        """Returns the mask of a character and its offset, rasterizing any new
+        ones.
+        """
+
+        try:
+            return self._glyphs[character]
+        except KeyError:
+            glyph = self._rasterize(character)
+            self._glyphs[character] = glyph
+            return glyph
+
+    def text(self, text):
+        """Sets a string from the glyphs, or returns None if any of the
+        character widths is not a whole number of pixels.
+        """
+
+        # Place each glyph at its pen position.
+        placements = []
+        pen = 0
+        for character, width in zip(text, _text_widths(text, self._font_spec,
+                                                       BITMAP_FONT_MODE)):
+            mask, left, top = self.glyph(character)
+            if mask.size:
+                placements.append((mask, pen + left, top))
+            if width != int(width):
+                return None
+            pen += int(width)
+
+        if not placements:
+            return TextBitmap(zeros((0, 0), dtype=bool), 0, 0)
+
+        # Combine the glyphs into one mask covering all of them.
+        left = min(x for _, x, _ in placements)
+        top = min(y for _, _, y in placements)
+        right = max(x + mask.shape[1] for mask, x, _ in placements)
+        bottom = max(y + mask.shape[0] for mask, _, y in placements)
+        text_mask = zeros((bottom - top, right - left), dtype=bool)
+        for mask, x, y in placements:
+            mask_height, mask_width = mask.shape
+            text_mask[y - top:y - top + mask_height,
+                      x - left:x - left + mask_width] |= mask
+
+        return TextBitmap(text_mask, left, top)
+
+
+@cached(cache={}, key=_widths_key)
+def _atlas(font_spec):
+    """Builds the glyph atlas of a font spec once."""
+
+    return GlyphAtlas(font_spec)
+
+
+@cached(cache=LRUCache(maxsize=MAX_CACHED_TEXTS),
+        key=lambda text, font_spec: (text,) + _widths_key(font_spec))
+def _text_bitmap(text, font_spec):
+    """Sets a string from the glyph atlas of a font spec."""
+
+    return _atlas(font_spec).text(text)
+
+
+def _text_xy(text_width, font_spec, xy, anchor, box_padding, border_width,
+             width, height):
+    """Calculates the top left corner of text in an image of the given size,
+    from the coordinates of its center or an anchor.
+    """
 
     # If any xy is specified, use it.
     text_height = font_spec['height']
@@ -55,15 +206,32 @@ def draw_text(text, font_spec, text_color, xy=None, anchor=None,
 
     # If any anchor is specified, adjust the xy.
     if anchor == 'center':
-        x = image.width // 2 - text_width // 2
-        y = image.height // 2 - text_height // 2
+        x = width // 2 - text_width // 2
+        y = height // 2 - text_height // 2
     elif anchor == 'center_x':
-        x = image.width // 2 - text_width // 2
+        x = width // 2 - text_width // 2
     elif anchor == 'center_y':
-        y = image.height // 2 - text_height // 2
+        y = height // 2 - text_height // 2
     elif anchor == 'bottom_right':
-        x = image.width - box_padding - border_width - text_width
-        y = image.height - box_padding - border_width - text_height
+        x = width - box_padding - border_width - text_width
+        y = height - box_padding - border_width - text_height
+
+    return x, y
+
+
+def draw_text(text, font_spec, text_color, xy=None, anchor=None,
+              box_color=None, box_padding=0, border_color=None, border_width=0,
+              image=None, draw=None):
+    """Draws centered text on an image, optionally in a box."""
+
+    if not draw:
+        draw = Draw(image)
+
+    character_widths = _text_widths(text, font_spec, draw.fontmode)
+    text_width = sum(character_widths)
+    text_height = font_spec['height']
+    x, y = _text_xy(text_width, font_spec, xy, anchor, box_padding,
+                    border_width, image.width, image.height)
 
     # Draw the box background and border.
     box_xy = [x - box_padding,
@@ -79,8 +247,20 @@ def draw_text(text, font_spec, text_color, xy=None, anchor=None,
     if box_color:
         draw.rectangle(box_xy, box_color)
 
-    # Draw the text character by character.
+    # Paste the text from the glyph atlas at whole pixel positions without
+    # anti-aliasing.
     y -= font_spec['y_offset']
+    if draw.fontmode == BITMAP_FONT_MODE and x == int(x) and y == int(y):
+        text_bitmap = _text_bitmap(text, font_spec)
+        if text_bitmap:
+            if text_bitmap.image:
+                image.paste(text_color, (int(x) + text_bitmap.left,
+                                         int(y) + text_bitmap.top),
+                            text_bitmap.image)
+            return border_xy
+
+    # Otherwise, draw the text character by character.
+    font = _font(font_spec['file'], font_spec['size'])
     for index in range(len(text)):
         character = text[index]
         draw.text((x, y), character, text_color, font)
@@ -88,3 +268,22 @@ def draw_text(text, font_spec, text_color, xy=None, anchor=None,
 
     # Return the bounding box for layout calculations.
     return border_xy
+
+
+def stencil_text(text, font_spec, text_index, xy=None, anchor=None,
+                 canvas=None):
+    """Draws centered text from the glyph atlas onto a canvas of palette
+    indices, at whole pixel positions.
+    """
+
+    text_bitmap = _text_bitmap(text, font_spec)
+    if not text_bitmap:
+        raise ValueError('Unsupported text for glyph atlas: %s' % text)
+
+    text_width = sum(_text_widths(text, font_spec, BITMAP_FONT_MODE))
+    height, width = canvas.shape
+    x, y = _text_xy(text_width, font_spec, xy, anchor, 0, 0, width, height)
+    y -= font_spec['y_offset']
+    stencil(canvas, text_bitmap.sprite, (int(x) + text_bitmap.left,
+                                         int(y) + text_bitmap.top),
+            text_index)
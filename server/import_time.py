@@ -0,0 +1,69 @@
+# To check the time it takes to import the server against the budget, run:
+# $ python import_time.py
+
+from subprocess import run
+from sys import executable
+
+# The module whose import time is measured.
+MAIN_MODULE = 'main'
+
+# The maximum time in milliseconds to import the server.
+IMPORT_BUDGET_MS = 1000
+
+# Modules that are slow to load and only imported on first use.
+LAZY_MODULES = ['artwork', 'city', 'city_assets', 'commute', 'everyone',
+                'firebase_admin', 'google.cloud.firestore',
+                'google.cloud.vision', 'google_calendar', 'google_maps',
+                'googleapiclient.discovery', 'scipy', 'wittgenstein']
+
+# The number of slowest modules to show in the report.
+REPORT_MODULES = 20
+
+
+def _import_times(module):
+    """Imports the module in a fresh process and parses the cumulative time
+    in microseconds for each imported module from -X importtime.
+    """
+
+    process = run([executable, '-X', 'importtime', '-c', 'import %s' % module],
+                  capture_output=True, text=True, check=True)
+
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        try:
+            times[name.strip()] = int(cumulative)
+        except ValueError:
+            # Skip the header.
+            continue
+
+    return times
+
+
+def _check():
+    """Reports the slowest imports and checks them against the budget."""
+
+    times = _import_times(MAIN_MODULE)
+
+    slowest = sorted(times.items(), key=lambda x: x[1], reverse=True)
+    for name, cumulative in slowest[:REPORT_MODULES]:
+        print('%8.1f ms  %s' % (cumulative / 1000, name))
+
+    eager = [name for name in LAZY_MODULES if name in times]
+    if eager:
+        raise ValueError('Lazy modules imported eagerly: %s' %
+                         ', '.join(eager))
+
+    total_ms = times[MAIN_MODULE] / 1000
+    if total_ms > IMPORT_BUDGET_MS:
+        raise ValueError('Import time over budget: %.1f ms > %d ms' % (
+            total_ms, IMPORT_BUDGET_MS))
+
+    print('Import time: %.1f ms (budget: %d ms)' % (total_ms,
+                                                    IMPORT_BUDGET_MS))
+
+
+if __name__ == '__main__':
+    _check()
@@ -7,7 +7,9 @@ from firestore import DataError
 
 
 class LocalTime(object):
-    """A wrapper around the current time in the user's time zone."""
+    """A wrapper around the current time in the user's time zone. Values are
+    memoized in the user's RenderContext for the duration of the request.
+    """
 
     def __init__(self, geocoder):
         self._geocoder = geocoder
@@ -20,18 +22,34 @@ class LocalTime(object):
     def now(self, user):
         """Calculates the current localized date and time."""
 
-        now = self.utc_now().astimezone(self.zone(user))
-
-        return now
+        return user.memoize('now', lambda: self.utc_now().astimezone(
+            self.zone(user)))
 
     def zone(self, user):
         """Returns the time zone at the user's home address."""
 
+        return user.memoize('zone', lambda: self._zone(user))
+
+    def _zone(self, user):
+        """Looks up the time zone at the user's home address."""
+
+        try:
+            return timezone(self.location(user).timezone)
+        except (AstralError, KeyError) as e:
+            raise DataError(e)
+
+    def location(self, user):
+        """Returns the location of the user's home address."""
+
+        return user.memoize('location', lambda: self._location(user))
+
+    def _location(self, user):
+        """Looks up the location of the user's home address."""
+
         try:
             home = user.get('home')
             if not home:
                 raise DataError('Missing home address')
-            location = self._geocoder[home]
-            return timezone(location.timezone)
+            return self._geocoder[home]
         except (AstralError, KeyError) as e:
             raise DataError(e)
@@ -8,21 +8,17 @@ from logging import exception
 from oauth2client.client import HttpAccessTokenRefreshError
 from time import time
 
-from artwork import Artwork
 from auth import ACCOUNT_ACCESS_URL
 from auth import google_calendar_step1
 from auth import next_retry_response
 from auth import oauth_step2
 from auth import user_auth
 from auth import validate_key
-from city import City
-from commute import Commute
 from content import ContentError
-from everyone import Everyone
+from content import ContentRegistry
 from firestore import Firestore
 from firestore import GoogleCalendarStorage
 from geocoder import Geocoder
-from google_calendar import GoogleCalendar
 from response import content_response
 from response import display_metadata
 from response import epd_response
@@ -30,7 +26,6 @@ from response import gif_response
 from response import settings_url
 from response import text_response
 from schedule import Schedule
-from wittgenstein import Wittgenstein
 
 # The URL of the Medium story about Accent.
 INFO_URL = ('https://medium.com/@maxbraun/meet-accent-352cfa95813a'
@@ -48,17 +43,18 @@ SOCIAL_URL = 'https://twitter.com/AccentInk'
 # The template for editing user data.
 HELLO_TEMPLATE = 'hello.html'
 
+# The response header with the milliseconds until the next image, which saves
+# clients a separate request to the next endpoint.
+NEXT_DELAY_HEADER = 'X-Next-Delay-Ms'
+
 # A geocoder instance with a shared cache.
 geocoder = Geocoder()
 
+# The image content instances, loaded on first use.
+contents = ContentRegistry(geocoder)
+
 # Helper library instances.
-artwork = Artwork()
-calendar = GoogleCalendar(geocoder)
-city = City(geocoder)
-commute = Commute(geocoder)
-everyone = Everyone(geocoder)
-schedule = Schedule(geocoder)
-wittgenstein = Wittgenstein()
+schedule = Schedule(geocoder, contents)
 
 # The Flask app handling requests.
 app = Flask(__name__)
@@ -70,8 +66,8 @@ def artwork_gif(key=None, user=None):
     """Responds with a GIF version of the artwork image."""
 
     width, height, variant = display_metadata(request)
-    return content_response(artwork, gif_response, user, width, height,
-                            variant)
+    return content_response(contents.get('artwork'), gif_response, user,
+                            width, height, variant)
 
 
 @app.route('/city')
@@ -80,7 +76,8 @@ def city_gif(key=None, user=None):
     """Responds with a GIF version of the city image."""
 
     width, height, variant = display_metadata(request)
-    return content_response(city, gif_response, user, width, height, variant)
+    return content_response(contents.get('city'), gif_response, user,
+                            width, height, variant)
 
 
 @app.route('/commute')
@@ -89,8 +86,8 @@ def commute_gif(key=None, user=None):
     """Responds with a GIF version of the commute image."""
 
     width, height, variant = display_metadata(request)
-    return content_response(commute, gif_response, user, width, height,
-                            variant)
+    return content_response(contents.get('commute'), gif_response, user,
+                            width, height, variant)
 
 
 @app.route('/calendar')
@@ -99,8 +96,8 @@ def calendar_gif(key=None, user=None):
     """Responds with a GIF version of the calendar image."""
 
     width, height, variant = display_metadata(request)
-    return content_response(calendar, gif_response, user, width, height,
-                            variant)
+    return content_response(contents.get('calendar'), gif_response, user,
+                            width, height, variant)
 
 
 @app.route('/everyone')
@@ -109,8 +106,8 @@ def everyone_gif(key=None, user=None):
     """Responds with a GIF version of the everyone image."""
 
     width, height, variant = display_metadata(request)
-    return content_response(everyone, gif_response, user, width, height,
-                            variant)
+    return content_response(contents.get('everyone'), gif_response, user,
+                            width, height, variant)
 
 
 @app.route('/wittgenstein')
@@ -119,8 +116,8 @@ def wittgenstein_gif(key=None, user=None):
     """Responds with a GIF version of the wittgenstein image."""
 
     width, height, variant = display_metadata(request)
-    return content_response(wittgenstein, gif_response, user, width, height,
-                            variant)
+    return content_response(contents.get('wittgenstein'), gif_response, user,
+                            width, height, variant)
 
 
 @app.route('/gif')
@@ -136,17 +133,31 @@ def gif(key=None, user=None):
 @app.route('/epd')
 @user_auth(image_response=epd_response)
 def epd(key=None, user=None):
-    """Responds with an e-paper display version of the scheduled image."""
+    """Responds with an e-paper display version of the scheduled image and
+    the delay until the next one.
+    """
 
     width, height, variant = display_metadata(request)
-    return content_response(schedule, epd_response, user, width, height,
-                            variant)
+    response = content_response(schedule, epd_response, user, width, height,
+                                variant)
+
+    # Add the delay, reusing the lookups for the image. Without it, clients
+    # fall back to the next endpoint.
+    try:
+        milliseconds = schedule.delay(user)
+        response.headers[NEXT_DELAY_HEADER] = str(milliseconds)
+    except ContentError as e:
+        exception('Failed to create next content: %s' % e)
+
+    return response
 
 
 @app.route('/next')
 @user_auth(bad_response=next_retry_response)
 def next(key=None, user=None):
-    """Responds with the milliseconds until the next image."""
+    """Responds with the milliseconds until the next image. Newer clients
+    read them from the e-paper display response instead.
+    """
 
     try:
         milliseconds = schedule.delay(user)
@@ -240,7 +251,7 @@ def hello_post(key):
 def _empty_timeline_response():
     """Responds with an empty schedule timeline image."""
 
-    image = schedule.empty_timeline()
+    image = schedule.empty_timeline('bwr')
     return gif_response(image, 'bwr')
 
 
@@ -249,7 +260,7 @@ def _empty_timeline_response():
 def timeline(key=None, user=None):
     """Responds with a schedule timeline image for the user."""
 
-    image = schedule.timeline(user)
+    image = schedule.timeline(user, 'bwr')
     return gif_response(image, 'bwr')
 
 
@@ -0,0 +1,56 @@
+from collections import Counter
+from logging import info
+
+
+class RenderContext(object):
+    """A wrapper around a user snapshot for the duration of one request. It
+    memoizes values derived from the user's data, like the location, time
+    zone, current time, daylight and weather, so that each is looked up at most
+    once per request. It can be used wherever a user snapshot is expected.
+    """
+
+    def __init__(self, user):
+        self._user = user
+        self._values = {}
+        self._lookups = Counter()
+        self._reuses = 0
+
+    @property
+    def id(self):
+        """The key of the user."""
+
+        return self._user.id
+
+    def get(self, field):
+        """Retrieves a field of the user's data."""
+
+        return self._user.get(field)
+
+    def memoize(self, key, function):
+        """Returns the value for the key, calling the function to look it up
+        only the first time. The key is either a name or a tuple starting with
+        a name followed by arguments.
+        """
+
+        try:
+            value = self._values[key]
+            self._reuses += 1
+            return value
+        except KeyError:
+            pass
+
+        # Count the lookups by name, including any failing ones.
+        name = key[0] if isinstance(key, tuple) else key
+        self._lookups[name] += 1
+        value = function()
+        self._values[key] = value
+
+        return value
+
+    def log_lookups(self):
+        """Logs how many lookups were performed during the request."""
+
+        lookups = ', '.join('%s: %d' % (name, count) for name, count in
+                            sorted(self._lookups.items()))
+        info('Request lookups: %d (%s), reused: %d' % (
+            sum(self._lookups.values()), lookups, self._reuses))
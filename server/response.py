@@ -1,20 +1,36 @@
+from flask import request
 from flask import Response
 from flask import send_file
 from flask import url_for
+from hashlib import blake2b
 from io import BytesIO
 from logging import exception
+from logging import info
 from logging import warning
-from PIL import Image
+from numpy import array
+from numpy import uint8
 
+from compositing import blit
+from compositing import load_sprite
+from compositing import new_canvas
+from compositing import Sprite
 from content import ContentError
 from epd import adjust_xy
+from epd import epd_image
+from epd import epd_indices
 from epd import to_epd_bytes
 from epd import to_epd_image
+from epd import to_epd_strips
 from epd import DEFAULT_DISPLAY_HEIGHT
 from epd import DEFAULT_DISPLAY_WIDTH
 from epd import DEFAULT_DISPLAY_VARIANT
+from epd import DEFAULT_DITHER
+from epd import DEFAULT_EPD_ENCODING
 from epd import DISPLAY_VARIANTS
-from graphics import draw_text
+from epd import DITHER_MODES
+from epd import EPD_ENCODINGS
+from frame_cache import FrameCache
+from graphics import stencil_text
 from graphics import SUBVARIO_CONDENSED_MEDIUM
 
 # The color of the new user image background.
@@ -32,25 +48,149 @@ COMPUTER_XY = (296, 145)
 # The position of the link text in the settings image.
 LINK_TEXT_XY = (0, 228)
 
+# The colors of the settings image, including the colors of the computer,
+# which are all close to display colors.
+SETTINGS_PALETTE = [BACKGROUND_COLOR, TEXT_COLOR, (0, 0, 0)]
 
-def gif_response(image, variant):
-    """Creates a Flask GIF response from the specified image."""
+# The MIME type of GIF responses.
+GIF_MIME_TYPE = 'image/gif'
+
+# The MIME type of e-paper display responses.
+EPD_MIME_TYPE = 'application/octet-stream'
+
+# The size in bytes of the hash used as the ETag of image data.
+ETAG_DIGEST_SIZE = 16
+
+# A cache of encoded frames shared across requests.
+frame_cache = FrameCache()
+
+# The sprite of the computer in the settings image.
+computer = load_sprite(COMPUTER_FILE, SETTINGS_PALETTE)
+
+
+def _dither_mode(preferred):
+    """Chooses the dithering mode from the request or the content's
+    preference.
+    """
+
+    # Let the request override the content's preference.
+    dither = request.args.get('dither')
+    if dither in DITHER_MODES:
+        return dither
+    if dither:
+        warning('Invalid dithering mode: %s' % dither)
+
+    return preferred
+
+
+def _image_dither_mode(image):
+    """Chooses the dithering mode from the request or the image."""
+
+    return _dither_mode(image.info.get('dither', DEFAULT_DITHER))
+
+
+def _epd_encoding():
+    """Chooses the display data encoding requested by the client."""
+
+    encoding = request.args.get('encoding')
+    if encoding in EPD_ENCODINGS:
+        return encoding
+    if encoding:
+        warning('Invalid display encoding: %s' % encoding)
+
+    return DEFAULT_EPD_ENCODING
+
+
+def _stream_requested():
+    """Checks if the client requested a streaming response."""
+
+    return request.args.get('stream') in ['1', 'true']
+
+
+def _gif_data(image, variant):
+    """Encodes the image as GIF data."""
 
     buffer = BytesIO()
-    image = to_epd_image(image, variant)
+    image = to_epd_image(image, variant, dither=_image_dither_mode(image))
     image.save(buffer, format='gif')
-    buffer.seek(0)
 
-    return send_file(buffer, mimetype='image/gif', max_age=0)
+    return buffer.getvalue()
+
+
+def _epd_data(image, variant):
+    """Encodes the image as e-paper display data."""
+
+    return to_epd_bytes(image, variant, dither=_image_dither_mode(image),
+                        encoding=_epd_encoding())
+
+
+def _epd_strips(image, variant):
+    """Encodes the image as e-paper display data one strip at a time."""
+
+    return to_epd_strips(image, variant, dither=_image_dither_mode(image),
+                         encoding=_epd_encoding())
+
+
+def _data_response(data, mimetype):
+    """Creates a Flask response from encoded image data. The data's hash is
+    used as a strong ETag, so clients sending a matching If-None-Match header
+    get an empty 304 Not Modified response instead.
+    """
+
+    buffer = BytesIO(data)
+    etag = blake2b(data, digest_size=ETAG_DIGEST_SIZE).hexdigest()
+
+    return send_file(buffer, mimetype=mimetype, max_age=0, etag=etag)
+
+
+def _stream_response(chunks, mimetype):
+    """Creates a Flask response sending chunks of encoded image data as they
+    become available. Without the complete data up front, there is no ETag.
+    """
+
+    response = Response(chunks, mimetype=mimetype)
+    response.cache_control.no_cache = True
+    response.cache_control.max_age = 0
+
+    return response
+
+
+def _cached_chunks(chunks, key, ttl):
+    """Passes through chunks of frame data and caches the complete frame."""
+
+    data = []
+    for chunk in chunks:
+        data.append(chunk)
+        yield chunk
+
+    frame_cache.put(key, b''.join(data), ttl)
+
+
+def gif_response(image, variant):
+    """Creates a Flask GIF response from the specified image."""
+
+    return _data_response(_gif_data(image, variant), GIF_MIME_TYPE)
 
 
 def epd_response(image, variant):
     """Creates a Flask e-paper display response from the specified image."""
 
-    data = to_epd_bytes(image, variant)
-    buffer = BytesIO(data)
+    if _stream_requested():
+        return _stream_response(_epd_strips(image, variant), EPD_MIME_TYPE)
+
+    return _data_response(_epd_data(image, variant), EPD_MIME_TYPE)
 
-    return send_file(buffer, mimetype='application/octet-stream', max_age=0)
+
+def _frame_format(image_response):
+    """Returns the encoder and MIME type used by the image response."""
+
+    if image_response == gif_response:
+        return _gif_data, GIF_MIME_TYPE
+    elif image_response == epd_response:
+        return _epd_data, EPD_MIME_TYPE
+    else:
+        raise ValueError('Unsupported image response: %s' %
+                         image_response.__name__)
 
 
 def text_response(text):
@@ -74,27 +214,66 @@ def settings_url(key):
 def settings_response(key, image_func, width, height, variant):
     """Creates an image response to start the new user flow."""
 
-    # Draw the image with the link text and a computer.
-    image = Image.new(mode='RGB', size=(width, height), color=BACKGROUND_COLOR)
-    draw_text(settings_url(key),
-              font_spec=SUBVARIO_CONDENSED_MEDIUM,
-              text_color=TEXT_COLOR,
-              xy=adjust_xy(*LINK_TEXT_XY, width, height),
-              anchor='center_x',
-              image=image)
-    computer = Image.open(COMPUTER_FILE).convert(mode='RGBA')
-    image.paste(computer, box=adjust_xy(*COMPUTER_XY, width, height),
-                mask=computer)
+    # Draw the image with a computer and the link text, using indices into
+    # the display's palette.
+    remap = array(epd_indices(SETTINGS_PALETTE, variant), dtype=uint8)
+    canvas = new_canvas(width, height,
+                        remap[SETTINGS_PALETTE.index(BACKGROUND_COLOR)])
+    blit(canvas, Sprite(remap[computer.indices], computer.mask),
+         adjust_xy(*COMPUTER_XY, width, height))
+    stencil_text(settings_url(key),
+                 font_spec=SUBVARIO_CONDENSED_MEDIUM,
+                 text_index=remap[SETTINGS_PALETTE.index(TEXT_COLOR)],
+                 xy=adjust_xy(*LINK_TEXT_XY, width, height),
+                 anchor='center_x',
+                 canvas=canvas)
+
+    return image_func(epd_image(canvas, variant), variant)
+
+
+def _frame_response(content, image_response, user, width, height, variant):
+    """Creates an image response, reusing the cached frame if the content's
+    fingerprint is unchanged.
+    """
+
+    # Skip the cache for content without a fingerprint.
+    fingerprint = content.fingerprint(user, width, height, variant)
+    if fingerprint is None:
+        image = content.image(user, width, height, variant)
+        return image_response(image, variant)
+
+    # Key the frame by everything that goes into the encoded data, using the
+    # resolved options, so that equivalent requests share frames.
+    encode, mimetype = _frame_format(image_response)
+    dither = _dither_mode(content.dither_mode(fingerprint))
+    encoding = _epd_encoding() if image_response == epd_response else None
+    key = (user.id, content.__class__.__name__, image_response.__name__,
+           width, height, variant, dither, encoding, fingerprint)
+    data = frame_cache.get(key)
+    if data is not None:
+        info('Using cached %s frame.' % content.__class__.__name__)
+        return _data_response(data, mimetype)
+
+    image = content.image(user, width, height, variant)
+    ttl = content.frame_ttl(fingerprint)
+
+    # Cache streamed display data once the last strip has been sent.
+    if image_response == epd_response and _stream_requested():
+        strips = _cached_chunks(_epd_strips(image, variant), key, ttl)
+        return _stream_response(strips, mimetype)
 
-    return image_func(image, variant)
+    data = encode(image, variant)
+    frame_cache.put(key, data, ttl)
+
+    return _data_response(data, mimetype)
 
 
 def content_response(content, image_response, user, width, height, variant):
     """Creates an image response and handles the error case flow."""
 
     try:
-        image = content.image(user, width, height, variant)
-        return image_response(image, variant)
+        return _frame_response(content, image_response, user, width, height,
+                               variant)
     except ContentError as e:
         exception('Failed to create %s content: %s' % (
             content.__class__.__name__, e))
@@ -1,25 +1,26 @@
+from bisect import bisect_left
+from bisect import bisect_right
+from cachetools import cached
+from cachetools import TTLCache
 from calendar import day_abbr
-from croniter import croniter
 from datetime import datetime
 from datetime import timedelta
 from logging import error
 from logging import info
-from PIL import Image
+from numpy import array
+from numpy import uint8
 from PIL.ImageDraw import Draw
 
-from artwork import Artwork
-from google_calendar import GoogleCalendar
 from graphics import draw_text
 from graphics import SCREENSTAR_SMALL_REGULAR
-from city import City
-from commute import Commute
 from content import ContentError
+from compositing import new_canvas
 from content import ImageContent
-from everyone import Everyone
+from epd import epd_image
+from epd import epd_indices
 from firestore import DataError
 from local_time import LocalTime
 from sun import Sun
-from wittgenstein import Wittgenstein
 
 # The client sleep duration may be early by a few minutes, so we add a buffer
 # to avoid waking up twice in a row.
@@ -49,6 +50,65 @@ TIMELINE_LINE_WIDTH = 1
 # The dash length of lines drawn in the timeline.
 TIMELINE_LINE_DASH = 2
 
+# The number of days before the current local date covered by a compiled
+# schedule, which includes the beginning of the week for the timeline.
+COMPILED_PAST_DAYS = 7
+
+# The number of days after the current local date covered by a compiled
+# schedule.
+COMPILED_FUTURE_DAYS = 8
+
+# The maximum number of compiled schedules to keep in memory.
+MAX_CACHED_SCHEDULES = 1000
+
+# The time to live in seconds for compiled schedules.
+SCHEDULE_CACHE_TTL_S = 24 * 60 * 60  # 1 day
+
+
+class Transitions(object):
+    """The start times of schedule entries, sorted for binary searches. Each
+    transition is a tuple of the start time, the index of the entry, and the
+    entry. Entries starting at the same time are ordered by index.
+    """
+
+    def __init__(self, transitions):
+        self._transitions = sorted(transitions, key=lambda x: x[:2])
+        self._times = [transition[0] for transition in self._transitions]
+
+    def latest(self, time):
+        """Finds the most recent transition at or before the time."""
+
+        index = bisect_right(self._times, time)
+        if index == 0:
+            raise ContentError('No past schedule entry')
+
+        # Use the first of any entries starting at the same time.
+        return self._transitions[bisect_left(self._times,
+                                             self._times[index - 1])]
+
+    def following(self, time):
+        """Finds the next transition after the time."""
+
+        index = bisect_right(self._times, time)
+        if index == len(self._times):
+            raise ContentError('No future schedule entry')
+
+        return self._transitions[index]
+
+    def between(self, start, stop):
+        """Lists the transitions after the start, up to and including the
+        first one at or after the stop, with the first entry for each time.
+        """
+
+        transitions = []
+        time = start
+        while time < stop:
+            transition = self.following(time)
+            transitions.append(transition)
+            time = transition[0]
+
+        return transitions
+
 
 class Schedule(ImageContent):
     """A database-backed schedule determining which images to show at request
@@ -65,74 +125,99 @@ class Schedule(ImageContent):
              'wittgenstein'.
     """
 
-    def __init__(self, geocoder):
+    def __init__(self, geocoder, contents):
         self._local_time = LocalTime(geocoder)
         self._sun = Sun(geocoder)
-        self._artwork = Artwork()
-        self._city = City(geocoder)
-        self._commute = Commute(geocoder)
-        self._calendar = GoogleCalendar(geocoder)
-        self._everyone = Everyone(geocoder)
-        self._wittgenstein = Wittgenstein()
 
-    def _next(self, cron, after, user):
-        """Finds the next time matching the cron expression."""
+        # Share the content instances and their caches with the endpoints
+        # that show them directly.
+        self._contents = contents
 
-        try:
-            cron = self._sun.rewrite_cron(cron, after, user)
-        except DataError as e:
-            raise ContentError(e)
+    def _content(self, kind):
+        """Looks up the image content based on the kind."""
 
-        try:
-            return croniter(cron, after).get_next(datetime)
-        except ValueError as e:
-            raise ContentError(e)
+        content = self._contents.get(kind)
+        if not content:
+            error('Unknown image kind: %s' % kind)
+
+        return content
 
     def _image(self, kind, user, width, height, variant):
         """Creates an image based on the kind."""
 
-        if kind == 'artwork':
-            content = self._artwork
-        elif kind == 'city':
-            content = self._city
-        elif kind == 'commute':
-            content = self._commute
-        elif kind == 'calendar':
-            content = self._calendar
-        elif kind == 'everyone':
-            content = self._everyone
-        elif kind == 'wittgenstein':
-            content = self._wittgenstein
-        else:
-            error('Unknown image kind: %s' % kind)
+        content = self._content(kind)
+        if not content:
             return None
 
         return content.image(user, width, height, variant)
 
-    def image(self, user, width, height, variant):
-        """Generates the current image based on the schedule."""
+    def _transitions(self, user):
+        """Returns the compiled transitions of the user's schedule around the
+        current local date.
+        """
 
-        # Find the current schedule entry by parsing the cron expressions.
         try:
             time = self._local_time.now(user)
         except DataError as e:
             raise ContentError(e)
+        entries = user.get('schedule')
+        if not entries:
+            raise ContentError('Empty schedule')
+
+        # Recompile when the schedule or the home address changes, or on the
+        # next day.
         today = time.replace(hour=0, minute=0, second=0, microsecond=0)
-        while True:
-            entries = [(self._next(entry['start'], today, user), entry)
-                       for entry in user.get('schedule')]
-            if not entries:
-                raise ContentError('Empty schedule')
-            past_entries = list(filter(lambda x: x[0] <= time, entries))
-
-            # Use the most recent past entry.
-            if past_entries:
-                latest_datetime, latest_entry = max(past_entries,
-                                                    key=lambda x: x[0])
-                break
-
-            # If there were no past entries, try the previous day.
-            today -= timedelta(days=1)
+        key = (user.id, user.get('home'), today,
+               tuple((entry['name'], entry['start'], entry['image'])
+                     for entry in entries))
+
+        return user.memoize('schedule_transitions',
+                            lambda: self._compile(key, today, entries, user))
+
+    @cached(cache=TTLCache(maxsize=MAX_CACHED_SCHEDULES,
+                           ttl=SCHEDULE_CACHE_TTL_S),
+            key=lambda self, key, today, entries, user: key)
+    def _compile(self, key, today, entries, user):
+        """Finds the start times of all schedule entries around the day."""
+
+        start = today - timedelta(days=COMPILED_PAST_DAYS)
+        stop = today + timedelta(days=COMPILED_FUTURE_DAYS)
+        transitions = []
+        for index in range(len(entries)):
+            entry = dict(entries[index])
+            try:
+                times = self._sun.cron_times(entry['start'], start, stop,
+                                             user)
+            except DataError as e:
+                raise ContentError(e)
+            transitions.extend((time, index, entry) for time in times)
+
+        info('Compiled schedule: %d transitions, %s to %s' % (
+             len(transitions),
+             start.strftime('%A %B %d %Y'),
+             stop.strftime('%A %B %d %Y')))
+
+        return Transitions(transitions)
+
+    def _current_entry(self, user):
+        """Returns the current schedule entry and its start time."""
+
+        return user.memoize('schedule_entry',
+                            lambda: self._find_current_entry(user))
+
+    def _find_current_entry(self, user):
+        """Finds the current schedule entry and its start time."""
+
+        time = self._local_time.now(user)
+        latest_datetime, _, latest_entry = self._transitions(user).latest(
+            time)
+
+        return latest_datetime, latest_entry
+
+    def image(self, user, width, height, variant):
+        """Generates the current image based on the schedule."""
+
+        latest_datetime, latest_entry = self._current_entry(user)
 
         # Generate the image from the current schedule entry.
         info('Using image from schedule entry: %s (%s, %s)' % (
@@ -144,19 +229,43 @@ class Schedule(ImageContent):
 
         return image
 
+    def fingerprint(self, user, width, height, variant):
+        """Combines the kind of the current schedule entry with the
+        fingerprint of its content.
+        """
+
+        _, latest_entry = self._current_entry(user)
+        kind = latest_entry['image']
+        content = self._content(kind)
+        if not content:
+            return None
+
+        content_fingerprint = content.fingerprint(user, width, height,
+                                                  variant)
+        if content_fingerprint is None:
+            return None
+
+        return kind, content_fingerprint
+
+    def frame_ttl(self, fingerprint):
+        """Uses the time to live of the current schedule entry's content."""
+
+        kind, content_fingerprint = fingerprint
+        return self._content(kind).frame_ttl(content_fingerprint)
+
+    def dither_mode(self, fingerprint):
+        """Uses the dithering mode of the current schedule entry's content."""
+
+        kind, content_fingerprint = fingerprint
+        return self._content(kind).dither_mode(content_fingerprint)
+
     def delay(self, user):
         """Calculates the delay in milliseconds to the next schedule entry."""
 
-        # Find the next schedule entry by parsing the cron expressions.
-        try:
-            time = self._local_time.now(user)
-        except DataError as e:
-            raise ContentError(e)
-        entries = [(self._next(entry['start'], time, user), entry)
-                   for entry in user.get('schedule')]
-        if not entries:
-            raise ContentError('Empty schedule')
-        next_datetime, next_entry = min(entries, key=lambda x: x[0])
+        # Find the next schedule entry in the compiled transitions.
+        transitions = self._transitions(user)
+        time = self._local_time.now(user)
+        next_datetime, _, next_entry = transitions.following(time)
 
         # Calculate the delay in milliseconds.
         seconds = (next_datetime - time).total_seconds()
@@ -170,11 +279,14 @@ class Schedule(ImageContent):
 
         return milliseconds
 
-    def empty_timeline(self):
+    def empty_timeline(self, variant):
         """Generates an empty timeline image."""
 
-        image = Image.new(mode='RGB', size=(TIMELINE_WIDTH, TIMELINE_HEIGHT),
-                          color=TIMELINE_BACKGROUND)
+        # Draw with indices into the display's palette.
+        background, foreground = epd_indices([TIMELINE_BACKGROUND,
+                                              TIMELINE_FOREGROUND], variant)
+        canvas = new_canvas(TIMELINE_WIDTH, TIMELINE_HEIGHT, background)
+        image = epd_image(canvas, variant)
         draw = Draw(image)
 
         # Draw each day of the week.
@@ -185,13 +297,13 @@ class Schedule(ImageContent):
             # Draw a dashed vertical line.
             for y in range(0, TIMELINE_HEIGHT, 2 * TIMELINE_LINE_DASH):
                 draw.line([(x, y), (x, y + TIMELINE_LINE_DASH - 1)],
-                          fill=TIMELINE_FOREGROUND, width=TIMELINE_LINE_WIDTH)
+                          fill=foreground, width=TIMELINE_LINE_WIDTH)
 
             # Draw the abbreviated day name.
             name = day_abbr[day_index]
             day_x = x + TIMELINE_DRAW_WIDTH / num_days / 2
             day_y = TIMELINE_HEIGHT - SCREENSTAR_SMALL_REGULAR['height']
-            draw_text(name, SCREENSTAR_SMALL_REGULAR, TIMELINE_FOREGROUND,
+            draw_text(name, SCREENSTAR_SMALL_REGULAR, foreground,
                       xy=(day_x, day_y), anchor=None, box_color=None,
                       box_padding=0, border_color=None, border_width=0,
                       image=image, draw=draw)
@@ -200,18 +312,16 @@ class Schedule(ImageContent):
         for y in range(0, TIMELINE_HEIGHT, 2 * TIMELINE_LINE_DASH):
             draw.line([(TIMELINE_DRAW_WIDTH, y),
                        (TIMELINE_DRAW_WIDTH, y + TIMELINE_LINE_DASH - 1)],
-                      fill=TIMELINE_FOREGROUND, width=TIMELINE_LINE_WIDTH)
-
-        # The calendar image is already quantized (no dithering).
-        image = image.convert('P', dither=None, palette=Image.ADAPTIVE)
+                      fill=foreground, width=TIMELINE_LINE_WIDTH)
 
         return image
 
-    def timeline(self, user):
+    def timeline(self, user, variant):
         """Generates a timeline image of the schedule for settings."""
 
-        image = self.empty_timeline().convert('RGB')
+        image = self.empty_timeline(variant)
         draw = Draw(image)
+        highlight, = epd_indices([TIMELINE_HIGHLIGHT], variant)
 
         # Find the user or return the empty timeline.
         try:
@@ -233,23 +343,20 @@ class Schedule(ImageContent):
             now_timestamp - start_timestamp) / timestamp_span
         for y in range(0, TIMELINE_HEIGHT, 2 * TIMELINE_LINE_DASH):
             draw.line([(now_x, y), (now_x, y + TIMELINE_LINE_DASH - 1)],
-                      fill=TIMELINE_HIGHLIGHT, width=TIMELINE_LINE_WIDTH)
+                      fill=highlight, width=TIMELINE_LINE_WIDTH)
 
         # Generate the schedule throughout the week.
         entries = user.get('schedule')
         if not entries:
             # Empty timeline.
             return image
-        for i in range(len(entries)):
-            entries[i]['index'] = i
-        time = start
-        while time < stop:
-            # Find the next entry.
-            next_entries = [(self._next(entry['start'], time, user),
-                             entry['index'], entry) for entry in entries]
-            next_datetime, next_index, next_entry = min(next_entries,
-                                                        key=lambda x: x[0])
 
+        # Draw the entries in RGB, so that the labels keep their anti-aliased
+        # glyphs, and map each pixel to the closest palette color afterwards.
+        image = image.convert('RGB')
+        draw = Draw(image)
+        for next_datetime, next_index, next_entry in self._transitions(
+                user).between(start, stop):
             # Draw the entry's index and a vertical line, with a tilde to mark
             # the variable sunrise and sunset times.
             timestamp = datetime.timestamp(next_datetime)
@@ -264,12 +371,9 @@ class Schedule(ImageContent):
                             TIMELINE_FOREGROUND, xy=(x, y), anchor=None,
                             box_color=None, box_padding=4, border_color=None,
                             border_width=0, image=image, draw=draw)
-            draw.line([(x, 0), (x, box[1])], fill=TIMELINE_FOREGROUND, width=1)
-
-            # Jump to the next entry.
-            time = next_datetime
+            draw.line([(x, 0), (x, box[1])], fill=TIMELINE_FOREGROUND,
+                      width=1)
 
-        # The timeline image is already quantized (no dithering).
-        image = image.convert('P', dither=None, palette=Image.ADAPTIVE)
-
-        return image
+        indices = epd_indices(array(image), variant)
+        return epd_image(array(indices, dtype=uint8).reshape(
+            (TIMELINE_HEIGHT, TIMELINE_WIDTH)), variant)
@@ -1,14 +1,148 @@
 from astral import Astral
 from astral import AstralError
+from cachetools import cached
+from cachetools import LRUCache
 from croniter import croniter
+from datetime import date
 from datetime import datetime
-from datetime import timedelta
 from logging import info
+from numpy import arange
+from numpy import arccos
+from numpy import arcsin
+from numpy import clip
+from numpy import cos
+from numpy import degrees
+from numpy import errstate
+from numpy import floor
+from numpy import isnan
+from numpy import radians
+from numpy import sin
+from numpy import sqrt
+from numpy import tan
 
 from firestore import DataError
 from geocoder import GeocoderWrapper
 from local_time import LocalTime
 
+# The zenith angle in degrees of the sun's center at sunrise and sunset, which
+# accounts for refraction and the size of the sun.
+HORIZON_ZENITH = 90.833
+
+# The radius of the Earth in meters for the horizon depression at elevation.
+EARTH_RADIUS_M = 6356900
+
+# The latitude in degrees closest to the poles used in the solar equations.
+MAX_LATITUDE = 89.8
+
+# The Julian day at midnight UTC on day zero of the proleptic Gregorian
+# calendar, to convert from ordinals.
+ORDINAL_JULIAN_DAY = 1721424.5
+
+# The Julian day of the J2000.0 epoch.
+J2000_JULIAN_DAY = 2451545.0
+
+# The ordinal of the Unix epoch.
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# The number of decimal places of the coordinates sharing sunrise and sunset
+# tables, about a kilometer.
+TABLE_COORDINATE_DIGITS = 2
+
+# The maximum number of yearly sunrise and sunset tables kept in memory.
+MAX_CACHED_TABLES = 1000
+
+
+def _cron_times(cron, start, stop):
+    """Lists the times matching a cron expression from start to stop, along
+    with the last one before and the first one after.
+    """
+
+    try:
+        iterator = croniter(cron, start)
+        times = [iterator.get_prev(datetime)]
+        while times[-1] <= stop:
+            times.append(iterator.get_next(datetime))
+    except ValueError as e:
+        raise DataError(e)
+
+    return times
+
+
+def _horizon_depression(elevation):
+    """Calculates the extra degrees of depression of the horizon seen from an
+    elevation in meters.
+    """
+
+    if elevation <= 0:
+        return 0
+
+    # Follow the geometry used by astral.
+    theta = arccos(EARTH_RADIUS_M / (EARTH_RADIUS_M + elevation))
+    a = EARTH_RADIUS_M * sin(theta)
+    b = EARTH_RADIUS_M * (1 - cos(theta))
+    return float(degrees(arccos(a / sqrt(a * a + b * b))))
+
+
+@cached(cache=LRUCache(maxsize=MAX_CACHED_TABLES))
+def _sun_table(latitude, longitude, elevation, year):
+    """Calculates the UTC timestamps of sunrise and sunset on each day of the
+    year with the NOAA solar equations, vectorized over the days. Days on
+    which the sun doesn't cross the horizon are NaN.
+    """
+
+    ordinals = arange(date(year, 1, 1).toordinal(),
+                      date(year + 1, 1, 1).toordinal())
+    centuries = (ordinals + ORDINAL_JULIAN_DAY - J2000_JULIAN_DAY) / 36525
+
+    # Find the position of the sun at midnight UTC on each day.
+    mean_longitude = radians((280.46646 + centuries * (
+        36000.76983 + 0.0003032 * centuries)) % 360)
+    mean_anomaly = radians(357.52911 + centuries * (
+        35999.05029 - 0.0001537 * centuries))
+    eccentricity = 0.016708634 - centuries * (
+        0.000042037 + 0.0000001267 * centuries)
+    center = (sin(mean_anomaly) * (1.914602 - centuries * (
+                  0.004817 + 0.000014 * centuries)) +
+              sin(2 * mean_anomaly) * (0.019993 - 0.000101 * centuries) +
+              sin(3 * mean_anomaly) * 0.000289)
+    omega = radians(125.04 - 1934.136 * centuries)
+    apparent_longitude = (degrees(mean_longitude) + center - 0.00569 -
+                          0.00478 * sin(omega))
+    obliquity_seconds = 21.448 - centuries * (46.815 + centuries * (
+        0.00059 - centuries * 0.001813))
+    obliquity = radians(23 + (26 + obliquity_seconds / 60) / 60 +
+                        0.00256 * cos(omega))
+    declination = arcsin(sin(obliquity) * sin(radians(apparent_longitude)))
+
+    # Find the equation of time in minutes.
+    y = tan(obliquity / 2) ** 2
+    equation_of_time = 4 * degrees(
+        y * sin(2 * mean_longitude) -
+        2 * eccentricity * sin(mean_anomaly) +
+        4 * eccentricity * y * sin(mean_anomaly) * cos(2 * mean_longitude) -
+        0.5 * y * y * sin(4 * mean_longitude) -
+        1.25 * eccentricity * eccentricity * sin(2 * mean_anomaly))
+
+    # Find the hour angle of the sun at the horizon, which is undefined when
+    # the sun doesn't cross it.
+    phi = radians(clip(latitude, -MAX_LATITUDE, MAX_LATITUDE))
+    zenith = radians(HORIZON_ZENITH + _horizon_depression(elevation))
+    with errstate(invalid='ignore'):
+        hour_angle = degrees(arccos(
+            cos(zenith) / (cos(phi) * cos(declination)) -
+            tan(phi) * tan(declination)))
+
+    # Convert the minutes from midnight UTC to whole seconds since the epoch.
+    noon = 720 - 4 * longitude - equation_of_time
+    midnights = (ordinals - EPOCH_ORDINAL) * 86400
+    sunrises = midnights + floor((noon - 4 * hour_angle) * 60)
+    sunsets = midnights + floor((noon + 4 * hour_angle) * 60)
+
+    info('Calculated sun table: %s, %s, %s m, %d' % (latitude, longitude,
+                                                     elevation, year))
+
+    return sunrises, sunsets
+
 
 class Sun(object):
     """A wrapper around a calculator for sunrise and sunset times."""
@@ -17,69 +151,97 @@ class Sun(object):
         self._astral = Astral(geocoder=GeocoderWrapper, wrapped=geocoder)
         self._local_time = LocalTime(geocoder)
 
-    def rewrite_cron(self, cron, after, user):
-        """Replaces references to sunrise and sunset in a cron expression."""
+    def cron_times(self, cron, start, stop, user):
+        """Lists the times matching a cron expression from start to stop,
+        along with the last one before and the first one after. References to
+        sunrise and sunset are replaced with the times on each day.
+        """
 
-        # Skip if there is nothing to rewrite.
+        # Use the cron expression as it is if there is nothing to replace.
         if 'sunrise' not in cron and 'sunset' not in cron:
-            return cron
+            return _cron_times(cron, start, stop)
 
-        # Determine the first two days of the cron expression after the
-        # reference, which covers all candidate sunrises and sunsets.
-        yesterday = after - timedelta(days=1)
+        # Find the days of the cron expression and the sunrise or sunset time
+        # on each, which starts at the beginning of the minute like cron.
         midnight_cron = cron.replace('sunrise', '0 0').replace('sunset', '0 0')
-        try:
-            first_day = croniter(midnight_cron, yesterday).get_next(datetime)
-            second_day = croniter(midnight_cron, first_day).get_next(datetime)
-        except ValueError as e:
-            raise DataError(e)
+        if 'sunrise' in cron:
+            sun_time = self._sunrise
+        else:
+            sun_time = self._sunset
+        times = [sun_time(day, user).replace(second=0, microsecond=0)
+                 for day in _cron_times(midnight_cron, start, stop)]
+
+        info('Expanded cron: (%s) -> %d times from %s' % (
+            cron,
+            len(times),
+            start.strftime('%A %B %d %Y %H:%M:%S %Z')))
+
+        return times
+
+    def _home(self, user):
+        """Returns the astral location of the user's home address."""
+
+        return user.memoize('sun_location', lambda: self._astral_home(user))
+
+    def _astral_home(self, user):
+        """Looks up the astral location of the user's home address."""
 
-        zone = self._local_time.zone(user)
         try:
-            home = self._astral[user.get('home')]
+            return self._astral[user.get('home')]
         except (AstralError, KeyError) as e:
             raise DataError(e)
 
-        # Calculate the closest future sunrise time and replace the term in the
-        # cron expression with minutes and hours.
-        if 'sunrise' in cron:
-            sunrises = map(lambda x: home.sunrise(x).astimezone(zone),
-                           [first_day, second_day])
-            next_sunrise = min(filter(lambda x: x >= after, sunrises))
-            sunrise_cron = cron.replace('sunrise', '%d %d' % (
-                next_sunrise.minute, next_sunrise.hour))
-            info('Rewrote cron: (%s) -> (%s), after %s' % (
-                cron,
-                sunrise_cron,
-                after.strftime('%A %B %d %Y %H:%M:%S %Z')))
-            return sunrise_cron
-
-        # Calculate the closest future sunset time and replace the term in the
-        # cron expression with minutes and hours.
-        if 'sunset' in cron:
-            sunsets = map(lambda x: home.sunset(x).astimezone(zone),
-                          [first_day, second_day])
-            next_sunset = min(filter(lambda x: x >= after, sunsets))
-            sunset_cron = cron.replace('sunset', '%d %d' % (next_sunset.minute,
-                                                            next_sunset.hour))
-            info('Rewrote cron: (%s) -> (%s), after %s' % (
-                cron,
-                sunset_cron,
-                after.strftime('%A %B %d %Y %H:%M:%S %Z')))
-            return sunset_cron
+    def _sun_tables(self, day, user):
+        """Returns the sunrise and sunset tables for the year of the day at
+        the user's home address, shared with nearby homes.
+        """
+
+        return user.memoize(('sun_tables', day.year),
+                            lambda: self._shared_sun_tables(day, user))
+
+    def _shared_sun_tables(self, day, user):
+        """Looks up the shared sunrise and sunset tables for the year."""
+
+        home = self._home(user)
+        return _sun_table(round(home.latitude, TABLE_COORDINATE_DIGITS),
+                          round(home.longitude, TABLE_COORDINATE_DIGITS),
+                          round(home.elevation), day.year)
+
+    def _localize(self, timestamps, day, user):
+        """Looks up the localized time on the day in a sun table."""
+
+        timestamp = timestamps[day.timetuple().tm_yday - 1]
+        if isnan(timestamp):
+            raise DataError('Sun doesn\'t cross the horizon on %s' %
+                            day.strftime('%A %B %d %Y'))
+
+        return datetime.fromtimestamp(timestamp,
+                                      tz=self._local_time.zone(user))
+
+    def _sunrise(self, day, user):
+        """Looks up the localized sunrise time on the day."""
+
+        sunrises, _ = self._sun_tables(day, user)
+        return self._localize(sunrises, day, user)
+
+    def _sunset(self, day, user):
+        """Looks up the localized sunset time on the day."""
+
+        _, sunsets = self._sun_tables(day, user)
+        return self._localize(sunsets, day, user)
 
     def is_daylight(self, user):
         """Calculates whether the sun is currently up."""
 
+        return user.memoize('daylight', lambda: self._is_daylight(user))
+
+    def _is_daylight(self, user):
+        """Compares the current time to today's sunrise and sunset times."""
+
         # Find the sunrise and sunset times for today.
         time = self._local_time.now(user)
-        zone = self._local_time.zone(user)
-        try:
-            home = self._astral[user.get('home')]
-        except (AstralError, KeyError) as e:
-            raise DataError(e)
-        sunrise = home.sunrise(time).astimezone(zone)
-        sunset = home.sunset(time).astimezone(zone)
+        sunrise = self._sunrise(time, user)
+        sunset = self._sunset(time, user)
 
         is_daylight = time > sunrise and time < sunset
 
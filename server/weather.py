@@ -1,4 +1,3 @@
-from astral import AstralError
 from cachetools import cached
 from cachetools import TTLCache
 from json.decoder import JSONDecodeError
@@ -6,8 +5,9 @@ from logging import info
 from requests import get
 from requests import RequestException
 
+from firestore import config
 from firestore import DataError
-from firestore import Firestore
+from local_time import LocalTime
 
 # The endpoint of the OpenWeather One Call API.
 # Spec: https://openweathermap.org/api/one-call-api
@@ -25,23 +25,13 @@ class Weather(object):
     """A wrapper around the OpenWeather One Call API with a cache."""
 
     def __init__(self, geocoder):
-        self._open_weather_api_key = Firestore().open_weather_api_key()
-        self._geocoder = geocoder
+        self._local_time = LocalTime(geocoder)
 
-    def _icon(self, user):
+    def icon(self, user):
         """Gets the current weather icon for the user's home address."""
 
-        location = self._home_location(user)
-        return self._request_icon(location)
-
-    def _home_location(self, user):
-        """Gets the location of the user's home address."""
-
-        try:
-            home = user.get('home')
-            return self._geocoder[home]
-        except (AstralError, KeyError) as e:
-            raise DataError(e)
+        return user.memoize('weather', lambda: self._request_icon(
+            self._local_time.location(user)))
 
     @cached(cache=TTLCache(maxsize=MAX_CACHE_SIZE, ttl=CACHE_TTL_S))
     def _request_icon(self, location):
@@ -50,7 +40,7 @@ class Weather(object):
         # Look up the current weather conditions at the location.
         request_url = OPEN_WEATHER_URL % (location.latitude,
                                           location.longitude,
-                                          self._open_weather_api_key)
+                                          config.open_weather_api_key())
 
         try:
             response_json = get(request_url).json()
@@ -64,29 +54,29 @@ class Weather(object):
     def is_clear(self, user):
         """Checks if the current weather is clear."""
 
-        return self._icon(user) in ['01d', '01n']
+        return self.icon(user) in ['01d', '01n']
 
     def is_partly_cloudy(self, user):
         """Checks if the current weather is partly cloudy."""
 
-        return self._icon(user) in ['02d', '02n']
+        return self.icon(user) in ['02d', '02n']
 
     def is_cloudy(self, user):
         """Checks if the current weather is cloudy."""
 
-        return self._icon(user) in ['03d', '03n', '04d', '04n']
+        return self.icon(user) in ['03d', '03n', '04d', '04n']
 
     def is_rainy(self, user):
         """Checks if the current weather is rainy."""
 
-        return self._icon(user) in ['09d', '09n', '10d', '10n', '11d', '11n']
+        return self.icon(user) in ['09d', '09n', '10d', '10n', '11d', '11n']
 
     def is_snowy(self, user):
         """Checks if the current weather is snowy."""
 
-        return self._icon(user) in ['13d', '13n']
+        return self.icon(user) in ['13d', '13n']
 
     def is_foggy(self, user):
         """Checks if the current weather is foggy."""
 
-        return self._icon(user) in ['50d', '50n']
+        return self.icon(user) in ['50d', '50n']
@@ -1,10 +1,20 @@
+from collections import deque
+from collections import OrderedDict
 from content import ContentError
 from io import BytesIO
+from logging import exception
+from logging import info
+from logging import warning
 from requests import get
 from requests.exceptions import RequestException
 from PIL import Image
+from threading import Condition
+from threading import Thread
+from time import monotonic
+from time import sleep
 
 from content import ImageContent
+from epd import ORDERED_DITHER
 
 # The URL for requesting a random Wittgenstein 2022 proposition.
 RANDOM_PROPOSITION_URL = 'https://wittgenstein.app/random.json'
@@ -12,6 +22,177 @@ RANDOM_PROPOSITION_URL = 'https://wittgenstein.app/random.json'
 # The URL of the Wittgenstein 2022 preview image for a given proposition ID.
 PREVIEW_IMAGE_URL = 'https://wittgenstein.app/preview/%s.png'
 
+# The timeout in seconds for each request to Wittgenstein 2022.
+REQUEST_TIMEOUT_S = 10
+
+# The number of prefetched images kept for each display size.
+POOL_DEPTH = 2
+
+# The number of most recently requested display sizes kept in the pool.
+MAX_POOL_SIZES = 4
+
+# The largest display area in pixels for which images are prefetched.
+MAX_POOL_PIXELS = 1600 * 1200
+
+# The time in seconds to wait before prefetching again after an error.
+REFILL_RETRY_S = 60
+
+
+def _fetch_preview():
+    """Downloads the preview image of a random proposition."""
+
+    try:
+        # Request a random proposition.
+        json = get(RANDOM_PROPOSITION_URL, timeout=REQUEST_TIMEOUT_S).json()
+        id = json['id']
+
+        # Download the preview image for the proposition.
+        response = get(PREVIEW_IMAGE_URL % id, timeout=REQUEST_TIMEOUT_S)
+        image_data = BytesIO(response.content)
+        return Image.open(image_data).convert('RGB')
+    except (RequestException, KeyError, OSError) as e:
+        raise ContentError(e)
+
+
+def _fit_preview(image, width, height):
+    """Resizes the preview image to the display and extends the
+    background.
+    """
+
+    scale = min(width / image.width, height / image.height)
+    scaled_width = int(image.width * scale)
+    scaled_height = int(image.height * scale)
+    image = image.resize((scaled_width, scaled_height),
+                         resample=Image.LANCZOS)
+    canvas = Image.new(mode='RGB', size=(width, height), color='white')
+    x = (width - scaled_width) // 2
+    y = (height - scaled_height) // 2
+    canvas.paste(image, (x, y), 0)
+
+    # Use ordered dithering, which is fast and parallel.
+    canvas.info['dither'] = ORDERED_DITHER
+
+    return canvas
+
+
+class PropositionPool(object):
+    """A bounded pool of random proposition images, downloaded and resized
+    ahead of time for each of the most recently requested display sizes. A
+    background thread refills it, so that requests don't wait on the network.
+    """
+
+    def __init__(self, depth=POOL_DEPTH, max_sizes=MAX_POOL_SIZES):
+        self._depth = depth
+        self._max_sizes = max_sizes
+        self._images = OrderedDict()
+        self._condition = Condition()
+        self._worker = None
+        self._refills = 0
+        self._refill_seconds = 0
+
+    def pop(self, width, height):
+        """Takes a prefetched image for the display size, or returns None if
+        there is none yet. Either way, the pool is refilled for the size,
+        unless it's too large.
+        """
+
+        # Leave unusual sizes to the request.
+        if width <= 0 or height <= 0 or width * height > MAX_POOL_PIXELS:
+            return None
+
+        size = (width, height)
+        with self._condition:
+            # Keep images for the most recently requested sizes.
+            images = self._images.setdefault(size, deque())
+            self._images.move_to_end(size)
+            while len(self._images) > self._max_sizes:
+                self._images.popitem(last=False)
+
+            image = images.popleft() if images else None
+            info('Wittgenstein pool depth for %dx%d: %d' % (
+                width, height, len(images)))
+
+            self._start_worker()
+            self._condition.notify()
+
+        return image
+
+    def metrics(self):
+        """Reports the depth of the pool for each display size and the number
+        and mean latency of refills.
+        """
+
+        with self._condition:
+            depths = {'%dx%d' % size: len(images) for size, images in
+                      self._images.items()}
+            mean_refill_ms = (1000 * self._refill_seconds /
+                              self._refills if self._refills else None)
+
+            return {'depths': depths,
+                    'refills': self._refills,
+                    'mean_refill_ms': mean_refill_ms}
+
+    def _start_worker(self):
+        """Starts the background thread, unless it's already running in this
+        process. Threads don't survive forking into worker processes.
+        """
+
+        if self._worker and self._worker.is_alive():
+            return
+
+        self._worker = Thread(target=self._refill, name='wittgenstein-pool',
+                              daemon=True)
+        self._worker.start()
+
+    def _missing_size(self):
+        """Finds the most recently requested display size with room in the
+        pool, or None if it's full.
+        """
+
+        for size in reversed(self._images):
+            if len(self._images[size]) < self._depth:
+                return size
+
+        return None
+
+    def _refill(self):
+        """Keeps prefetching images while the pool has room."""
+
+        while True:
+            with self._condition:
+                width, height = self._condition.wait_for(self._missing_size)
+
+            start = monotonic()
+            try:
+                image = _fit_preview(_fetch_preview(), width, height)
+            except ContentError as e:
+                warning('Failed to prefetch Wittgenstein proposition: %s' % e)
+                sleep(REFILL_RETRY_S)
+                continue
+            except Exception:
+                # Keep the thread alive for other sizes and later requests.
+                exception('Failed to prefetch Wittgenstein proposition')
+                sleep(REFILL_RETRY_S)
+                continue
+            refill_seconds = monotonic() - start
+
+            # Drop the image if its size was evicted in the meantime.
+            with self._condition:
+                self._refills += 1
+                self._refill_seconds += refill_seconds
+                images = self._images.get((width, height))
+                if images is not None and len(images) < self._depth:
+                    images.append(image)
+                depth = len(images) if images is not None else 0
+
+            info('Prefetched Wittgenstein proposition for %dx%d in %d ms '
+                 '(depth: %d)' % (width, height, refill_seconds * 1000, depth))
+            info('Wittgenstein pool metrics: %s' % self.metrics())
+
+
+# The prefetched proposition images shared by all instances.
+pool = PropositionPool()
+
 
 class Wittgenstein(ImageContent):
     """A random proposition from Wittgenstein 2022."""
@@ -19,26 +200,14 @@ class Wittgenstein(ImageContent):
     def image(self, user, width, height, variant):
         """Picks a random proposition preview image."""
 
-        try:
-            # Request a random proposition.
-            json = get(RANDOM_PROPOSITION_URL).json()
-            id = json['id']
-
-            # Download the preview image for the proposition.
-            image_data = BytesIO(get(PREVIEW_IMAGE_URL % id).content)
-            image = Image.open(image_data).convert('RGB')
-        except (RequestException, KeyError) as e:
-            raise ContentError(e)
-
-        # Resize the image and extend the background.
-        scale = min(width / image.width, height / image.height)
-        scaled_width = int(image.width * scale)
-        scaled_height = int(image.height * scale)
-        image = image.resize((scaled_width, scaled_height),
-                             resample=Image.LANCZOS)
-        canvas = Image.new(mode='RGB', size=(width, height), color='white')
-        x = (width - scaled_width) // 2
-        y = (height - scaled_height) // 2
-        canvas.paste(image, (x, y), 0)
-
-        return canvas
+        # Use a prefetched image or download one now if there is none.
+        image = pool.pop(width, height)
+        if image is None:
+            image = _fit_preview(_fetch_preview(), width, height)
+
+        return image
+
+    def dither_mode(self, fingerprint):
+        """Prefers ordered dithering for the preview images."""
+
+        return ORDERED_DITHER